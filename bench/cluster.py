@@ -0,0 +1,115 @@
+"""
+Local cluster launcher.
+
+Runs one job on this machine: writes a config with free ports for a
+master and N workers, starts `master.py --auto` and the workers as
+subprocesses in a run directory, waits for all of them and reports wall
+time, exit codes and the peak RSS of every process (from wait4).
+"""
+
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MASTER = os.path.join(BASE_DIR, 'engine', 'master.py')
+WORKER = os.path.join(BASE_DIR, 'engine', 'worker.py')
+
+
+def free_ports(count, host='127.0.0.1'):
+    """Ask the OS for `count` distinct free TCP ports"""
+    socks = []
+    try:
+        for _ in range(count):
+            s = socket.socket()
+            s.bind((host, 0))
+            socks.append(s)
+        return [s.getsockname()[1] for s in socks]
+    finally:
+        for s in socks:
+            s.close()
+
+
+def make_config(run_dir, input_path, num_workers, base_config=None, host='127.0.0.1'):
+    """A copy of the base config with fresh ports, the input and a private work dir and map cache"""
+    config = dict(base_config or {})
+    ports = free_ports(num_workers + 1, host)
+    config['master_node'] = {"ip": host, "port": ports[0]}
+    config['worker_nodes'] = [{"id": i + 1, "ip": host, "port": port}
+                              for i, port in enumerate(ports[1:])]
+    config['input_path'] = os.path.abspath(input_path)
+    config['work_dir'] = os.path.join(os.path.abspath(run_dir), 'work')
+    config['metrics_file'] = os.path.join(os.path.abspath(run_dir), 'job_summary.json')
+    # A cache kept from an earlier run would time the cache, not the map code
+    config['map_cache_dir'] = os.path.join(os.path.abspath(run_dir), 'map_cache')
+    config.pop('expected_workers', None)
+    # Several clusters may run on one machine, do not fight over the stats port
+    config['stats_port'] = None
+    return config
+
+
+def _wait(proc, deadline):
+    """Wait for a process and return its peak RSS in MB (None if it had to be killed)"""
+    while True:
+        pid, status, usage = os.wait4(proc.pid, os.WNOHANG)
+        if pid:
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in KB on Linux
+            return usage.ru_maxrss / 1024
+        if time.monotonic() > deadline:
+            proc.kill()
+            proc.wait()
+            return None
+        time.sleep(0.05)
+
+
+def run_job(run_dir, input_path, app, app_args=(), num_workers=3, base_config=None, timeout=600):
+    """
+    Run one job on a fresh local cluster. Returns a dict with the wall
+    time, per-process exit codes and peak RSS, and the master's job summary.
+    Whatever an earlier run left in run_dir (work files, map cache) is removed.
+    """
+    shutil.rmtree(run_dir, ignore_errors=True)
+    os.makedirs(run_dir)
+    config = make_config(run_dir, input_path, num_workers, base_config)
+    config_path = os.path.join(run_dir, 'config.json')
+    with open(config_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    env = dict(os.environ, MAPREDUCE_CONFIG=config_path)
+
+    logs = []
+
+    def launch(args, log_name):
+        log = open(os.path.join(run_dir, log_name), 'w')
+        logs.append(log)
+        return subprocess.Popen([sys.executable, '-u'] + args, cwd=run_dir, env=env,
+                                stdout=log, stderr=subprocess.STDOUT, stdin=subprocess.DEVNULL)
+
+    start = time.perf_counter()
+    master = launch([MASTER, '--auto'], 'master.log')
+    workers = [launch([WORKER, str(i + 1), app] + list(app_args), f'worker_{i + 1}.log')
+               for i in range(num_workers)]
+
+    deadline = time.monotonic() + timeout
+    master_rss = _wait(master, deadline)
+    wall = time.perf_counter() - start
+    # Workers leave as soon as the master closes their connection
+    worker_rss = [_wait(w, time.monotonic() + 30) for w in workers]
+    for log in logs:
+        log.close()
+
+    summary = None
+    if os.path.exists(config['metrics_file']):
+        with open(config['metrics_file']) as f:
+            summary = json.load(f)
+    return {
+        "wall_s": wall,
+        "ok": master.returncode == 0 and summary is not None,
+        "exit_codes": {"master": master.returncode, "workers": [w.returncode for w in workers]},
+        "peak_rss_mb": {"master": master_rss, "workers": worker_rss},
+        "summary": summary,
+    }
@@ -0,0 +1,79 @@
+"""
+Synthetic Spotify-shaped dataset generator for benchmarks.
+
+Writes the same 18 columns as the Spotify "top songs" CSV the apps are
+written for (artist, song, duration_ms, explicit, year, ..., genre).
+Artists, genres and years are drawn from a Zipf-like distribution:
+skew 0 is uniform, skew 1 means the most common value is about twice as
+frequent as the second, and so on. The output only depends on the
+arguments, so every run of a benchmark reads the same bytes.
+
+Usage:
+    python bench/gen_dataset.py <out.csv> --rows 200000 [--skew 1.0] [--seed 42]
+"""
+
+import argparse
+import csv
+import random
+
+HEADER = ['artist', 'song', 'duration_ms', 'explicit', 'year', 'popularity',
+          'danceability', 'energy', 'key', 'loudness', 'mode', 'speechiness',
+          'acousticness', 'instrumentalness', 'liveness', 'valence', 'tempo', 'genre']
+
+GENRES = ['pop', 'hip hop', 'rock', 'Dance/Electronic', 'R&B', 'latin', 'country',
+          'metal', 'Folk/Acoustic', 'easy listening', 'blues', 'jazz', 'World/Traditional']
+YEARS = list(range(1985, 2024))
+NUM_ARTISTS = 2000
+CHUNK_ROWS = 10000
+
+
+def zipf_weights(n, skew):
+    return [1.0 / (rank + 1) ** skew for rank in range(n)]
+
+
+def generate(path, rows, skew=1.0, seed=42):
+    """Write `rows` songs to `path`. Returns the number of bytes written."""
+    rng = random.Random(seed)
+    artists = [f"Artist {i}" for i in range(NUM_ARTISTS)]
+    # Which value is "popular" is random, how popular is set by the skew
+    genres = GENRES[:]
+    years = YEARS[:]
+    rng.shuffle(genres)
+    rng.shuffle(years)
+    genre_weights = zipf_weights(len(genres), skew)
+    year_weights = zipf_weights(len(years), skew)
+    artist_weights = zipf_weights(len(artists), skew)
+
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(HEADER)
+        for start in range(0, rows, CHUNK_ROWS):
+            n = min(CHUNK_ROWS, rows - start)
+            chunk_artists = rng.choices(artists, artist_weights, k=n)
+            chunk_genres = rng.choices(genres, genre_weights, k=n)
+            chunk_years = rng.choices(years, year_weights, k=n)
+            for i in range(n):
+                genre = chunk_genres[i]
+                # Some songs are listed under two genres, like in the real data
+                if rng.random() < 0.1:
+                    genre = f"{genre}, {rng.choice(GENRES)}"
+                writer.writerow([
+                    chunk_artists[i], f"Song {start + i}", rng.randint(120000, 300000),
+                    rng.random() < 0.3, chunk_years[i], rng.randint(0, 100),
+                    round(rng.random(), 3), round(rng.random(), 3), rng.randint(0, 11),
+                    round(rng.uniform(-20, 0), 3), rng.randint(0, 1), round(rng.random() * 0.5, 4),
+                    round(rng.random(), 4), round(rng.random() * 0.1, 6), round(rng.random(), 4),
+                    round(rng.random(), 3), round(rng.uniform(60, 200), 3), genre
+                ])
+        return f.tell()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a Spotify-shaped CSV")
+    parser.add_argument('out')
+    parser.add_argument('--rows', type=int, default=200000)
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+    size = generate(args.out, args.rows, args.skew, args.seed)
+    print(f"Wrote {args.rows} rows ({size / 1e6:.1f} MB) to {args.out}")
@@ -0,0 +1,167 @@
+"""
+End-to-end benchmark.
+
+For every dataset size, generates a Spotify-shaped CSV (cached by size,
+skew and seed), then runs each app on a fresh local cluster and records
+throughput, per-phase times and peak RSS. The results file can be
+compared with one from another commit.
+
+Usage:
+    python bench/run_bench.py [--rows 100000,1000000] [--skew 1.0] [--workers 3]
+                              [--repeat 3] [--out bench_results.json]
+    python bench/run_bench.py --compare old.json new.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load_config
+from bench.cluster import BASE_DIR, run_job
+from bench.gen_dataset import generate
+
+# (name, module, extra args) of every job that is benchmarked
+JOBS = [
+    ("user_app", "user_app", []),
+    ("user_app_problem2", "user_app_problem2", ["--popularity"]),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def dataset(bench_dir, rows, skew, seed):
+    path = os.path.join(bench_dir, 'data', f"spotify_{rows}_s{skew}_r{seed}.csv")
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        print(f"[BENCH] Generating {rows} rows (skew {skew})...")
+        generate(path + '.tmp', rows, skew, seed)
+        os.replace(path + '.tmp', path)
+    return path
+
+
+def phase_seconds(summary):
+    return {name: info.get('wall_s') for name, info in summary['phases'].items()
+            if info.get('wall_s') is not None}
+
+
+def run_one(bench_dir, input_path, rows, name, module, app_args, args, attempt):
+    run_dir = os.path.join(bench_dir, 'runs', f"{name}_{rows}_{attempt}")
+    result = run_job(run_dir, input_path, module, app_args, args.workers,
+                     base_config=load_config(), timeout=args.timeout)
+    if not result['ok']:
+        raise RuntimeError(f"{name} on {rows} rows failed, see the logs in {run_dir}")
+    summary = result['summary']
+    map_totals = summary['phases']['map']['totals']
+    size = os.path.getsize(input_path)
+    return {
+        "wall_s": result['wall_s'],
+        "job_s": sum(phase_seconds(summary).values()),
+        "phases_s": phase_seconds(summary),
+        "throughput_mb_s": size / 1e6 / result['wall_s'],
+        "records_per_s": map_totals.get('records_in', 0) / result['wall_s'],
+        "shuffle_bytes": sum(summary['phases']['shuffle']['totals'].get('bytes_sent_by_peer', {}).values()),
+        "peak_rss_mb": {
+            "master": result['peak_rss_mb']['master'],
+            "worker_max": max(r for r in result['peak_rss_mb']['workers'] if r is not None),
+        },
+    }
+
+
+def median_run(attempts):
+    """The attempt with the median wall time, plus the spread of all of them"""
+    ordered = sorted(attempts, key=lambda r: r['wall_s'])
+    best = dict(ordered[len(ordered) // 2])
+    best['wall_s_all'] = [round(r['wall_s'], 4) for r in attempts]
+    return best
+
+
+def run_benchmarks(args):
+    bench_dir = os.path.abspath(args.dir)
+    results = {
+        "commit": git_commit(),
+        "created": time.strftime('%Y-%m-%dT%H:%M:%S'),
+        "python": platform.python_version(),
+        "machine": f"{platform.system()} {platform.machine()}, {os.cpu_count()} cpus",
+        "settings": {"workers": args.workers, "skew": args.skew, "seed": args.seed,
+                     "repeat": args.repeat},
+        "runs": [],
+    }
+    for rows in args.rows:
+        input_path = dataset(bench_dir, rows, args.skew, args.seed)
+        for name, module, app_args in JOBS:
+            if args.apps and name not in args.apps:
+                continue
+            attempts = [run_one(bench_dir, input_path, rows, name, module, app_args, args, i)
+                        for i in range(args.repeat)]
+            run = dict(median_run(attempts), app=name, rows=rows,
+                       input_bytes=os.path.getsize(input_path))
+            results['runs'].append(run)
+            print(f"[BENCH] {name:18} {rows:>9} rows  {run['wall_s']:7.2f} s  "
+                  f"{run['throughput_mb_s']:6.1f} MB/s  "
+                  + "  ".join(f"{p} {s:.2f}s" for p, s in run['phases_s'].items())
+                  + f"  rss {run['peak_rss_mb']['worker_max']:.0f} MB")
+
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"[BENCH] Results written to {args.out}")
+
+
+def compare(old_path, new_path):
+    """Print the change of every metric between two result files"""
+    with open(old_path) as f:
+        old = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    old_runs = {(r['app'], r['rows']): r for r in old['runs']}
+    for run in new['runs']:
+        before = old_runs.get((run['app'], run['rows']))
+        if before is None:
+            continue
+        rows = [("wall_s", before['wall_s'], run['wall_s']),
+                ("throughput_mb_s", before['throughput_mb_s'], run['throughput_mb_s']),
+                ("worker_rss_mb", before['peak_rss_mb']['worker_max'], run['peak_rss_mb']['worker_max'])]
+        rows += [(f"{p}_s", before['phases_s'].get(p), s) for p, s in run['phases_s'].items()]
+        print(f"{run['app']} ({run['rows']} rows)")
+        for metric, a, b in rows:
+            if a:
+                print(f"  {metric:18} {a:10.3f} -> {b:10.3f}  ({(b - a) / a * 100:+.1f}%)")
+
+
+def parse_rows(text):
+    return [int(float(n)) for n in text.split(',')]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="MapReduce end-to-end benchmark")
+    parser.add_argument('--rows', type=parse_rows, default=[100000, 1000000],
+                        help="comma separated dataset sizes in rows")
+    parser.add_argument('--skew', type=float, default=1.0)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--workers', type=int, default=3)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--apps', type=lambda s: s.split(','), default=None,
+                        help="only run these jobs (" + ", ".join(name for name, _, _ in JOBS) + ")")
+    parser.add_argument('--timeout', type=int, default=1800)
+    parser.add_argument('--dir', default=os.path.join(BASE_DIR, 'bench_work'),
+                        help="datasets and run directories")
+    parser.add_argument('--out', default='bench_results.json')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'))
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+    else:
+        run_benchmarks(args)
@@ -0,0 +1,288 @@
+"""
+Columnar copy of a CSV dataset, with zone maps.
+
+The CSV is converted once, as a separate step:
+
+    python -m engine.columnar ingest <csv> [--dest=DIR] [--row-group-rows=N] [--sort-by=COLUMN]
+
+(or by the master before a job, outside of its phase times, when config
+columnar_ingest is true) into a directory holding one file per column
+and a manifest.json. Rows are cut into row groups of
+`row_group_rows` rows, and each column of a row group is one chunk:
+
+- "int":  every value is a plain integer (str(int(v)) == v), stored as
+          the narrowest machine ints that hold them (1 to 8 bytes), with
+          the chunk's min and max,
+- "str":  anything else, UTF-8 text joined by NUL bytes, with min and
+          max as strings ("json" when a value contains a NUL byte).
+
+A column is an "int" column when all of its chunks are, and map_columns
+gets its values as ints. Every other column is read as strings, also
+from its chunks that happen to hold only integers, so a text column
+never changes type from one row group to the next.
+
+Apps opt in next to map_batch with:
+
+    COLUMNS = [0, 2, 4]           # column indexes map_columns reads
+    def map_columns(columns):     # {index: values} of some rows -> pairs
+    ZONE_FILTER = {4: (lo, hi)}   # optional: rows whose column 4 is outside
+                                  # [lo, hi] produce nothing
+
+A map task then reads only the chunks of the declared columns, and skips a
+row group whose min/max show that the filter drops all of its rows.
+Zone maps only prune when the filtered column is clustered, so the
+ingest can sort the rows by one column (--sort-by).
+
+The header is dropped, and so are rows with fewer fields than the header
+(extra fields are ignored), the same rows the apps skip when reading
+the CSV. The copy is rebuilt when the CSV's size or mtime changes.
+"""
+
+import array
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+VERSION = 2
+MANIFEST = 'manifest.json'
+INT64 = (-(1 << 63), (1 << 63) - 1)
+# array typecodes for integer chunks, narrowest first
+INT_TYPECODES = 'bhiq'
+
+# Manifests read so far, by (directory, mtime)
+_manifests = {}
+
+
+def column_file(index):
+    return f"col_{index:03d}.bin"
+
+
+def _int_value(text):
+    try:
+        value = int(text)
+    except ValueError:
+        return None
+    if str(value) != text or not INT64[0] <= value <= INT64[1]:
+        return None
+    return value
+
+
+def _typecode(low, high):
+    for code in INT_TYPECODES:
+        bits = array.array(code).itemsize * 8
+        if -(1 << (bits - 1)) <= low and high < (1 << (bits - 1)):
+            return code
+    return 'q'
+
+
+def encode_chunk(values):
+    """(type, bytes, min, max) of one column of a row group"""
+    ints = [_int_value(v) for v in values]
+    if None not in ints:
+        low, high = min(ints), max(ints)
+        code = _typecode(low, high)
+        return f"int:{code}", array.array(code, ints).tobytes(), low, high
+    if any('\0' in v for v in values):
+        return "json", json.dumps(values).encode('utf-8'), min(values), max(values)
+    return "str", '\0'.join(values).encode('utf-8'), min(values), max(values)
+
+
+def decode_chunk(kind, data, byteorder=sys.byteorder):
+    if kind.startswith("int"):
+        values = array.array(kind[4:])
+        values.frombytes(data)
+        if byteorder != sys.byteorder:
+            values.byteswap()
+        return values.tolist()
+    if kind == "json":
+        return json.loads(data)
+    return data.decode('utf-8').split('\0')
+
+
+def _source_info(csv_path):
+    st = os.stat(csv_path)
+    return {"path": os.path.abspath(csv_path), "size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+
+def _row_groups(rows, size):
+    group = []
+    for row in rows:
+        group.append(row)
+        if len(group) == size:
+            yield group
+            group = []
+    if group:
+        yield group
+
+
+def ingest(csv_path, dest_dir, row_group_rows=2048, sort_by=None):
+    """
+    Convert `csv_path` into a columnar directory. `sort_by` (a column
+    index or name) orders the rows first, which keeps all of them in memory.
+    Returns the manifest.
+    """
+    source = _source_info(csv_path)
+    tmp_dir = f"{dest_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+
+    with open(csv_path, newline='', encoding='utf-8') as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        width = len(header)
+        if isinstance(sort_by, str):
+            sort_by = int(sort_by) if sort_by.isdigit() else header.index(sort_by)
+        rows = (row[:width] for row in reader if len(row) >= width)
+        if sort_by is not None:
+            rows = sorted(rows, key=lambda row: (_int_value(row[sort_by]) is None,
+                                                 _int_value(row[sort_by]) or 0, row[sort_by]))
+
+        files = [open(os.path.join(tmp_dir, column_file(i)), 'wb') for i in range(width)]
+        int_columns = [True] * width
+        try:
+            row_groups = []
+            total = 0
+            for group in _row_groups(rows, row_group_rows):
+                digest = hashlib.blake2b(digest_size=20)
+                chunks = []
+                for i, values in enumerate(zip(*group)):
+                    kind, data, low, high = encode_chunk(list(values))
+                    int_columns[i] = int_columns[i] and kind.startswith("int")
+                    digest.update(kind.encode('utf-8') + len(data).to_bytes(8, 'little'))
+                    digest.update(data)
+                    chunks.append({"offset": files[i].tell(), "length": len(data),
+                                   "type": kind, "min": low, "max": high})
+                    files[i].write(data)
+                row_groups.append({"rows": len(group), "digest": digest.hexdigest(),
+                                   "columns": chunks})
+                total += len(group)
+        finally:
+            for column in files:
+                column.close()
+
+    manifest = {"version": VERSION, "source": source, "header": header, "rows": total,
+                "column_types": ["int" if is_int else "str" for is_int in int_columns],
+                "byteorder": sys.byteorder, "sort_by": sort_by, "row_groups": row_groups}
+    with open(os.path.join(tmp_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(dest_dir, ignore_errors=True)
+    os.replace(tmp_dir, dest_dir)
+    return manifest
+
+
+def load_manifest(dest_dir):
+    path = os.path.join(dest_dir, MANIFEST)
+    key = (os.path.abspath(dest_dir), os.stat(path).st_mtime_ns)
+    if key not in _manifests:
+        with open(path) as f:
+            _manifests[key] = json.load(f)
+    return _manifests[key]
+
+
+def is_fresh(dest_dir, csv_path):
+    """True if `dest_dir` holds a columnar copy of the current `csv_path`"""
+    try:
+        manifest = load_manifest(dest_dir)
+    except (OSError, ValueError):
+        return False
+    source = _source_info(csv_path)
+    return manifest.get("version") == VERSION and \
+        all(manifest["source"].get(k) == source[k] for k in ("size", "mtime_ns"))
+
+
+def compute_splits(dest_dir, num_splits):
+    """Cut the row groups into at most `num_splits` contiguous ranges"""
+    count = len(load_manifest(dest_dir)["row_groups"])
+    return subdivide_row_groups({"path": dest_dir, "row_groups": [0, count]}, num_splits)
+
+
+def subdivide_row_groups(split, parts):
+    """Cut one split into at most `parts` smaller ones"""
+    start, end = split['row_groups']
+    parts = max(1, min(parts, end - start))
+    bounds = [start + (end - start) * i // parts for i in range(parts + 1)]
+    return [dict(split, row_groups=[a, b]) for a, b in zip(bounds, bounds[1:]) if b > a]
+
+
+def split_digest(split):
+    """Content hash of the row groups of a split (see engine/mapcache.py)"""
+    manifest = load_manifest(split['path'])
+    start, end = split['row_groups']
+    h = hashlib.blake2b(b'columnar', digest_size=20)
+    for group in manifest["row_groups"][start:end]:
+        h.update(group["digest"].encode('ascii'))
+    return h.hexdigest()
+
+
+def may_match(group, zone_filter):
+    """False when the zone maps show `zone_filter` drops every row of the group"""
+    for index, (low, high) in (zone_filter or {}).items():
+        chunk = group["columns"][int(index)]
+        # Only integer chunks have comparable bounds
+        if not chunk["type"].startswith("int"):
+            continue
+        if (high is not None and chunk["min"] > high) or (low is not None and chunk["max"] < low):
+            return False
+    return True
+
+
+class ColumnReader:
+    """Reads column chunks of one columnar directory"""
+
+    def __init__(self, dest_dir):
+        self.dest_dir = dest_dir
+        self.manifest = load_manifest(dest_dir)
+        self.files = {}
+        self.bytes_read = 0
+
+    def row_groups(self, split):
+        start, end = split['row_groups']
+        return self.manifest["row_groups"][start:end]
+
+    def read(self, group, columns):
+        """{column index: values} of a row group"""
+        result = {}
+        for index in columns:
+            chunk = group["columns"][index]
+            f = self.files.get(index)
+            if f is None:
+                f = self.files[index] = open(os.path.join(self.dest_dir, column_file(index)), 'rb')
+            f.seek(chunk["offset"])
+            data = f.read(chunk["length"])
+            self.bytes_read += len(data)
+            values = decode_chunk(chunk["type"], data, self.manifest["byteorder"])
+            if chunk["type"].startswith("int") and self.manifest["column_types"][index] != "int":
+                # Integers of a text column, back as the text they were
+                values = list(map(str, values))
+            result[index] = values
+        return result
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        self.files.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+if __name__ == "__main__":
+    # Usage: python -m engine.columnar ingest <csv> [--dest=DIR] [--row-group-rows=N] [--sort-by=COLUMN]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+    options = dict(arg[2:].split('=', 1) for arg in sys.argv[1:] if arg.startswith('--') and '=' in arg)
+    if len(args) != 2 or args[0] != 'ingest':
+        sys.exit("Usage: python -m engine.columnar ingest <csv> [--dest=DIR] [--row-group-rows=N] "
+                 "[--sort-by=COLUMN]")
+    csv_path = args[1]
+    dest = options.get('dest', f"{csv_path}.columnar")
+    manifest = ingest(csv_path, dest, int(options.get('row-group-rows', 2048)),
+                      options.get('sort-by'))
+    size = sum(os.path.getsize(os.path.join(dest, column_file(i))) for i in range(len(manifest["header"])))
+    print(f"Wrote {manifest['rows']} rows in {len(manifest['row_groups'])} row groups "
+          f"({size} bytes) to {dest}")
@@ -0,0 +1,176 @@
+"""
+Payload compression with stdlib codecs.
+
+Shuffle batches and the larger control messages (key samples, split
+partials, recovery task lists) repeat the same keys, field names and
+artist names over and over, so they compress very well. Every connection
+negotiates a codec when it opens: each side lists the codecs it can
+decode (lzma and bz2 are optional in some Python builds) and the sender
+only uses the configured codec if the receiver has it.
+
+A compressed frame carries the codec id in its first byte, see
+engine/protocol.py. Small payloads are always sent as they are.
+
+The level adapts to what is measured on the connection. Compressing and
+sending happen one after the other, so sending one input byte costs
+1 / cpu_rate + ratio / net_rate when compressed and 1 / net_rate when
+not. Every few payloads the compressor moves one level up or down,
+whichever looks cheaper, and switches itself off (probing again now and
+then) when sending raw bytes is faster or the data does not compress.
+"""
+
+import time
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import bz2
+except ImportError:
+    bz2 = None
+
+# name -> (id on the wire, module, lowest level, highest level)
+CODECS = {"zlib": (1, zlib, 1, 9)}
+if lzma is not None:
+    CODECS["lzma"] = (2, lzma, 0, 9)
+if bz2 is not None:
+    CODECS["bz2"] = (3, bz2, 1, 9)
+CODEC_IDS = {codec_id: module for codec_id, module, _, _ in CODECS.values()}
+
+# Payloads that shrink less than this are not worth compressing
+INCOMPRESSIBLE = 0.9
+ADJUST_EVERY = 16
+PROBE_EVERY = 64
+# Weight of a new measurement in the moving averages
+SMOOTHING = 0.3
+
+
+def available_codecs():
+    return list(CODECS)
+
+
+def _compress(module, data, level):
+    if module is lzma:
+        return lzma.compress(data, preset=level)
+    return module.compress(data, level)
+
+
+def decompress(payload):
+    """Undo AdaptiveCompressor.compress: [codec id][compressed bytes]"""
+    module = CODEC_IDS.get(payload[0])
+    if module is None:
+        raise ValueError(f"Unknown compression codec id: {payload[0]}")
+    return module.decompress(payload[1:])
+
+
+class AdaptiveCompressor:
+    """Compresses the payloads of one connection (not thread-safe)"""
+
+    def __init__(self, codec='zlib', min_bytes=4096, level=None):
+        self.codec = codec
+        self.codec_id, self.module, self.min_level, self.max_level = CODECS[codec]
+        self.min_bytes = min_bytes
+        # A fixed level turns the adaptation off
+        self.fixed = level is not None
+        self.level = level if level is not None else self.min_level
+        self.enabled = True
+        self.calls = 0
+        # Moving averages: compression speed (input bytes/s) and ratio per
+        # level, and how fast the link takes bytes (None until measured)
+        self.cpu_rate = {}
+        self.ratio = {}
+        self.net_rate = None
+        # Counters
+        self.raw_bytes = 0
+        self.wire_bytes = 0
+        self.compressed = 0
+        self.skipped = 0
+        self.compress_s = 0.0
+
+    def compress(self, data):
+        """Return the bytes to send for `data`, or None to send it as it is"""
+        size = len(data)
+        if size < self.min_bytes or (not self.enabled and self.calls % PROBE_EVERY):
+            self.calls += 1
+            return self._skip(size)
+        self.calls += 1
+        level = self.level
+        start = time.perf_counter()
+        out = _compress(self.module, data, level)
+        seconds = time.perf_counter() - start
+        self.compress_s += seconds
+        self._average(self.cpu_rate, level, size / max(seconds, 1e-9))
+        self._average(self.ratio, level, len(out) / size)
+
+        if len(out) >= size * INCOMPRESSIBLE:
+            self.enabled = False
+            return self._skip(size)
+        if not self.enabled:
+            # A probe: stay off while raw bytes are still faster
+            cost = self._cost(level)
+            if cost is not None and cost > 1 / self.net_rate:
+                return self._skip(size)
+            self.enabled = True
+        self.compressed += 1
+        self.raw_bytes += size
+        self.wire_bytes += len(out) + 1
+        if not self.fixed and self.compressed % ADJUST_EVERY == 0:
+            self._adjust()
+        return bytes((self.codec_id,)) + out
+
+    def observe_send(self, nbytes, seconds):
+        """Bytes that took `seconds` to go out on the link (writes, drains and acks)"""
+        if nbytes and seconds > 0:
+            rate = nbytes / seconds
+            self.net_rate = rate if self.net_rate is None else \
+                (1 - SMOOTHING) * self.net_rate + SMOOTHING * rate
+
+    def counters(self):
+        return {"raw_bytes": self.raw_bytes, "wire_bytes": self.wire_bytes,
+                "compressed": self.compressed, "skipped": self.skipped,
+                "compress_s": self.compress_s, "level": self.level if self.enabled else None}
+
+    def _skip(self, size):
+        self.skipped += 1
+        self.raw_bytes += size
+        self.wire_bytes += size
+        return None
+
+    def _average(self, table, level, value):
+        old = table.get(level)
+        table[level] = value if old is None else (1 - SMOOTHING) * old + SMOOTHING * value
+
+    def _cost(self, level):
+        """Seconds to compress and send one input byte at `level` (None if unknown)"""
+        if level not in self.ratio or self.net_rate is None:
+            return None
+        return 1 / self.cpu_rate[level] + self.ratio[level] / self.net_rate
+
+    def _adjust(self):
+        if self.net_rate is None:
+            return
+        cost = self._cost(self.level)
+        if cost > 1 / self.net_rate and self.level == self.min_level:
+            # Even the fastest level loses against raw bytes: CPU is the bottleneck
+            self.enabled = False
+            return
+        lower, higher = self._cost(self.level - 1), self._cost(self.level + 1)
+        if lower is not None and lower < cost and self.level > self.min_level:
+            self.level -= 1
+        elif self.level < self.max_level and (higher is None or higher < cost):
+            # Unmeasured levels get tried once compression is clearly cheap
+            if higher is not None or 1 / self.cpu_rate[self.level] < cost / 2:
+                self.level += 1
+        elif self.level > self.min_level and lower is None and 1 / self.cpu_rate[self.level] > cost / 2:
+            self.level -= 1
+
+
+def negotiate(config, peer_codecs):
+    """A compressor for a peer that can decode `peer_codecs`, or None to send raw"""
+    codec = config.get('compression', 'zlib')
+    if not codec or codec not in CODECS or codec not in (peer_codecs or []):
+        return None
+    return AdaptiveCompressor(codec, config.get('compression_min_bytes', 4096),
+                              config.get('compression_level'))
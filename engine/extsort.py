@@ -0,0 +1,196 @@
+"""
+External sort-merge grouping for the reduce phase.
+
+Records are buffered in memory, and a full buffer is sorted by key and
+written out as a run file. At reduce time the runs (plus whatever is
+still buffered) are k-way merged with heapq.merge and handed out one key
+at a time, so peak memory is bounded by the buffers and not by the size
+of the partition. Runs can be zlib-compressed (compress_level), trading a
+little CPU for less disk traffic.
+
+The buffers of many sorters (every reduce partition and staged shuffle
+group of a worker) share one MemoryBudget of `max_records`: once they
+hold more than that, the largest buffer is emptied. With a `combine`
+function (the app's combine_function) it is first combined per key, and
+only spilled if that did not halve it, so data that arrives in many
+small batches is pre-aggregated as it comes.
+
+At most `merge_fan_in` runs are open at once: with more, groups of them
+are first merged into bigger runs, in as many passes as needed.
+"""
+
+import heapq
+import itertools
+import os
+import threading
+from operator import itemgetter
+
+from engine.records import RecordWriter, read_records
+
+_by_key = itemgetter(0)
+
+
+class MemoryBudget:
+    """Records buffered in memory by a set of sorters, e.g. all of a worker's"""
+
+    def __init__(self, max_records):
+        self.max_records = max_records
+        self.lock = threading.Lock()
+        self.used = 0
+        self.sorters = set()
+        # Sorters being emptied right now, by whichever thread went over budget
+        self.shrinking = set()
+
+    def register(self, sorter):
+        with self.lock:
+            self.sorters.add(sorter)
+
+    def unregister(self, sorter):
+        """The sorter's buffer is not emptied for the budget any more"""
+        with self.lock:
+            self.sorters.discard(sorter)
+
+    def release(self, records):
+        with self.lock:
+            self.used -= records
+
+    def reserve(self, records):
+        """Count new records, emptying the largest buffers while over budget"""
+        with self.lock:
+            self.used += records
+        while True:
+            with self.lock:
+                if self.used <= self.max_records:
+                    return
+                candidates = [sorter for sorter in self.sorters
+                              if sorter.buffer and sorter not in self.shrinking]
+                if not candidates:
+                    return
+                victim = max(candidates, key=lambda sorter: len(sorter.buffer))
+                self.shrinking.add(victim)
+            # Outside the budget's lock: a spill writes a file
+            try:
+                victim.shrink()
+            finally:
+                with self.lock:
+                    self.shrinking.discard(victim)
+
+
+class ExternalSorter:
+    def __init__(self, spill_dir, max_records=100000, prefix="run", compress_level=None, combine=None,
+                 budget=None, merge_fan_in=64):
+        self.spill_dir = spill_dir
+        self.prefix = prefix
+        self.compress_level = compress_level
+        self.combine = combine
+        # A budget of its own unless it shares one with other sorters
+        self.budget = budget if budget is not None else MemoryBudget(max_records)
+        self.merge_fan_in = max(2, merge_fan_in)
+        self.lock = threading.Lock()
+        self.buffer = []
+        self.runs = []
+        self.count = 0
+        self.spilled_bytes = 0
+        self._run_ids = itertools.count()
+        self.budget.register(self)
+
+    def add(self, key, value):
+        self.extend([(key, value)])
+
+    def extend(self, pairs):
+        with self.lock:
+            before = len(self.buffer)
+            self.buffer.extend(pairs)
+            added = len(self.buffer) - before
+            self.count += added
+        self.budget.reserve(added)
+
+    def shrink(self):
+        """Combine the buffer, and spill it unless that halved it (called by the budget)"""
+        with self.lock:
+            before = len(self.buffer)
+            if self.combine is not None:
+                self._combine_buffer()
+            if len(self.buffer) > before // 2:
+                self._spill()
+            freed = before - len(self.buffer)
+        self.budget.release(freed)
+
+    def _combine_buffer(self):
+        grouped = {}
+        for key, value in self.buffer:
+            if key not in grouped: grouped[key] = []
+            grouped[key].append(value)
+        self.buffer = [(key, values[0] if len(values) == 1 else self.combine(key, values))
+                       for key, values in grouped.items()]
+
+    def _run_path(self):
+        os.makedirs(self.spill_dir, exist_ok=True)
+        return os.path.join(self.spill_dir, f"{self.prefix}_{next(self._run_ids)}.bin")
+
+    def _spill(self):
+        """Write the in-memory buffer as one sorted run file"""
+        if not self.buffer:
+            return
+        path = self._run_path()
+        self.buffer.sort(key=_by_key)
+        with RecordWriter(path, compress_level=self.compress_level) as writer:
+            writer.write_all(self.buffer)
+        self.spilled_bytes += os.path.getsize(path)
+        self.runs.append(path)
+        self.buffer = []
+
+    def absorb(self, other):
+        """Take over all records (and run files) of another sorter"""
+        other.budget.unregister(other)
+        with other.lock:
+            runs, buffer, count, spilled_bytes = other.runs, other.buffer, other.count, other.spilled_bytes
+            other.runs = []
+            other.buffer = []
+            other.count = 0
+        other.budget.release(len(buffer))
+        with self.lock:
+            self.runs.extend(runs)
+            self.spilled_bytes += spilled_bytes
+            self.count += count - len(buffer)
+        self.extend(buffer)
+
+    def _merge_runs(self, runs):
+        """Merge sorted run files into one, and delete them"""
+        path = self._run_path()
+        merged = heapq.merge(*(read_records(run) for run in runs), key=_by_key)
+        with RecordWriter(path, compress_level=self.compress_level) as writer:
+            writer.write_all(merged)
+        for run in runs:
+            os.remove(run)
+        return path
+
+    def groups(self):
+        """Yield (key, values) in key order; values is a one-shot iterator"""
+        # The budget leaves the buffer alone while it is merged
+        self.budget.unregister(self)
+        with self.lock:
+            # Merge passes until the runs and the buffer fit in merge_fan_in open streams
+            while len(self.runs) >= self.merge_fan_in:
+                group = self.runs[:self.merge_fan_in]
+                self.runs = self.runs[self.merge_fan_in:] + [self._merge_runs(group)]
+            self.buffer.sort(key=_by_key)
+            streams = [read_records(path) for path in self.runs]
+            streams.append(iter(self.buffer))
+        merged = heapq.merge(*streams, key=_by_key)
+        for key, records in itertools.groupby(merged, key=_by_key):
+            yield key, (value for _, value in records)
+
+    def cleanup(self):
+        self.budget.unregister(self)
+        with self.lock:
+            for path in self.runs:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            freed = len(self.buffer)
+            self.runs = []
+            self.buffer = []
+            self.count = 0
+        self.budget.release(freed)
@@ -0,0 +1,108 @@
+"""
+Local worker launcher for a warm cluster (`master.py --serve`).
+
+    python engine/launcher.py [problem_module] [--flags]
+
+Every launcher_poll_s seconds it asks the master for its jobs and workers
+and sizes the cluster to the largest queued or running job: one worker
+per launcher_bytes_per_worker bytes of input, at least
+launcher_min_workers and at most launcher_max_workers (0: one per core).
+Missing workers are started as `worker.py auto`: they listen on any free
+port and get their id from the master. Once the master has had nothing
+to run for launcher_idle_s seconds, the workers the launcher started are
+stopped again, newest first, down to the minimum. Workers started by hand
+count towards the size but are never stopped.
+
+The master holds a queued job back for up to scale_up_wait_s seconds
+until that many workers have joined, as a job only runs on the workers
+connected when it starts.
+"""
+
+import math
+import os
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load_config
+from engine.submit import request
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+WORKER = os.path.join(BASE_DIR, 'engine', 'worker.py')
+
+
+def max_workers(config):
+    return config.get('launcher_max_workers', 0) or os.cpu_count() or 1
+
+
+def workers_for(input_bytes, config):
+    """How many workers a job over `input_bytes` of input should get"""
+    per_worker = config.get('launcher_bytes_per_worker', 64 * 1024 * 1024)
+    return min(max_workers(config), max(1, math.ceil((input_bytes or 0) / per_worker)))
+
+
+def wanted_workers(reply, config):
+    """Workers the largest queued or running job calls for (0 when there is no work)"""
+    return max((workers_for(job['input_bytes'], config)
+                for job in reply['jobs'] if job['state'] in ('QUEUED', 'RUNNING')), default=0)
+
+
+def run(argv):
+    config = load_config()
+    min_workers = config.get('launcher_min_workers', 1)
+    idle_s = config.get('launcher_idle_s', 30)
+    poll_s = config.get('launcher_poll_s', 1.0)
+    log_dir = os.path.join(config.get('work_dir', 'work'), 'launcher')
+    os.makedirs(log_dir, exist_ok=True)
+
+    started = []
+    launched = 0
+    idle_since = time.monotonic()
+    print(f"[LAUNCHER] Keeping {min_workers} to {max_workers(config)} workers")
+    try:
+        while True:
+            try:
+                (reply,) = request({"type": "jobs"})
+            except OSError:
+                print("[LAUNCHER] The master is gone, stopping.")
+                return 0
+            started = [p for p in started if p.poll() is None]
+            mine = {p.pid for p in started}
+            # Our workers count from the start, even before they registered
+            others = sum(1 for wid, status in reply['workers'].items()
+                         if status != 'LOST' and reply['pids'].get(wid) not in mine)
+            wanted = wanted_workers(reply, config)
+            if wanted:
+                idle_since = time.monotonic()
+            target = max(min_workers, wanted)
+
+            if others + len(started) < target:
+                for _ in range(target - others - len(started)):
+                    launched += 1
+                    with open(os.path.join(log_dir, f"worker_{launched}.log"), 'w') as log:
+                        started.append(subprocess.Popen(
+                            [sys.executable, WORKER, 'auto'] + argv,
+                            stdout=log, stderr=subprocess.STDOUT, cwd=os.getcwd()))
+                print(f"[LAUNCHER] {target} workers wanted, {len(started)} started here")
+
+            elif time.monotonic() - idle_since > idle_s and started and others + len(started) > target:
+                surplus = min(len(started), others + len(started) - target)
+                for p in started[-surplus:]:
+                    p.terminate()
+                    p.wait()
+                started = started[:-surplus]
+                print(f"[LAUNCHER] Idle, stopped {surplus} workers ({len(started)} left here)")
+
+            time.sleep(poll_s)
+    except KeyboardInterrupt:
+        return 0
+    finally:
+        for p in started:
+            p.terminate()
+        for p in started:
+            p.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(run(sys.argv[1:]))
@@ -0,0 +1,153 @@
+"""
+Content-addressed cache of map outputs.
+
+A map task's output only depends on the bytes of its split and on the
+problem module, so it is stored under a hash of:
+
+- the split's content (not its offsets: the same rows anywhere hit; the
+  digests of its row groups for a columnar input),
+- the module's source file, the record format version and the version
+  of what an entry holds besides the output (ENTRY_VERSION),
+- the configure_features() arguments and the module's UPPER_CASE
+  constants after configuration (INTERVAL_SIZE, POPULARITY_ENABLED, ...).
+
+A hit is hard-linked (or copied) into the worker's work dir, so the map
+step is skipped entirely and eviction never removes a file a job still
+reads. Because of the links, map outputs must be replaced (unlinked and
+written anew), never rewritten in place.
+
+The cache is opt-in (config "map_cache": true): a job that hits it does
+not run the map code at all, which is not what a benchmark or a changed
+module outside the fingerprint expects.
+
+The cache is bounded by total size and evicts the least recently used
+entries (by mtime, refreshed on every hit). Several workers on one
+machine may share a cache directory.
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import shutil
+import uuid
+
+from engine import columnar
+from engine.records import MAGIC
+
+READ_SIZE = 1 << 20
+# Bumped when the info stored with an output changes
+# (2: key samples are counted before the combiner)
+ENTRY_VERSION = 2
+CONSTANT_TYPES = (bool, int, float, str, tuple, list, type(None))
+
+
+def module_fingerprint(module, extra_args=None):
+    """Hash of everything in the problem module that can change map output"""
+    h = hashlib.sha256(MAGIC)
+    with open(inspect.getsourcefile(module), 'rb') as f:
+        h.update(f.read())
+    h.update(json.dumps(list(extra_args or [])).encode('utf-8'))
+    constants = sorted((name, repr(value)) for name, value in vars(module).items()
+                       if name.isupper() and isinstance(value, CONSTANT_TYPES))
+    h.update(repr(constants).encode('utf-8'))
+    return h.hexdigest()
+
+
+def split_digest(split):
+    """Hash of the bytes of a split"""
+    if 'row_groups' in split:
+        return columnar.split_digest(split)
+    h = hashlib.blake2b(digest_size=20)
+    with open(split['path'], 'rb') as f:
+        f.seek(split['start'])
+        remaining = split['end'] - split['start']
+        while remaining > 0:
+            chunk = f.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            h.update(chunk)
+            remaining -= len(chunk)
+    return h.hexdigest()
+
+
+class MapCache:
+    def __init__(self, cache_dir, max_bytes, fingerprint):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.fingerprint = fingerprint
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def key(self, split):
+        return hashlib.sha256(
+            f"{ENTRY_VERSION}:{self.fingerprint}:{split_digest(split)}".encode()).hexdigest()
+
+    def _paths(self, key):
+        base = os.path.join(self.cache_dir, key)
+        return base + '.bin', base + '.json'
+
+    def get(self, key, dest):
+        """On a hit, place the cached output at `dest` and return its info dict"""
+        data_path, info_path = self._paths(key)
+        try:
+            with open(info_path) as f:
+                info = json.load(f)
+            _link_or_copy(data_path, dest)
+        except (OSError, ValueError):
+            return None
+        # Recently used entries are evicted last
+        try:
+            os.utime(data_path)
+        except OSError:
+            pass
+        return info
+
+    def put(self, key, src, info):
+        """Store a map output (and its info, e.g. the key sample) under `key`"""
+        data_path, info_path = self._paths(key)
+        tmp = os.path.join(self.cache_dir, f".{uuid.uuid4().hex}.tmp")
+        try:
+            _link_or_copy(src, tmp)
+            with open(tmp + '.json', 'w') as f:
+                json.dump(info, f)
+            # The info file goes last: an entry without it is never a hit
+            os.replace(tmp, data_path)
+            os.replace(tmp + '.json', info_path)
+        except OSError:
+            for path in (tmp, tmp + '.json'):
+                if os.path.exists(path):
+                    os.remove(path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith('.bin'):
+                continue
+            path = os.path.join(self.cache_dir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for victim in (path[:-4] + '.json', path):
+                try:
+                    os.remove(victim)
+                except OSError:
+                    pass
+            total -= size
+
+
+def _link_or_copy(src, dest):
+    if os.path.exists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
@@ -1,125 +1,914 @@
-import socket
-import threading
-import json
+import asyncio
+import itertools
 import sys
 import os
 import time
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_config
+from utils import load_config, format_problems
+from engine.protocol import encode_message, read_message, write_message
+from engine.splits import compute_splits
+from engine import columnar
+from engine.scheduler import TaskScheduler
+from engine.partitioner import HashPartitioner, build_balanced
+from engine.metrics import JobMetrics, serve_stats, add_counters
+from engine.compression import available_codecs, negotiate
+from engine.output import merge_results, output_labels
+from engine.storage import place_markers, remove_markers
+from engine.launcher import workers_for
+from engine import profiling
 
-connected_workers = {} 
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+connected_workers = {}
 worker_status = {}
-lock = threading.Lock()
+worker_addresses = {}
+# Process id of each worker, so a launcher can tell its own workers apart
+worker_pids = {}
+# The problem modules (and flags) each worker was started with
+worker_problem = {}
+# Compressor for the commands sent to each worker (None: send raw)
+worker_compressors = {}
+# Everything runs on one event loop, so the state needs no locks.
+# Set on every registration / status change, replaces polling
+state_changed = asyncio.Event()
+connection_tasks = set()
+
+# Failure detection: time of the last message from each worker
+last_seen = {}
+
+# Jobs by id (finished ones are kept for the stats), and the ones waiting to run
+jobs = {}
+job_queue = []
+job_ids = itertools.count(1)
+shutdown_requested = False
+# master.py --profile: profile every job (see engine/profiling.py)
+profile_jobs = False
+# Columnar copies of the inputs are built one at a time
+ingest_lock = asyncio.Lock()
+
+async def columnar_input(data_path, config):
+    """
+    The columnar copy of an input (see engine/columnar.py), or None when
+    there is no up to date one. It is built with `python -m engine.columnar
+    ingest <csv>`, or here when config columnar_ingest is true.
+    """
+    dest = f"{data_path}.columnar"
+    async with ingest_lock:
+        if not columnar.is_fresh(dest, data_path):
+            if not config.get('columnar_ingest', False):
+                print(f"[MASTER] No up to date columnar copy of {data_path}, reading the CSV "
+                      f"(build one with: python -m engine.columnar ingest {data_path})")
+                return None
+            print(f"[MASTER] Converting {data_path} to columnar row groups in {dest}...")
+            start = time.perf_counter()
+            manifest = await asyncio.to_thread(
+                columnar.ingest, data_path, dest,
+                config.get('columnar_row_group_rows', 2048), config.get('columnar_sort_by'))
+            print(f"[MASTER] {manifest['rows']} rows in {len(manifest['row_groups'])} row groups "
+                  f"({(time.perf_counter() - start) * 1000:.1f} ms)")
+    return dest
+
+def notify():
+    state_changed.set()
+
+async def wait_for_change(timeout=None):
+    """Sleep until the state changes (or `timeout` seconds pass)"""
+    try:
+        await asyncio.wait_for(state_changed.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    state_changed.clear()
+
+async def wait_for_workers(expected):
+    """Block until `expected` workers have registered"""
+    while len(connected_workers) < expected:
+        await wait_for_change()
+
+def new_worker_id():
+    """An id no worker has used yet, after the ones listed in config.json"""
+    configured = [node.get('id', 0) for node in load_config()['worker_nodes']]
+    return max(configured + list(worker_status) + [0]) + 1
+
+def running_jobs():
+    return [job for job in jobs.values() if job.state == 'RUNNING']
+
+def mark_lost(worker_id, reason):
+    """Forget a dead worker, the running jobs hand its work to others"""
+    writer = connected_workers.pop(worker_id, None)
+    if writer is None:
+        return
+    print(f"[MASTER] Worker {worker_id} lost ({reason}).")
+    worker_status[worker_id] = 'LOST'
+    for job in running_jobs():
+        job.worker_lost(worker_id)
+    notify()
+    writer.close()
+
+def send_to_worker(worker_id, msg):
+    """Queue a command for a worker. False if it is gone."""
+    writer = connected_workers.get(worker_id)
+    if writer is None:
+        return False
+    if writer.is_closing():
+        mark_lost(worker_id, "connection closed")
+        return False
+    # Commands are small: the transport buffers them without waiting
+    writer.write(encode_message(msg, compressor=worker_compressors.get(worker_id)))
+    return True
+
+def check_heartbeats(timeout):
+    """Declare workers dead that have been silent for too long"""
+    now = time.monotonic()
+    for wid in list(connected_workers):
+        if now - last_seen.get(wid, now) > timeout:
+            mark_lost(wid, f"no heartbeat for {timeout}s")
+
+
+class Job:
+    """
+    One run of one or more problem modules over an input, problems =
+    [(module, args), ...]: its map tasks, reduce partitions and metrics.
+    Several modules share the scan of the input and the shuffle, and get
+    their results in a sub-directory each. Every command and report carries the job id,
+    so several jobs can share the workers without seeing each other's data.
+    """
+
+    def __init__(self, job_id, problems, input_path=None, output_dir='.', metrics_file=None,
+                 profile=False):
+        self.job_id = job_id
+        self.problems = [(module, list(args or [])) for module, args in problems]
+        self.input_path = input_path
+        # Lets a launcher size the cluster to the queued work (engine/launcher.py)
+        data_path = os.path.join(BASE_DIR, input_path or '')
+        self.input_bytes = os.path.getsize(data_path) if os.path.isfile(data_path) else None
+        self.output_dir = output_dir
+        self.metrics_file = metrics_file or os.path.join(output_dir, 'job_summary.json')
+        self.state = 'QUEUED'
+        self.error = None
+        self.submitted = time.time()
+        self.wall_s = None
+        # Resolved when the job is over, for clients waiting on it
+        self.finished = asyncio.get_running_loop().create_future()
+
+        # Workers taking part, the ones that loaded the modules, and whether
+        # every module has a combiner there
+        self.members = []
+        self.ready = set()
+        self.combiner = {}
+        self.columnar = {}
+        self.worker_phase = {}
+        # Commands sent to a worker that it has not reported back on yet
+        self.outstanding = {}
+        # Workers found dead that the job has not handled yet
+        self.lost = set()
+
+        # Map phase state
+        self.scheduler = None
+        self.idle_workers = set()
+        # Key counts sampled from each map task's output
+        self.task_samples = {}
+        # Pipelined mode: the owner that shuffled each map task
+        self.pipelined = False
+        self.shuffled_tasks = {}
+
+        # Reduce partitions: partition_owner[p - 1] is the worker that reduces partition p
+        self.partitioner = None
+        self.partition_owner = []
+        self.partitions_done = set()
+        self.partitions_requested = set()
+        # Combined values of split keys, per partition, and who reduces them at the end
+        self.split_partials = {}
+        self.split_worker = None
+        self.split_done = False
+        # Output files of each partition (and of the split keys, under
+        # 'split'), one per module
+        self.outputs = {}
+
+        self.phase_times = {}
+        # Counters reported by the workers, see engine/metrics.py
+        self.metrics = JobMetrics(progress=self.progress)
+
+        # Opt-in profiling: the workers that profile the job, their profiles,
+        # and the master's own (of the merge)
+        self.profile = profile
+        self.profiled = set()
+        self.profiles = {}
+        self.master_profile = None
+        # Marker files of the shared storage check, removed when the job ends
+        self.storage_markers = {}
+
+    def log(self, text):
+        print(f"[MASTER] [job {self.job_id}] {text}")
+
+    def describe(self):
+        return {"job_id": self.job_id, "problems": self.problems, "input_bytes": self.input_bytes,
+                "state": self.state, "error": self.error, "output_dir": self.output_dir,
+                "wall_s": self.wall_s}
+
+    def progress(self):
+        """Live view of the job for the stats endpoint"""
+        progress = {
+            "workers": {str(wid): phase for wid, phase in self.worker_phase.items()},
+            "partitions_done": len(self.partitions_done),
+            "partitions": len(self.partition_owner),
+        }
+        if self.scheduler is not None:
+            tasks = self.scheduler.tasks.values()
+            progress["map_tasks"] = len(tasks)
+            progress["map_tasks_done"] = sum(1 for t in tasks if t['state'] == 'DONE')
+            progress["backup_tasks"] = self.scheduler.backups
+        return progress
+
+    def live(self):
+        """Members of this job that are still connected"""
+        return [wid for wid in self.members if wid in connected_workers]
+
+    def send(self, worker_id, msg):
+        return send_to_worker(worker_id, dict(msg, job_id=self.job_id))
+
+    def set_phase(self, phase):
+        for wid in self.live():
+            self.worker_phase[wid] = phase
+
+    def nothing_outstanding(self):
+        return not any(self.outstanding.get(wid) for wid in self.live())
+
+    def worker_lost(self, worker_id):
+        if worker_id not in self.members:
+            return
+        self.worker_phase[worker_id] = 'LOST'
+        self.outstanding.pop(worker_id, None)
+        self.idle_workers.discard(worker_id)
+        self.lost.add(worker_id)
+
+    def handle(self, worker_id, msg):
+        """A report of one of the job's workers"""
+        if msg['type'] == 'job_ready':
+            if msg.get('error'):
+                self.error = f"Worker {worker_id} could not start {format_problems(self.problems)}: {msg['error']}"
+            self.ready.add(worker_id)
+            self.combiner[worker_id] = msg.get('combiner', False)
+            self.columnar[worker_id] = msg.get('columnar', False)
+            if msg.get('profile'):
+                self.profiled.add(worker_id)
+
+        elif msg['type'] == 'job_error':
+            self.error = f"Worker {worker_id} failed: {msg['error']}"
+
+        elif msg['type'] == 'map_done':
+            task_id = msg['task_id']
+            first = self.scheduler.complete(task_id, worker_id, time.monotonic(), msg.get('output'))
+            self.metrics.add(worker_id, 'map', msg.get('metrics'))
+            if first and msg.get('sample'):
+                self.task_samples[task_id] = msg['sample']
+            if worker_id in connected_workers:
+                self.idle_workers.add(worker_id)
+            if first:
+                self.log(f"Worker {worker_id} finished map task {task_id}.")
+            else:
+                self.log(f"Worker {worker_id} finished map task {task_id} (duplicate, discarded).")
+            if self.pipelined:
+                # The worker only shuffles an attempt that won
+                self.send(worker_id, {"type": "map_accepted" if first else "map_discarded",
+                                      "task_id": task_id})
+
+        elif msg['type'] == 'task_shuffled':
+            self.metrics.add(worker_id, 'shuffle', msg.get('metrics'))
+            for task_id in msg['tasks']:
+                # Only counts if the task is still the sender's (it may have
+                # been lost and re-mapped elsewhere meanwhile)
+                if self.scheduler.tasks[task_id]['owner'] == worker_id:
+                    self.shuffled_tasks[task_id] = worker_id
+
+        elif msg['type'] == 'shuffle_done':
+            self.log(f"Worker {worker_id} finished SHUFFLING.")
+            self.metrics.add(worker_id, 'shuffle', msg.get('metrics'))
+            self.outstanding[worker_id] -= 1
+
+        elif msg['type'] == 'recover_done':
+            self.log(f"Worker {worker_id} finished RECOVERY.")
+            self.metrics.add(worker_id, 'recovery', msg.get('metrics'))
+            self.outstanding[worker_id] -= 1
+
+        elif msg['type'] == 'reduce_done':
+            self.log(f"Worker {worker_id} finished REDUCING partitions {msg['partitions']}.")
+            self.metrics.add(worker_id, 'reduce', msg.get('metrics'))
+            self.outstanding[worker_id] -= 1
+            self.partitions_done.update(msg['partitions'])
+            self.outputs.update(zip(msg['partitions'], msg['outputs']))
+            for p in msg['partitions']:
+                self.split_partials[p] = []
+            for p, key, value in msg.get('partials', []):
+                self.split_partials[p].append((key, value))
+            self.partitions_requested.difference_update(msg['partitions'])
+
+        elif msg['type'] == 'split_done':
+            self.log(f"Worker {worker_id} finished REDUCING split keys.")
+            self.metrics.add(worker_id, 'reduce', msg.get('metrics'))
+            self.outstanding[worker_id] -= 1
+            self.outputs['split'] = msg['outputs']
+            self.split_done = True
+
+        elif msg['type'] == 'profile_done':
+            self.profiles[worker_id] = msg['profile']
+            self.outstanding[worker_id] -= 1
+
+    async def wait_until(self, done, on_lost, heartbeat_timeout):
+        """
+        Wait until done() is true. Every lost worker is passed to on_lost()
+        first, so its work goes to the healthy ones.
+        """
+        while True:
+            check_heartbeats(heartbeat_timeout)
+            while self.lost:
+                on_lost(self.lost.pop())
+            if self.error:
+                raise RuntimeError(self.error)
+            if not self.live():
+                raise RuntimeError("All workers lost, the job cannot continue")
+            if done():
+                return
+            await wait_for_change(timeout=0.5)
+
+    def dispatch_map_tasks(self):
+        """Give every idle worker its next task"""
+        for wid in list(self.idle_workers):
+            picked = self.scheduler.next_task(wid, time.monotonic())
+            if picked is None:
+                continue
+            task, is_backup = picked
+            self.idle_workers.discard(wid)
+            if is_backup:
+                self.log(f"Launching backup of map task {task['task_id']} on Worker {wid}")
+            # "output" is only set when the task's owner was lost: reuse it if readable
+            self.send(wid, {"type": "map_task", "task_id": task['task_id'],
+                            "split": task['split'], "output": task['output']})
+
+    def partition_table(self):
+        """Where each reduce partition lives, as sent to the workers"""
+        table = []
+        for wid in self.partition_owner:
+            address = worker_addresses[wid]
+            table.append({"worker_id": wid, "ip": address['ip'], "port": address['port']})
+        return table
+
+    def all_tasks_shuffled(self):
+        """Pipelined mode: every map task was pushed to the reducers by its owner"""
+        return all(task['state'] == 'DONE' and self.shuffled_tasks.get(task_id) == task['owner']
+                   for task_id, task in self.scheduler.tasks.items())
+
+    def lost_worker(self, worker_id):
+        """The lost worker's address: its peers abort their sends to it"""
+        return dict(worker_addresses[worker_id], worker_id=worker_id)
+
+    def pipeline_worker_lost(self, worker_id):
+        """
+        Pipelined map phase: the lost worker's map tasks are mapped again, and
+        its partitions move to healthy workers, which get everything shuffled
+        to them so far re-sent
+        """
+        requeued = self.scheduler.worker_lost(worker_id)
+        live = self.live()
+        if not live:
+            return
+        lost_partitions = [p for p, owner in enumerate(self.partition_owner, 1) if owner == worker_id]
+        for i, p in enumerate(lost_partitions):
+            self.partition_owner[p - 1] = live[i % len(live)]
+        self.log(f"Re-queued map tasks {requeued} of Worker {worker_id}, "
+                 f"partitions {lost_partitions} reassigned.")
+        for wid in live:
+            if self.send(wid, {
+                "type": "recover",
+                "lost": self.lost_worker(worker_id),
+                "partitions": self.partition_table(),
+                "partitioner": self.partitioner.to_spec(),
+                "tasks": [],
+                "resend": lost_partitions,
+                "targets": []
+            }):
+                self.outstanding[wid] += 1
+
+    def recover_worker(self, worker_id):
+        """
+        After the map phase: move the lost worker's map tasks and unfinished
+        reduce partitions to healthy workers.
+        """
+        live = self.live()
+        if not live:
+            return
+        lost_partitions = [p for p, owner in enumerate(self.partition_owner, 1)
+                           if owner == worker_id and p not in self.partitions_done]
+        for i, p in enumerate(lost_partitions):
+            self.partition_owner[p - 1] = live[i % len(live)]
+        self.partitions_requested.difference_update(lost_partitions)
+
+        # Its map outputs are re-shuffled (or re-mapped) by their new owners
+        adopted = {wid: [] for wid in live}
+        lost_tasks = [t for t in self.scheduler.tasks.values() if t['owner'] == worker_id]
+        for i, task in enumerate(lost_tasks):
+            new_owner = live[i % len(live)]
+            task['owner'] = new_owner
+            adopted[new_owner].append({"task_id": task['task_id'], "split": task['split'],
+                                       "output": task['output']})
+
+        self.log(f"Recovering from Worker {worker_id}: {len(lost_tasks)} map tasks moved, "
+                 f"partitions {lost_partitions} reassigned.")
+        targets = [p for p in range(1, len(self.partition_owner) + 1) if p not in self.partitions_done]
+        for wid in live:
+            if not adopted[wid] and not lost_partitions:
+                continue
+            if self.send(wid, {
+                "type": "recover",
+                "lost": self.lost_worker(worker_id),
+                "partitions": self.partition_table(),
+                "partitioner": self.partitioner.to_spec(),
+                "tasks": adopted[wid],
+                "resend": lost_partitions,
+                "targets": targets
+            }):
+                self.outstanding[wid] += 1
+
+    def request_reduces(self):
+        """Start every partition that has all of its data"""
+        if not self.nothing_outstanding():
+            return
+        by_owner = {}
+        for p, owner in enumerate(self.partition_owner, 1):
+            if p not in self.partitions_done and p not in self.partitions_requested:
+                by_owner.setdefault(owner, []).append(p)
+        for wid, parts in by_owner.items():
+            if self.send(wid, {"type": "start_reduce", "partitions": parts}):
+                self.outstanding[wid] += 1
+                self.partitions_requested.update(parts)
+
+    def request_split_reduce(self):
+        """Reduce the partials of split keys once all partitions are done"""
+        if self.split_worker in connected_workers or not self.nothing_outstanding():
+            return
+        values = {}
+        for p in sorted(self.split_partials):
+            for key, value in self.split_partials[p]:
+                values.setdefault(key, []).append(value)
+        self.split_worker = min(self.live())
+        if self.send(self.split_worker, {"type": "reduce_split", "keys": sorted(values.items())}):
+            self.outstanding[self.split_worker] += 1
+
+    def choose_partitioner(self, config, num_partitions):
+        """Hash partitioning, or a balanced assignment from the sampled key counts"""
+        if config.get('partitioner', 'hash') != 'balanced':
+            return HashPartitioner(num_partitions)
+        weights = {}
+        other = 0
+        for sample in self.task_samples.values():
+            for key, weight in sample['keys'].items():
+                weights[key] = weights.get(key, 0) + weight
+            other += sample['other']
+        # Splitting a key is only safe when partial results can be combined
+        splittable = all(self.combiner.get(wid) for wid in self.live())
+        return build_balanced(num_partitions, weights, other, splittable)
 
-def handle_worker(conn, addr):
+    async def collect_profiles(self, heartbeat_timeout):
+        """Merge the profiles of the workers (and of the master) into one report"""
+        for wid in self.live():
+            if wid in self.profiled and self.send(wid, {"type": "profile_report"}):
+                self.outstanding[wid] += 1
+        await self.wait_until(self.nothing_outstanding, lambda wid: None, heartbeat_timeout)
+
+        profile_dir = os.path.join(self.output_dir, 'profile')
+        profiles = [self.profiles[wid] for wid in sorted(self.profiles)]
+        if self.master_profile is not None:
+            profiling.write(self.master_profile.data, os.path.join(profile_dir, 'master.json'))
+            profiles.append(self.master_profile.data)
+        merged = profiling.merge(profiles)
+        profiling.write(merged, os.path.join(profile_dir, 'merged.json'))
+        with open(os.path.join(profile_dir, 'report.txt'), 'w') as f:
+            f.write(profiling.report(merged))
+        for phase, info in merged['phases'].items():
+            self.log(f"Profile {phase}: {info.get('wall_s', 0):.3f} s, "
+                     f"user functions {info.get('user_s', 0):.3f} s")
+        self.log(f"Profiles of workers {sorted(self.profiles)} merged into "
+                 f"{os.path.join(profile_dir, 'report.txt')}")
+
+    async def run(self, config, auto=False):
+        heartbeat_timeout = config.get('heartbeat_timeout', 10)
+        self.state = 'RUNNING'
+        self.members = sorted(connected_workers)
+        self.outstanding = {wid: 0 for wid in self.members}
+        job_start = time.perf_counter()
+
+        # 0. Every worker loads the job's modules (kept warm for later jobs)
+        # and checks that it sees the master's files (engine/storage.py)
+        self.log(f"Starting {format_problems(self.problems)} on workers {self.members}")
+        self.storage_markers = place_markers(
+            {"work_dir": config.get('work_dir', 'work'), "output_dir": self.output_dir}, self.job_id)
+        for wid in self.members:
+            self.send(wid, {"type": "job_start", "problems": self.problems,
+                            "output_dir": os.path.abspath(self.output_dir), "profile": self.profile,
+                            "storage": self.storage_markers})
+        await self.wait_until(lambda: self.ready.issuperset(self.live()),
+                              lambda wid: None, heartbeat_timeout)
+
+        # Apps with map_columns read a columnar copy of the CSV instead.
+        # Building one (opt-in) happens here, outside of the phase times.
+        data_path = os.path.join(BASE_DIR, self.input_path)
+        columnar_dir = None
+        if config.get('columnar', False) and all(self.columnar.get(wid) for wid in self.live()):
+            columnar_dir = await columnar_input(data_path, config)
+
+        # 1. Start Mapping
+        if not auto:
+            await asyncio.to_thread(input, "Press Enter to start MAP PHASE > ")
+        phase_start = time.perf_counter()
+        self.metrics.phase_started('map')
+
+        # Only byte offsets travel over the network, workers read the data themselves.
+        # Many small tasks are handed out on demand, so fast workers take more of them.
+        worker_ids = self.live()
+        num_tasks = max(
+            len(worker_ids) * config.get('map_tasks_per_worker', 4),
+            -(-os.path.getsize(data_path) // config.get('map_task_bytes', 64 * 1024 * 1024))
+        )
+        if columnar_dir is not None:
+            splits = columnar.compute_splits(columnar_dir, num_tasks)
+        else:
+            splits = compute_splits(data_path, num_tasks)
+
+        # Pipelined mode: the partitions are fixed up front (hash partitioning,
+        # there are no key samples yet) and the winning attempt of every map
+        # task is shuffled as soon as it is accepted, while the next one is mapped
+        pipelined = self.pipelined = config.get('pipelined', False)
+        if pipelined:
+            self.partition_owner[:] = worker_ids
+            self.partitioner = HashPartitioner(len(worker_ids))
+            for wid in worker_ids:
+                self.send(wid, {"type": "start_pipeline", "partitions": self.partition_table(),
+                                "partitioner": self.partitioner.to_spec()})
+            self.metrics.phase_started('shuffle')
+
+        def map_phase_done():
+            self.dispatch_map_tasks()
+            if not pipelined:
+                return self.scheduler.done()
+            if self.scheduler.done() and 'map' not in self.phase_times:
+                self.phase_times['map'] = time.perf_counter() - phase_start
+                self.metrics.phase_finished('map')
+            return self.all_tasks_shuffled() and self.nothing_outstanding()
+
+        def map_worker_lost(wid):
+            # Only the lost worker's own tasks are mapped again
+            requeued = self.scheduler.worker_lost(wid)
+            self.log(f"Re-queued map tasks {requeued} of Worker {wid}")
+
+        self.scheduler = TaskScheduler(
+            splits,
+            speculation=config.get('speculative_execution', True),
+            slowdown=config.get('speculation_slowdown', 1.5)
+        )
+        self.idle_workers.update(worker_ids)
+        self.set_phase('MAPPING')
+        self.log(f"{len(splits)} map tasks queued. Waiting for completion...")
+
+        # Re-check on every completion, and now and then for stragglers
+        await self.wait_until(map_phase_done,
+                              self.pipeline_worker_lost if pipelined else map_worker_lost,
+                              heartbeat_timeout)
+        self.idle_workers.clear()
+
+        if pipelined:
+            self.phase_times['shuffle'] = time.perf_counter() - phase_start
+            self.metrics.phase_finished('shuffle')
+            spec = self.partitioner.to_spec()
+            self.log(f"--- MAP PHASE COMPLETE ({self.phase_times['map'] * 1000:.1f} ms, "
+                     f"{self.scheduler.backups} backup tasks), SHUFFLE done "
+                     f"{self.phase_times['shuffle'] * 1000:.1f} ms after the start (pipelined) ---")
+        else:
+            self.phase_times['map'] = time.perf_counter() - phase_start
+            self.metrics.phase_finished('map')
+            self.log(f"--- MAP PHASE COMPLETE ({self.phase_times['map'] * 1000:.1f} ms, "
+                     f"{self.scheduler.backups} backup tasks) ---")
+
+            # 2. Start Shuffle
+            if not auto:
+                await asyncio.to_thread(input, "Press Enter to start SHUFFLE PHASE > ")
+            phase_start = time.perf_counter()
+            self.metrics.phase_started('shuffle')
+
+            # One reduce partition per worker still alive
+            self.partition_owner[:] = self.live()
+            table = self.partition_table()
+            self.partitioner = self.choose_partitioner(config, len(self.partition_owner))
+            spec = self.partitioner.to_spec()
+            if spec.get('splits'):
+                self.log(f"Splitting hot keys over partitions: {spec['splits']}")
+
+            # Each worker shuffles the outputs of the tasks it won
+            self.set_phase('SHUFFLING')
+            for wid in self.live():
+                if self.send(wid, {
+                    "type": "start_shuffle",
+                    "partitions": table,
+                    "partitioner": spec,
+                    "tasks": self.scheduler.owned_tasks(wid)
+                }):
+                    self.outstanding[wid] += 1
+
+            self.log("Shuffle started. Waiting for completion...")
+            await self.wait_until(self.nothing_outstanding, self.recover_worker, heartbeat_timeout)
+            self.phase_times['shuffle'] = time.perf_counter() - phase_start
+            self.metrics.phase_finished('shuffle')
+            self.log(f"--- SHUFFLE PHASE COMPLETE ({self.phase_times['shuffle'] * 1000:.1f} ms) ---")
+
+        # 3. Start Reduce
+        if not auto:
+            await asyncio.to_thread(input, "Press Enter to start REDUCE PHASE > ")
+        phase_start = time.perf_counter()
+        self.metrics.phase_started('reduce')
+
+        def reduce_phase_done():
+            self.request_reduces()
+            if len(self.partitions_done) < len(self.partition_owner):
+                return False
+            if not spec.get('splits') or self.split_done:
+                return True
+            self.request_split_reduce()
+            return False
+
+        self.set_phase('REDUCING')
+        await self.wait_until(reduce_phase_done, self.recover_worker, heartbeat_timeout)
+        self.phase_times['reduce'] = time.perf_counter() - phase_start
+        self.metrics.phase_finished('reduce')
+        self.log(f"--- REDUCE PHASE COMPLETE ({self.phase_times['reduce'] * 1000:.1f} ms) ---")
+
+        # 4. Merge the sorted partition outputs into one file per module
+        phase_start = time.perf_counter()
+        self.metrics.phase_started('merge')
+        if self.profile:
+            self.master_profile = profiling.Profile(
+                interval=config.get('profile_interval_s', profiling.DEFAULT_INTERVAL))
+        merged_files = []
+        count = 0
+        for index, label in enumerate(output_labels(self.problems)):
+            paths = [self.outputs[p][index] for p in range(1, len(self.partition_owner) + 1)]
+            if 'split' in self.outputs:
+                paths.append(self.outputs['split'][index])
+            os.makedirs(os.path.join(self.output_dir, label), exist_ok=True)
+            merged = os.path.normpath(os.path.join(self.output_dir, label, 'reduce_results.jsonl'))
+            if self.master_profile is not None:
+                results = await asyncio.to_thread(self.master_profile.run, 'merge',
+                                                  merge_results, paths, merged)
+            else:
+                results = await asyncio.to_thread(merge_results, paths, merged)
+            self.metrics.add('master', 'merge', {"files_in": len(paths), "records_out": results,
+                                                 "output_bytes": os.path.getsize(merged)})
+            merged_files.append(merged)
+            count += results
+        self.phase_times['merge'] = time.perf_counter() - phase_start
+        self.metrics.phase_finished('merge')
+        self.log(f"--- MERGE COMPLETE ({self.phase_times['merge'] * 1000:.1f} ms, {count} results) ---")
+
+        # 5. Profiles, when the job or a worker asked for them
+        if self.profile or self.profiled:
+            await self.collect_profiles(heartbeat_timeout)
+
+        self.wall_s = time.perf_counter() - job_start
+        self.log("--- JOB COMPLETE ---")
+        self.log("Phase times: " + ", ".join(
+            f"{name} {seconds * 1000:.1f} ms" for name, seconds in self.phase_times.items()))
+        self.log(f"Wall-clock time: {self.wall_s * 1000:.1f} ms")
+        self.log(f"Results (sorted by key) in {', '.join(merged_files)}")
+        self.set_phase('DONE')
+        self.state = 'DONE'
+
+    def end(self):
+        """Let the workers drop the job's state and write the job summary"""
+        for wid in self.live():
+            self.send(wid, {"type": "job_end"})
+        remove_markers(self.storage_markers)
+        self.metrics.current_phase = self.state.lower()
+        os.makedirs(os.path.dirname(os.path.abspath(self.metrics_file)), exist_ok=True)
+        self.metrics.write(self.metrics_file)
+        self.log(f"Job summary written to {self.metrics_file}")
+        if not self.finished.done():
+            self.finished.set_result(self.describe())
+        notify()
+
+async def run_job(job, config, auto=True):
+    """Run one job to the end. Failures are recorded on the job, not raised."""
+    try:
+        await job.run(config, auto)
+    except RuntimeError as e:
+        job.state = 'FAILED'
+        job.error = str(e)
+        job.log(f"--- JOB FAILED: {e} ---")
+    finally:
+        job.end()
+
+def submit_job(config, problems, input_path=None, output_dir=None, profile=False):
+    """Queue a job of problems = [(module, args), ...] for the warm cluster. Returns the Job."""
+    job_id = next(job_ids)
+    if output_dir is None:
+        output_dir = os.path.join(config.get('results_dir', 'results'), f"job_{job_id}")
+    job = Job(job_id, problems,
+              input_path=input_path or config.get('input_path', os.path.join('data', 'dataset.csv')),
+              output_dir=output_dir,
+              profile=profile or profile_jobs or config.get('profile', False))
+    jobs[job_id] = job
+    job_queue.append(job)
+    job.log(f"Queued {format_problems(job.problems)}")
+    notify()
+    return job
+
+async def handle_client(msg, writer):
+    """Job submission API: submit, list jobs, shut the master down"""
+    global shutdown_requested
+    config = load_config()
+    if msg['type'] == 'submit':
+        job = submit_job(config, msg['problems'], msg.get('input_path'), msg.get('output_dir'),
+                         msg.get('profile', False))
+        await write_message(writer, {"type": "job_submitted", "job_id": job.job_id})
+        if msg.get('wait'):
+            result = await asyncio.shield(job.finished)
+            await write_message(writer, dict(result, type="job_finished"))
+
+    elif msg['type'] == 'jobs':
+        await write_message(writer, {
+            "type": "jobs",
+            "workers": {str(wid): status for wid, status in worker_status.items()},
+            "pids": {str(wid): pid for wid, pid in worker_pids.items()},
+            "jobs": [job.describe() for job in jobs.values()]
+        })
+
+    elif msg['type'] == 'shutdown':
+        # Jobs already submitted still run
+        shutdown_requested = True
+        notify()
+        await write_message(writer, {"type": "shutdown_ack", "pending": len(job_queue)})
+
+async def handle_worker(reader, writer):
     worker_id = None
+    connection_tasks.add(asyncio.current_task())
     try:
         while True:
-            msg_bytes = conn.recv(4096)
-            if not msg_bytes: break
-            msg = json.loads(msg_bytes.decode('utf-8'))
-            
+            msg = await read_message(reader)
+            if msg is None: break
+            if worker_id is not None:
+                last_seen[worker_id] = time.monotonic()
+
             if msg['type'] == 'register':
-                worker_id = msg['worker_id']
-                with lock:
-                    connected_workers[worker_id] = conn
-                    worker_status[worker_id] = 'IDLE'
-                print(f"[MASTER] Worker {worker_id} registered.")
-                
-            elif msg['type'] == 'map_done':
-                print(f"[MASTER] Worker {worker_id} finished MAPPING.")
-                with lock: worker_status[worker_id] = 'MAP_DONE'
-                
-            elif msg['type'] == 'shuffle_done':
-                print(f"[MASTER] Worker {worker_id} finished SHUFFLING.")
-                with lock: worker_status[worker_id] = 'SHUFFLE_DONE'
-
-            elif msg['type'] == 'reduce_done':
-                print(f"[MASTER] Worker {worker_id} finished REDUCING.")
-                with lock: worker_status[worker_id] = 'REDUCE_DONE'
-                
+                # Workers may join at any time, with the address they listen on;
+                # one without an id (or with an id in use) gets a free one
+                worker_id = msg.get('worker_id')
+                if worker_id is None or worker_id in connected_workers:
+                    worker_id = new_worker_id()
+                connected_workers[worker_id] = writer
+                worker_addresses[worker_id] = msg['address']
+                worker_pids[worker_id] = msg.get('pid')
+                worker_problem[worker_id] = msg.get('problems')
+                worker_compressors[worker_id] = negotiate(load_config(), msg.get('codecs'))
+                worker_status[worker_id] = 'IDLE'
+                last_seen[worker_id] = time.monotonic()
+                send_to_worker(worker_id, {"type": "welcome", "codecs": available_codecs(),
+                                           "worker_id": worker_id})
+                notify()
+                print(f"[MASTER] Worker {worker_id} registered at "
+                      f"{msg['address']['ip']}:{msg['address']['port']}.")
+
+            elif msg['type'] == 'heartbeat':
+                pass
+
+            elif msg['type'] in ('submit', 'jobs', 'shutdown'):
+                await handle_client(msg, writer)
+
+            else:
+                # Reports of a job that is over are dropped
+                job = jobs.get(msg.get('job_id'))
+                if job is not None and job.state == 'RUNNING':
+                    job.handle(worker_id, msg)
+                    notify()
+
     except Exception as e:
-        print(f"[MASTER] Worker {worker_id} disconnected.")
+        print(f"[MASTER] Worker {worker_id} disconnected: {e!r}")
     finally:
-        conn.close()
+        if worker_id is not None and connected_workers.get(worker_id) is writer:
+            mark_lost(worker_id, "connection closed")
+        writer.close()
+        connection_tasks.discard(asyncio.current_task())
+
+def stats_summary():
+    """Live view of the cluster and of every job, for the stats endpoint"""
+    control = {}
+    for compressor in worker_compressors.values():
+        if compressor is not None:
+            add_counters(control, compressor.counters())
+    return {
+        "workers": {str(wid): status for wid, status in worker_status.items()},
+        "control_compression": control,
+        "queued": [job.job_id for job in job_queue],
+        "jobs": {str(job_id): dict(job.describe(), **job.metrics.summary())
+                 for job_id, job in jobs.items()},
+    }
 
-def orchestrate_job():
+async def orchestrate_job(auto=False):
+    """One job with the modules the workers were started with, then exit"""
     config = load_config()
-    total_workers = len(config['worker_nodes'])
-    
-    # 1. Start Mapping
-    input("Press Enter to start MAP PHASE > ")
-    
-    base_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    data_path = os.path.join(base_dir, 'data', 'dataset.csv')
-    with open(data_path, 'r', encoding='utf-8') as f:
-        lines = f.readlines()[1:]
-        
-    worker_ids = list(connected_workers.keys())
-    chunks = {wid: [] for wid in worker_ids}
-    for i, line in enumerate(lines):
-        chunks[worker_ids[i % len(worker_ids)]].append(line)
-        
-    for wid, chunk in chunks.items():
-        msg = json.dumps({"type": "map_task", "data": chunk})
-        connected_workers[wid].sendall(msg.encode('utf-8'))
-        with lock: worker_status[wid] = 'MAPPING'
-        
-    print("[MASTER] Map tasks sent. Waiting for completion...")
-    
-    # Wait for Map Done
-    while True:
-        with lock:
-            if all(s == 'MAP_DONE' for s in worker_status.values()) and len(worker_status) == len(worker_ids):
-                break
-        time.sleep(1)
-    print("[MASTER] --- MAP PHASE COMPLETE ---")
-    
-    # 2. Start Shuffle
-    input("Press Enter to start SHUFFLE PHASE > ")
-    all_workers_list = config['worker_nodes']
-    shuffle_msg = json.dumps({"type": "start_shuffle", "workers": all_workers_list})
-    
-    for conn in connected_workers.values():
-        conn.sendall(shuffle_msg.encode('utf-8'))
-        
-    print("[MASTER] Shuffle started. Waiting for completion...")
-    
-    while True:
-        with lock:
-            if all(s == 'SHUFFLE_DONE' for s in worker_status.values()):
-                break
-        time.sleep(1)
-    print("[MASTER] --- SHUFFLE PHASE COMPLETE ---")
-    
-    # 3. Start Reduce
-    input("Press Enter to start REDUCE PHASE > ")
-    
-    reduce_msg = json.dumps({"type": "start_reduce"})
-    for conn in connected_workers.values():
-        conn.sendall(reduce_msg.encode('utf-8'))
-        
-    while True:
-        with lock:
-            if all(s == 'REDUCE_DONE' for s in worker_status.values()):
-                break
-        time.sleep(1)
-    print("[MASTER] --- JOB COMPLETE ---")
-    print("Check reduce_results_X.json files for output!")
-
-def start_master():
+    expected = config.get('expected_workers', len(config['worker_nodes']))
+
+    print(f"[MASTER] Waiting for {expected} workers to register...")
+    await wait_for_workers(expected)
+
+    problems = worker_problem[min(connected_workers)]
+    if len(set(format_problems(p) for p in worker_problem.values())) > 1:
+        print(f"[MASTER] Workers were started with different modules, running {format_problems(problems)}")
+    job = Job(next(job_ids), problems,
+              input_path=config.get('input_path', os.path.join('data', 'dataset.csv')),
+              metrics_file=config.get('metrics_file', 'job_summary.json'),
+              profile=profile_jobs or config.get('profile', False))
+    jobs[job.job_id] = job
+    await run_job(job, config, auto)
+    if job.state == 'FAILED':
+        raise RuntimeError(job.error)
+
+def enough_workers(job, config):
+    """
+    A queued job waits up to scale_up_wait_s for the workers its input
+    size calls for, so a launcher (engine/launcher.py) can start them
+    """
+    wait = config.get('scale_up_wait_s', 0)
+    if not wait or time.time() - job.submitted > wait:
+        return True
+    return len(connected_workers) >= workers_for(job.input_bytes, config)
+
+async def serve_jobs():
+    """Run submitted jobs on the warm workers until a client asks to shut down"""
+    config = load_config()
+    expected = config.get('expected_workers', len(config['worker_nodes']))
+    heartbeat_timeout = config.get('heartbeat_timeout', 10)
+    # Jobs run back to back by default, or this many interleaved on the workers
+    concurrency = config.get('job_concurrency', 1)
+    running = set()
+
+    print(f"[MASTER] Waiting for {expected} workers to register...")
+    await wait_for_workers(expected)
+    print("[MASTER] Cluster ready, waiting for jobs (python engine/submit.py <module> [--flags] [+ <module> ...])")
+
+    while not (shutdown_requested and not job_queue and not running):
+        check_heartbeats(heartbeat_timeout)
+        while job_queue and len(running) < concurrency and connected_workers \
+                and enough_workers(job_queue[0], config):
+            job = job_queue.pop(0)
+            task = asyncio.create_task(run_job(job, config))
+            running.add(task)
+            task.add_done_callback(running.discard)
+        await wait_for_change(timeout=0.5)
+    print("[MASTER] All jobs done, shutting down.")
+
+async def run_master(auto=False, serve=False):
     config = load_config()
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((config['master_node']['ip'], config['master_node']['port']))
-    server.listen()
-    
-    threading.Thread(target=orchestrate_job).start()
-    
+    # One event loop serves every worker connection, no thread per worker
+    server = await asyncio.start_server(
+        handle_worker, config['master_node']['ip'], config['master_node']['port'],
+        backlog=config.get('listen_backlog', 1024), reuse_address=True
+    )
+
     print(f"[MASTER] Listening on {config['master_node']['port']}...")
-    while True:
-        conn, addr = server.accept()
-        threading.Thread(target=handle_worker, args=(conn, addr)).start()
+    if config.get('stats_port'):
+        stats_server = await serve_stats(stats_summary, config['master_node']['ip'], config['stats_port'])
+        print(f"[MASTER] Live stats on http://{config['master_node']['ip']}:{config['stats_port']}/stats")
+
+    # The master exits once its jobs are done, which also releases the workers
+    try:
+        if serve:
+            await serve_jobs()
+        else:
+            await orchestrate_job(auto)
+    finally:
+        server.close()
+        if config.get('stats_port'):
+            stats_server.close()
+        writers = list(connected_workers.values())
+        connected_workers.clear()
+        for writer in writers:
+            writer.close()
+        # Let the connection handlers see the close and return
+        if connection_tasks:
+            await asyncio.wait(list(connection_tasks), timeout=1)
+
+def start_master(auto=False, serve=False, profile=False):
+    global profile_jobs
+    profile_jobs = profile
+    asyncio.run(run_master(auto, serve))
 
 if __name__ == "__main__":
-    start_master()
\ No newline at end of file
+    # Usage: python master.py [--auto | --serve] [--profile]
+    #   --auto   no prompts: start as soon as all workers registered and
+    #            move to the next phase the moment the last worker reports
+    #   --serve  keep the workers warm and run the jobs submitted with
+    #            engine/submit.py until it sends --shutdown
+    #   --profile  profile every job: user functions vs engine time, merged
+    #              from all workers into <output_dir>/profile/report.txt
+    # The input, work_dir and results_dir of conf/config.json must be the same
+    # files on every node (one machine or a shared filesystem): each job
+    # checks it first, see engine/storage.py
+    start_master(auto="--auto" in sys.argv[1:], serve="--serve" in sys.argv[1:],
+                 profile="--profile" in sys.argv[1:])
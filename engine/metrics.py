@@ -0,0 +1,101 @@
+"""
+Job metrics.
+
+Workers measure every command they run (records in/out, bytes read and
+shuffled, spills, wall and CPU time) and attach the counters to the
+matching *_done message. The master adds them up per phase and per
+worker in one JobMetrics per job, writes the result as a job summary JSON
+at the end of the job and serves all jobs live over a tiny HTTP endpoint:
+
+    curl http://127.0.0.1:<stats_port>/stats
+
+CPU time is the worker's process CPU time, so it does not include map
+processes of a local process pool.
+"""
+
+import asyncio
+import json
+import time
+
+
+def start_timer():
+    return time.perf_counter(), time.process_time()
+
+
+def elapsed(timer):
+    """Wall and CPU seconds since start_timer()"""
+    wall, cpu = timer
+    return {"wall_s": time.perf_counter() - wall, "cpu_s": time.process_time() - cpu}
+
+
+def add_counters(total, counters):
+    """Add counters into `total`; nested dicts (e.g. bytes per peer) are added per key"""
+    for name, value in counters.items():
+        if isinstance(value, dict):
+            add_counters(total.setdefault(name, {}), value)
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            total[name] = total.get(name, 0) + value
+
+
+class JobMetrics:
+    def __init__(self, progress=None):
+        self.started = time.time()
+        self.phases = {}
+        self.workers = {}
+        self.current_phase = None
+        # Called for a live view of the job (tasks done, worker states, ...)
+        self.progress = progress
+
+    def phase_started(self, phase):
+        self.current_phase = phase
+        self.phases[phase] = {"started": time.time(), "wall_s": None, "totals": {}}
+
+    def phase_finished(self, phase):
+        info = self.phases[phase]
+        info["wall_s"] = time.time() - info["started"]
+
+    def add(self, worker_id, phase, counters):
+        """Counters reported by a worker for one command of `phase`"""
+        if not counters:
+            return
+        counters = dict(counters, commands=1)
+        add_counters(self.phases.setdefault(phase, {"totals": {}})["totals"], counters)
+        add_counters(self.workers.setdefault(str(worker_id), {}).setdefault(phase, {}), counters)
+
+    def summary(self):
+        for info in self.phases.values():
+            totals = info["totals"]
+            # Bytes on the wire per byte of records, after compression
+            if totals.get("bytes_sent_raw"):
+                totals["compression_ratio"] = totals.get("bytes_sent", 0) / totals["bytes_sent_raw"]
+        return {
+            "elapsed_s": time.time() - self.started,
+            "current_phase": self.current_phase,
+            "progress": self.progress() if self.progress else {},
+            "phases": self.phases,
+            "workers": self.workers,
+        }
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.summary(), f, indent=2)
+
+
+async def serve_stats(summary, host, port):
+    """Serve summary() as JSON to any HTTP GET on host:port"""
+
+    async def handle(reader, writer):
+        try:
+            # Only the request line matters; skip the headers
+            while (await reader.readline()) not in (b'\r\n', b'\n', b''):
+                pass
+            body = json.dumps(summary(), indent=2).encode('utf-8')
+            writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: application/json\r\n"
+                         b"Content-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+            await writer.drain()
+        except OSError:
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port, reuse_address=True)
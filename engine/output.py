@@ -0,0 +1,75 @@
+"""
+Reduce output files.
+
+Reducers stream their results to disk one line at a time, as JSON lines
+of {"key": ..., "value": ...} in key order (the order the sorted runs are
+merged in). A file only appears under its final name once it is
+complete, so a reducer that dies half way never leaves a truncated
+output behind.
+
+After the reduce phase the master merges the per-partition files into
+one key-sorted file with a streaming k-way merge: only one line per
+input file is in memory at a time. A job running several problem modules
+over one scan keeps the results of each module in its own sub-directory.
+"""
+
+import heapq
+import json
+import os
+
+
+class ResultWriter:
+    """Writes the (key, value) results of one reducer as JSON lines"""
+
+    def __init__(self, path):
+        self.path = path
+        self.tmp_path = f"{path}.tmp"
+        self.f = open(self.tmp_path, 'w')
+        self.count = 0
+
+    def write(self, key, value):
+        self.f.write(json.dumps({"key": key, "value": value}))
+        self.f.write('\n')
+        self.count += 1
+
+    def close(self):
+        self.f.close()
+        os.replace(self.tmp_path, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            self.f.close()
+            os.remove(self.tmp_path)
+
+
+def output_labels(problems):
+    """Results sub-directory of each (module, args) of a job, '' when there is only one"""
+    if len(problems) == 1:
+        return ['']
+    names = [name for name, _ in problems]
+    return [name if names.count(name) == 1 else f"{name}_{i}" for i, name in enumerate(names)]
+
+
+def read_results(path):
+    """Yield (key, raw line) from a result file"""
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)['key'], line
+
+
+def merge_results(paths, dest):
+    """K-way merge of key-sorted result files into `dest`. Returns the number of results."""
+    count = 0
+    tmp_path = f"{dest}.tmp"
+    with open(tmp_path, 'w') as out:
+        for _, line in heapq.merge(*(read_results(p) for p in paths), key=lambda item: item[0]):
+            out.write(line if line.endswith('\n') else line + '\n')
+            count += 1
+    os.replace(tmp_path, dest)
+    return count
@@ -0,0 +1,116 @@
+"""
+Reduce partitioners.
+
+A partitioner maps a key to a reduce partition (numbered from 1). It is
+built by the master and sent to the workers as a small JSON spec, so
+every sender agrees on where a key goes.
+
+- "hash":     crc32 of the key modulo the number of partitions. Stable
+              across processes (unlike hash()) and much cheaper than md5.
+- "balanced": built from key counts the workers take while mapping
+              (before the combiner, which leaves about one record per key).
+              Keys are placed heaviest first on the least loaded partition;
+              unsampled keys fall back to the hash. When the app has a
+              combine_function, a key heavier than a fair share is split
+              over several partitions; each of them combines its part and
+              the partials are reduced once more at the end of the job.
+"""
+
+import math
+import zlib
+from collections import Counter
+
+
+def stable_hash(key):
+    return zlib.crc32(key.encode('utf-8'))
+
+
+class HashPartitioner:
+    name = "hash"
+
+    def __init__(self, num_partitions):
+        self.num_partitions = num_partitions
+
+    def partition(self, key, salt=0):
+        """Partition of `key`; `salt` picks among the parts of a split key"""
+        return stable_hash(key) % self.num_partitions + 1
+
+    def is_split(self, key):
+        return False
+
+    def to_spec(self):
+        return {"type": self.name, "num_partitions": self.num_partitions}
+
+
+class BalancedPartitioner(HashPartitioner):
+    name = "balanced"
+
+    def __init__(self, num_partitions, assignment=None, splits=None):
+        super().__init__(num_partitions)
+        self.assignment = assignment or {}
+        self.splits = splits or {}
+
+    def partition(self, key, salt=0):
+        p = self.assignment.get(key)
+        if p is not None:
+            return p
+        parts = self.splits.get(key)
+        if parts is not None:
+            return parts[salt % len(parts)]
+        return stable_hash(key) % self.num_partitions + 1
+
+    def is_split(self, key):
+        return key in self.splits
+
+    def to_spec(self):
+        return {"type": self.name, "num_partitions": self.num_partitions,
+                "assignment": self.assignment, "splits": self.splits}
+
+
+PARTITIONERS = {cls.name: cls for cls in (HashPartitioner, BalancedPartitioner)}
+
+
+def from_spec(spec):
+    """Rebuild a partitioner from the spec the master sent"""
+    args = {k: v for k, v in spec.items() if k != "type"}
+    return PARTITIONERS[spec["type"]](**args)
+
+
+def sample_keys(pairs, sample_size=1000, max_keys=1000, counts=None):
+    """
+    Estimate how many records each key has in `pairs` from at most about
+    `sample_size` of them. Returns ({key: weight} for the heaviest
+    `max_keys` keys, total weight of all other keys).
+
+    `counts` are exact record counts per key from before a combiner ran;
+    they are used instead when given, since combined pairs hide the skew.
+    """
+    if counts is not None:
+        top = Counter(counts).most_common(max_keys)
+        return dict(top), sum(counts.values()) - sum(n for _, n in top)
+    stride = max(1, len(pairs) // sample_size)
+    counts = Counter(key for key, _ in pairs[::stride])
+    top = counts.most_common(max_keys)
+    other = sum(counts.values()) - sum(n for _, n in top)
+    return {key: n * stride for key, n in top}, other * stride
+
+
+def build_balanced(num_partitions, weights, other_weight=0, splittable=False):
+    """Greedy (heaviest key first) assignment of sampled keys to partitions"""
+    # Unsampled keys are hashed, so they spread about evenly
+    loads = [other_weight / num_partitions] * num_partitions
+    share = (sum(weights.values()) + other_weight) / num_partitions
+    assignment = {}
+    splits = {}
+    for key, weight in sorted(weights.items(), key=lambda kv: (-kv[1], kv[0])):
+        pieces = 1
+        if splittable and share and weight > share:
+            pieces = min(num_partitions, math.ceil(weight / share))
+        targets = sorted(range(num_partitions), key=lambda i: (loads[i], i))[:pieces]
+        for i in targets:
+            loads[i] += weight / pieces
+        if pieces == 1:
+            assignment[key] = targets[0] + 1
+        else:
+            splits[key] = [i + 1 for i in targets]
+    return BalancedPartitioner(num_partitions, assignment, splits)
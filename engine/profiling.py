@@ -0,0 +1,276 @@
+"""
+Opt-in profiling of jobs (master.py --profile, worker.py --profile or
+config "profile": true).
+
+A profiled job records, per phase of every command it runs:
+
+- the time of each call of the problem modules' functions (map_function,
+  map_batch, map_columns, combine_function, reduce_function), as a
+  histogram of power-of-two buckets per function. The rest of a command's
+  time is engine overhead: reading the input, records, partitioning,
+  spills, JSON output, ...
+- stack samples: a thread looks at the stacks of the threads running
+  profiled commands every profile_interval_s seconds and counts the
+  functions on them (self: top of the stack, cumulative: anywhere on it).
+  A sample with a frame of a problem module on the stack is user time.
+- engine sections the samples cannot see, such as the wait for the peers
+  while a shuffle is sent (socket I/O, on the event loop).
+
+reduce_function is timed with the iteration over its values, so the time
+of merging the sorted runs counts as user time there.
+
+A profile is a nested dict of numbers, so the profiles of commands, map
+processes and workers are merged by adding them up (add_counters). Each
+worker writes its own profile next to the job's results and sends it to
+the master, which merges them into one report. When profiling is off,
+nothing is wrapped and no sampling thread runs.
+"""
+
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+from engine.metrics import add_counters
+
+DEFAULT_INTERVAL = 0.005
+
+_local = threading.local()
+_sampler = None
+_sampler_lock = threading.Lock()
+
+
+def new_profile():
+    return {"phases": {}, "user": {}, "engine": {}, "self": {}, "cumulative": {}}
+
+
+def add_call(histogram, seconds):
+    """One call into a {calls, total_s, buckets} histogram; bucket k holds calls under 2**k us"""
+    histogram["calls"] = histogram.get("calls", 0) + 1
+    histogram["total_s"] = histogram.get("total_s", 0) + seconds
+    bucket = str(int(seconds * 1e6).bit_length())
+    buckets = histogram.setdefault("buckets", {})
+    buckets[bucket] = buckets.get(bucket, 0) + 1
+
+
+def percentile(histogram, fraction):
+    """Upper bound (in seconds) of the bucket holding the given fraction of the calls"""
+    seen = 0
+    for bucket, count in sorted(histogram.get("buckets", {}).items(), key=lambda item: int(item[0])):
+        seen += count
+        if seen >= fraction * histogram["calls"]:
+            return (1 << int(bucket)) / 1e6
+    return None
+
+
+def stack_depth(frame):
+    depth = 0
+    while frame is not None:
+        depth += 1
+        frame = frame.f_back
+    return depth
+
+
+def frame_label(code):
+    return f"{os.path.basename(code.co_filename)}:{code.co_firstlineno}({code.co_name})"
+
+
+class Recorder:
+    """Timings and stack samples of one command, on the thread that runs it"""
+
+    def __init__(self, phase, user_files=()):
+        self.phase = phase
+        self.user_files = set(user_files)
+        self.data = new_profile()
+        self.info = self.data["phases"][phase] = {"commands": 1, "wall_s": 0.0, "user_s": 0.0,
+                                                  "samples": 0, "user_samples": 0}
+        self.user = self.data["user"][phase] = {}
+        self.self_samples = self.data["self"][phase] = {}
+        self.cumulative = self.data["cumulative"][phase] = {}
+        self.wrappers = {}
+        # Frames of the code that started the recording (thread bootstrap,
+        # executor, ...) are left out of the samples
+        self.base_depth = 0
+
+    def timed(self, name, function):
+        """`function`, with every call timed into the histogram of `name`"""
+        wrapper = self.wrappers.get(name)
+        if wrapper is None:
+            histogram = self.user.setdefault(name, {})
+
+            def wrapper(*args):
+                start = time.perf_counter()
+                try:
+                    return function(*args)
+                finally:
+                    add_call(histogram, time.perf_counter() - start)
+            self.wrappers[name] = wrapper
+        return wrapper
+
+    def sample(self, frame):
+        """Count the functions on a stack (called from the sampling thread)"""
+        self.info["samples"] += 1
+        seen = set()
+        user = False
+        top = True
+        for _ in range(stack_depth(frame) - self.base_depth):
+            code = frame.f_code
+            label = frame_label(code)
+            if top:
+                self.self_samples[label] = self.self_samples.get(label, 0) + 1
+                top = False
+            if label not in seen:
+                seen.add(label)
+                self.cumulative[label] = self.cumulative.get(label, 0) + 1
+            user = user or code.co_filename in self.user_files
+            frame = frame.f_back
+        if user:
+            self.info["user_samples"] += 1
+
+    def finish(self, wall_s):
+        self.info["wall_s"] = wall_s
+        self.info["user_s"] = sum(h.get("total_s", 0) for h in self.user.values())
+
+
+class Sampler:
+    """Samples the stacks of the threads with a Recorder; stops when there are none"""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.active = {}
+        self.thread = None
+
+    def add(self, ident, recorder):
+        with self.lock:
+            self.active[ident] = recorder
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="profile-sampler", daemon=True)
+                self.thread.start()
+
+    def remove(self, ident):
+        with self.lock:
+            self.active.pop(ident, None)
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self.lock:
+                if not self.active:
+                    self.thread = None
+                    return
+                for ident, recorder in self.active.items():
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        recorder.sample(frame)
+            del frames
+
+
+def current():
+    """The Recorder of the command running on this thread, None when it is not profiled"""
+    return getattr(_local, 'recorder', None)
+
+
+@contextlib.contextmanager
+def recording(phase, user_files=(), interval=DEFAULT_INTERVAL):
+    """Profile what this thread runs in the block, under `phase`"""
+    global _sampler
+    with _sampler_lock:
+        if _sampler is None:
+            _sampler = Sampler(interval)
+    recorder = Recorder(phase, user_files)
+    # The frame of the with statement, under contextlib's __enter__
+    recorder.base_depth = stack_depth(sys._getframe(2))
+    ident = threading.get_ident()
+    _local.recorder = recorder
+    _sampler.add(ident, recorder)
+    start = time.perf_counter()
+    try:
+        yield recorder
+    finally:
+        _sampler.remove(ident)
+        _local.recorder = None
+        recorder.finish(time.perf_counter() - start)
+
+
+class Profile:
+    """The merged profile of one job on one process"""
+
+    def __init__(self, user_files=(), interval=DEFAULT_INTERVAL):
+        self.user_files = list(user_files)
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.data = new_profile()
+
+    def run(self, phase, function, *args):
+        """function(*args), profiled under `phase`"""
+        with recording(phase, self.user_files, self.interval) as recorder:
+            result = function(*args)
+        # Added once the block is over, with its wall time
+        self.add(recorder.data)
+        return result
+
+    def add(self, data):
+        with self.lock:
+            add_counters(self.data, data)
+
+    def add_section(self, phase, name, seconds):
+        """Engine time the stack samples do not see, e.g. waiting on sockets"""
+        with self.lock:
+            add_call(self.data["engine"].setdefault(phase, {}).setdefault(name, {}), seconds)
+            info = self.data["phases"].setdefault(phase, {})
+            info["wall_s"] = info.get("wall_s", 0) + seconds
+
+
+def merge(profiles):
+    """One profile out of several (of workers, map processes, ...)"""
+    total = new_profile()
+    for data in profiles:
+        add_counters(total, data)
+    return total
+
+
+def write(data, path):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def report(data, top=15):
+    """Text report of a profile: per phase user vs engine time, the user
+    function histograms and the functions that were sampled the most"""
+    lines = []
+    for phase, info in data["phases"].items():
+        wall = info.get("wall_s", 0)
+        user = info.get("user_s", 0)
+        samples = info.get("samples", 0)
+        lines.append(f"== {phase}: {wall:.3f} s profiled over {info.get('commands', 0)} commands, "
+                     f"user functions {user:.3f} s, engine {max(wall - user, 0):.3f} s")
+        if samples:
+            lines.append(f"   {samples} stack samples, {info.get('user_samples', 0) / samples:.0%} "
+                         f"in user code")
+        for kind in ("user", "engine"):
+            for name, histogram in sorted(data[kind].get(phase, {}).items(),
+                                          key=lambda item: -item[1].get("total_s", 0)):
+                calls = histogram.get("calls", 0)
+                if not calls:
+                    continue
+                lines.append(f"   {kind:6} {name}: {calls} calls, {histogram['total_s']:.3f} s, "
+                             f"mean {histogram['total_s'] / calls * 1e6:.1f} us, "
+                             f"p50 < {percentile(histogram, 0.5) * 1e6:.0f} us, "
+                             f"p99 < {percentile(histogram, 0.99) * 1e6:.0f} us")
+                lines.append("          " + "  ".join(
+                    f"<{1 << int(bucket)}us:{count}" for bucket, count in
+                    sorted(histogram.get("buckets", {}).items(), key=lambda item: int(item[0]))))
+        for kind, title in (("self", "self"), ("cumulative", "cumulative")):
+            counts = data[kind].get(phase, {})
+            if not counts:
+                continue
+            lines.append(f"   top {title} samples:")
+            for label, count in sorted(counts.items(), key=lambda item: -item[1])[:top]:
+                lines.append(f"     {count / samples:6.1%}  {label}")
+        lines.append("")
+    return "\n".join(lines)
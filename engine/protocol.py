@@ -0,0 +1,129 @@
+"""
+Length-prefixed message framing shared by the master and the workers.
+
+Every frame on a socket looks like this:
+
+    +----------------+--------+---------------------+
+    | length (4B BE) | kind   | payload (length B)  |
+    +----------------+--------+---------------------+
+
+kind = KIND_JSON  -> payload is a UTF-8 JSON object (control messages)
+kind = KIND_BLOB  -> payload is a JSON header followed by raw bytes:
+                     [header length (4B BE)][JSON header][blob]
+
+With the FLAG_COMPRESSED bit set in `kind`, the payload above is
+compressed and prefixed with the codec id (see engine/compression.py).
+
+Because the receiver always knows how many bytes belong to the current
+frame, a multi-MB message is read in one pass and two messages that arrive
+in the same TCP segment are never merged.
+
+The same frames are used by the blocking socket helpers and by the
+asyncio stream helpers (read_message / write_message).
+"""
+
+import asyncio
+import json
+import struct
+
+from engine.compression import decompress
+
+HEADER = struct.Struct('!IB')
+BLOB_HEADER = struct.Struct('!I')
+
+KIND_JSON = 0
+KIND_BLOB = 1
+FLAG_COMPRESSED = 0x80
+
+MAX_FRAME_SIZE = 1 << 31
+
+
+class ConnectionClosed(Exception):
+    """Raised when the peer closes the socket in the middle of a frame"""
+
+
+def encode_message(msg, blob=None, compressor=None):
+    """Build the bytes of one frame for a JSON message (+ optional blob)"""
+    body = json.dumps(msg).encode('utf-8')
+    if blob is None:
+        kind, payload = KIND_JSON, body
+    else:
+        kind, payload = KIND_BLOB, b''.join((BLOB_HEADER.pack(len(body)), body, blob))
+    if compressor is not None:
+        compressed = compressor.compress(payload)
+        if compressed is not None:
+            kind, payload = kind | FLAG_COMPRESSED, compressed
+    return HEADER.pack(len(payload), kind) + payload
+
+
+def decode_payload(kind, payload):
+    """Turn a frame payload back into a message dict"""
+    if kind & FLAG_COMPRESSED:
+        kind, payload = kind & ~FLAG_COMPRESSED, decompress(payload)
+    if kind == KIND_JSON:
+        return json.loads(payload)
+    if kind == KIND_BLOB:
+        (json_len,) = BLOB_HEADER.unpack_from(payload, 0)
+        start = BLOB_HEADER.size
+        msg = json.loads(payload[start:start + json_len])
+        msg['blob'] = bytes(payload[start + json_len:])
+        return msg
+    raise ValueError(f"Unknown frame kind: {kind}")
+
+
+def recv_exact(sock, size):
+    """Read exactly `size` bytes from a blocking socket"""
+    buf = bytearray(size)
+    view = memoryview(buf)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            if received == 0:
+                return None
+            raise ConnectionClosed(f"Socket closed after {received}/{size} bytes")
+        received += n
+    return buf
+
+
+def send_message(sock, msg, blob=None):
+    """Send one framed message over a blocking socket"""
+    sock.sendall(encode_message(msg, blob))
+
+
+def recv_message(sock):
+    """Receive one framed message. Returns None on a clean close."""
+    header = recv_exact(sock, HEADER.size)
+    if header is None:
+        return None
+    length, kind = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {length} bytes")
+    payload = recv_exact(sock, length) if length else bytearray()
+    if payload is None:
+        raise ConnectionClosed("Socket closed before frame payload")
+    return decode_payload(kind, payload)
+
+
+async def read_message(reader):
+    """asyncio version of recv_message. Returns None on a clean close."""
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionClosed(f"Stream closed after {len(e.partial)}/{HEADER.size} bytes")
+    length, kind = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame too large: {length} bytes")
+    try:
+        payload = await reader.readexactly(length) if length else b''
+    except asyncio.IncompleteReadError:
+        raise ConnectionClosed("Stream closed before frame payload")
+    return decode_payload(kind, payload)
+
+
+async def write_message(writer, msg, blob=None, compressor=None):
+    """Send one framed message, waiting while the peer's window is full"""
+    writer.write(encode_message(msg, blob, compressor))
+    await writer.drain()
@@ -0,0 +1,517 @@
+"""
+Compact binary format for intermediate (key, value) records.
+
+Used for map output files, sort runs and shuffle payloads. A stream is a
+magic header followed by entries, each starting with a tag byte:
+
+    STRING  [len varint][utf-8]          defines the next string id
+    SCHEMA  [n varint]([name id][type])*  defines the next schema id
+    RECORD  [key id][schema id][fixed fields][generic fields]
+    ROWS    [schema id varint][n varint]([key id][fixed fields])*n
+
+Strings (keys, field names, artist names, ...) are written once and then
+referenced by id. A dict value is described by a schema (its field names
+and types) the first time that shape appears; after that each record is
+just a struct-packed row of numbers and string ids. Values that do not
+fit a fixed type (lists, nested dicts, huge ints) use a small tagged
+generic encoding.
+
+Batches (encode_all) write consecutive records of the same all-fixed
+schema as one ROWS block: the rows are packed and unpacked a block at a
+time (struct.iter_unpack), string ids are mapped a column at a time and
+no per-field Python code runs, which keeps the format at least as fast
+as JSON for flat map outputs.
+
+Files (map outputs, sort runs) can be written zlib-compressed: they then
+start with MAGIC_ZLIB and the entries after it are one zlib stream.
+read_records reads both kinds.
+"""
+
+import struct
+import zlib
+from itertools import islice, repeat
+
+MAGIC = b'MRR1'
+MAGIC_ZLIB = b'MRZ1'
+
+T_STRING = 1
+T_SCHEMA = 2
+T_RECORD = 3
+T_ROWS = 4
+
+# Field types inside a schema
+F_INT = b'q'
+F_FLOAT = b'd'
+F_BOOL = b'?'
+F_STR = b'I'
+F_NONE = b'N'
+F_GENERIC = b'V'
+
+# Schema id used when the value is not a dict with string keys
+RAW_SCHEMA = 0xFFFFFFFF
+
+# Tags of the generic encoding
+G_NONE, G_FALSE, G_TRUE, G_INT, G_FLOAT, G_STR, G_LIST, G_DICT = range(8)
+
+RECORD_HEADER = struct.Struct('<BII')
+DOUBLE = struct.Struct('<d')
+INT64_MIN, INT64_MAX = -(1 << 63), (1 << 63) - 1
+READ_SIZE = 1 << 16
+# Records per ROWS block, so a reader never needs much more than a chunk
+ROWS_PER_BLOCK = 2048
+
+
+class _NeedMore(Exception):
+    """The buffer ends in the middle of an entry"""
+
+
+def _field_type(value):
+    if value is None:
+        return F_NONE
+    if value is True or value is False:
+        return F_BOOL
+    if type(value) is int:
+        return F_INT if INT64_MIN <= value <= INT64_MAX else F_GENERIC
+    if type(value) is float:
+        return F_FLOAT
+    if type(value) is str:
+        return F_STR
+    return F_GENERIC
+
+
+def _write_varint(out, n):
+    while n > 0x7F:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        if pos >= len(buf):
+            raise _NeedMore()
+        b = buf[pos]
+        pos += 1
+        result |= (b & 0x7F) << shift
+        if b < 0x80:
+            return result, pos
+        shift += 7
+
+
+class _Schema:
+    def __init__(self, names, types):
+        self.names = names
+        self.types = types
+        fixed = [i for i, t in enumerate(types) if t not in (F_NONE, F_GENERIC)]
+        self.fixed = fixed
+        self.strings = [i for i in fixed if types[i] == F_STR]
+        self.generic = [i for i, t in enumerate(types) if t == F_GENERIC]
+        self.struct = struct.Struct('<' + b''.join(types[i] for i in fixed).decode())
+        # Every field is packed in order: decode straight from the struct
+        self.all_fixed = len(fixed) == len(types)
+        # Key id + fields, for ROWS blocks
+        self.rows = struct.Struct(self.struct.format.replace('<', '<I', 1)) if names and self.all_fixed else None
+
+
+class RecordEncoder:
+    """Turns (key, value) pairs into bytes, keeping string/schema tables"""
+
+    def __init__(self):
+        self.string_ids = {}
+        self.schema_ids = {}
+        self.schemas = []
+
+    def _string_id(self, out, s):
+        sid = self.string_ids.get(s)
+        if sid is None:
+            sid = len(self.string_ids)
+            self.string_ids[s] = sid
+            data = s.encode('utf-8')
+            out.append(T_STRING)
+            _write_varint(out, len(data))
+            out += data
+        return sid
+
+    def _generic(self, out, defs, value):
+        if value is None:
+            out.append(G_NONE)
+        elif value is True:
+            out.append(G_TRUE)
+        elif value is False:
+            out.append(G_FALSE)
+        elif isinstance(value, int):
+            out.append(G_INT)
+            _write_varint(out, (value << 1) if value >= 0 else ((-value << 1) - 1))
+        elif isinstance(value, float):
+            out.append(G_FLOAT)
+            out += DOUBLE.pack(value)
+        elif isinstance(value, str):
+            out.append(G_STR)
+            _write_varint(out, self._string_id(defs, value))
+        elif isinstance(value, (list, tuple, set)):
+            out.append(G_LIST)
+            _write_varint(out, len(value))
+            for item in value:
+                self._generic(out, defs, item)
+        elif isinstance(value, dict):
+            out.append(G_DICT)
+            _write_varint(out, len(value))
+            for k, v in value.items():
+                _write_varint(out, self._string_id(defs, str(k)))
+                self._generic(out, defs, v)
+        else:
+            raise TypeError(f"Cannot encode value of type {type(value).__name__}")
+
+    def _schema(self, out, shape, values):
+        """Declare the schema for a new (field names, field types) shape"""
+        names = shape[0]
+        if not all(type(name) is str for name in names):
+            self.schema_ids[shape] = RAW_SCHEMA
+            return RAW_SCHEMA
+        types = tuple(_field_type(v) for v in values)
+        name_ids = [self._string_id(out, name) for name in names]
+        schema_id = len(self.schemas)
+        self.schema_ids[shape] = schema_id
+        self.schemas.append(_Schema(names, types))
+        out.append(T_SCHEMA)
+        _write_varint(out, len(names))
+        for name_id, t in zip(name_ids, types):
+            _write_varint(out, name_id)
+            out += t
+        return schema_id
+
+    def _raw(self, out, key_id, value):
+        tail = bytearray()
+        self._generic(tail, out, value)
+        out += RECORD_HEADER.pack(T_RECORD, key_id, RAW_SCHEMA)
+        out += tail
+
+    def _string_ids_of(self, out, strings):
+        """Ids of a column of strings, defining the new ones"""
+        string_ids = self.string_ids
+        ids = list(map(string_ids.get, strings))
+        if None in ids:
+            for s in dict.fromkeys(strings):
+                if s not in string_ids:
+                    self._string_id(out, s)
+            ids = list(map(string_ids.get, strings))
+        return ids
+
+    def _rows(self, out, schema_id, types, keys, values):
+        """Append ROWS blocks (and the strings they define) to `out`"""
+        for start in range(0, len(keys), ROWS_PER_BLOCK):
+            self._block(out, schema_id, types, keys[start:start + ROWS_PER_BLOCK],
+                        values[start:start + ROWS_PER_BLOCK])
+
+    def _block(self, out, schema_id, types, keys, values):
+        """One ROWS block of dicts with the schema's field names, if their types match it"""
+        schema = self.schemas[schema_id]
+        columns = list(zip(*map(dict.values, values)))
+        if all(set(map(type, column)) == {t} for column, t in zip(columns, types)):
+            for i in schema.strings:
+                columns[i] = self._string_ids_of(out, columns[i])
+            try:
+                packed = b''.join(map(schema.rows.pack, self._string_ids_of(out, keys), *columns))
+            except struct.error:
+                # e.g. an int that does not fit in 64 bits
+                packed = None
+            if packed is not None:
+                out.append(T_ROWS)
+                _write_varint(out, schema_id)
+                _write_varint(out, len(keys))
+                out += packed
+                return
+        for key, value in zip(keys, values):
+            self.encode(out, key, value)
+
+    def encode_all(self, out, pairs):
+        """Append many records to `out`, as ROWS blocks where the schema allows"""
+        schema_ids = self.schema_ids
+        schemas = self.schemas
+        run_names = run_types = run_id = None
+        keys, values = [], []
+        for key, value in pairs:
+            if type(value) is dict:
+                names = tuple(value)
+                # Same field names as the run: the types are checked per block
+                if names == run_names:
+                    keys.append(key)
+                    values.append(value)
+                    continue
+                field_values = list(value.values())
+                shape = (names, tuple(map(type, field_values)))
+                schema_id = schema_ids.get(shape)
+                if schema_id is None:
+                    schema_id = self._schema(out, shape, field_values)
+                if schema_id != RAW_SCHEMA and schemas[schema_id].rows is not None:
+                    if keys:
+                        self._rows(out, run_id, run_types, keys, values)
+                    run_names, run_types = shape
+                    run_id = schema_id
+                    keys, values = [key], [value]
+                    continue
+            if keys:
+                self._rows(out, run_id, run_types, keys, values)
+                keys, values = [], []
+            run_names = run_types = run_id = None
+            self.encode(out, key, value)
+        if keys:
+            self._rows(out, run_id, run_types, keys, values)
+
+    def encode(self, out, key, value):
+        """Append one record (and any new definitions) to `out`"""
+        string_ids = self.string_ids
+        key_id = string_ids.get(key)
+        if key_id is None:
+            key_id = self._string_id(out, key)
+        if type(value) is not dict:
+            self._raw(out, key_id, value)
+            return
+
+        values = list(value.values())
+        shape = (tuple(value), tuple(map(type, values)))
+        schema_id = self.schema_ids.get(shape)
+        if schema_id is None:
+            schema_id = self._schema(out, shape, values)
+        if schema_id == RAW_SCHEMA:
+            self._raw(out, key_id, value)
+            return
+
+        schema = self.schemas[schema_id]
+        for i in schema.strings:
+            sid = string_ids.get(values[i])
+            values[i] = sid if sid is not None else self._string_id(out, values[i])
+        try:
+            fixed = schema.struct.pack(*[values[i] for i in schema.fixed]) if schema.fixed else b''
+        except struct.error:
+            # e.g. an int that does not fit in 64 bits this time
+            self._raw(out, key_id, value)
+            return
+        tail = bytearray()
+        for i in schema.generic:
+            self._generic(tail, out, values[i])
+        out += RECORD_HEADER.pack(T_RECORD, key_id, schema_id)
+        out += fixed
+        out += tail
+
+
+class RecordDecoder:
+    """Parses entries produced by RecordEncoder"""
+
+    def __init__(self):
+        self.strings = []
+        self.schemas = []
+
+    def _generic(self, buf, pos):
+        if pos >= len(buf):
+            raise _NeedMore()
+        tag = buf[pos]
+        pos += 1
+        if tag == G_NONE:
+            return None, pos
+        if tag == G_TRUE:
+            return True, pos
+        if tag == G_FALSE:
+            return False, pos
+        if tag == G_INT:
+            n, pos = _read_varint(buf, pos)
+            return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+        if tag == G_FLOAT:
+            if pos + 8 > len(buf):
+                raise _NeedMore()
+            return DOUBLE.unpack_from(buf, pos)[0], pos + 8
+        if tag == G_STR:
+            sid, pos = _read_varint(buf, pos)
+            return self.strings[sid], pos
+        if tag == G_LIST:
+            n, pos = _read_varint(buf, pos)
+            items = []
+            for _ in range(n):
+                item, pos = self._generic(buf, pos)
+                items.append(item)
+            return items, pos
+        if tag == G_DICT:
+            n, pos = _read_varint(buf, pos)
+            result = {}
+            for _ in range(n):
+                sid, pos = _read_varint(buf, pos)
+                result[self.strings[sid]], pos = self._generic(buf, pos)
+            return result, pos
+        raise ValueError(f"Corrupt record stream: generic tag {tag}")
+
+    def decode(self, buf, pos, records):
+        """
+        Decode the entry at buf[pos], appending its records (none for a
+        definition, many for a ROWS block) to `records`. Returns the new
+        position; raises _NeedMore if the entry is not complete yet.
+        """
+        strings = self.strings
+        if pos >= len(buf):
+            raise _NeedMore()
+        tag = buf[pos]
+        if tag == T_ROWS:
+            schema_id, p = _read_varint(buf, pos + 1)
+            n, p = _read_varint(buf, p)
+            schema = self.schemas[schema_id]
+            end = p + n * schema.rows.size
+            if end > len(buf):
+                raise _NeedMore()
+            columns = list(zip(*schema.rows.iter_unpack(memoryview(buf)[p:end])))
+            lookup = strings.__getitem__
+            for i in schema.strings:
+                columns[i + 1] = map(lookup, columns[i + 1])
+            values = map(dict, map(zip, repeat(schema.names), zip(*columns[1:])))
+            records.extend(zip(map(lookup, columns[0]), values))
+            return end
+        if tag == T_RECORD:
+            if pos + RECORD_HEADER.size > len(buf):
+                raise _NeedMore()
+            _, key_id, schema_id = RECORD_HEADER.unpack_from(buf, pos)
+            pos += RECORD_HEADER.size
+            if schema_id == RAW_SCHEMA:
+                value, pos = self._generic(buf, pos)
+                records.append((strings[key_id], value))
+                return pos
+            schema = self.schemas[schema_id]
+            size = schema.struct.size
+            if pos + size > len(buf):
+                raise _NeedMore()
+            if schema.all_fixed:
+                values = list(schema.struct.unpack_from(buf, pos))
+            else:
+                values = [None] * len(schema.names)
+                for i, v in zip(schema.fixed, schema.struct.unpack_from(buf, pos)):
+                    values[i] = v
+            pos += size
+            for i in schema.strings:
+                values[i] = strings[values[i]]
+            for i in schema.generic:
+                values[i], pos = self._generic(buf, pos)
+            records.append((strings[key_id], dict(zip(schema.names, values))))
+            return pos
+        if tag == T_STRING:
+            n, p = _read_varint(buf, pos + 1)
+            if p + n > len(buf):
+                raise _NeedMore()
+            strings.append(bytes(buf[p:p + n]).decode('utf-8'))
+            return p + n
+        if tag == T_SCHEMA:
+            n, p = _read_varint(buf, pos + 1)
+            names, types = [], []
+            for _ in range(n):
+                sid, p = _read_varint(buf, p)
+                if p >= len(buf):
+                    raise _NeedMore()
+                names.append(strings[sid])
+                types.append(bytes(buf[p:p + 1]))
+                p += 1
+            self.schemas.append(_Schema(tuple(names), tuple(types)))
+            return p
+        raise ValueError(f"Corrupt record stream: tag {tag}")
+
+
+class RecordWriter:
+    """Streams records into a binary file, zlib-compressed at `compress_level` if set"""
+
+    def __init__(self, path, flush_size=READ_SIZE, compress_level=None):
+        self.f = open(path, 'wb')
+        self.encoder = RecordEncoder()
+        self.compressor = None
+        if compress_level:
+            self.f.write(MAGIC_ZLIB)
+            self.compressor = zlib.compressobj(compress_level)
+            self.buffer = bytearray()
+        else:
+            self.buffer = bytearray(MAGIC)
+        self.flush_size = flush_size
+        self.count = 0
+
+    def write(self, key, value):
+        self.encoder.encode(self.buffer, key, value)
+        self.count += 1
+        if len(self.buffer) >= self.flush_size:
+            self._flush()
+
+    def write_all(self, pairs):
+        pairs = iter(pairs)
+        while True:
+            batch = list(islice(pairs, ROWS_PER_BLOCK))
+            if not batch:
+                return
+            self.encoder.encode_all(self.buffer, batch)
+            self.count += len(batch)
+            if len(self.buffer) >= self.flush_size:
+                self._flush()
+
+    def _flush(self):
+        self.f.write(self.compressor.compress(self.buffer) if self.compressor else self.buffer)
+        self.buffer = bytearray()
+
+    def close(self):
+        self._flush()
+        if self.compressor:
+            self.f.write(self.compressor.flush())
+        self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_records(path):
+    """Yield (key, value) pairs from a record file, reading it in chunks"""
+    decoder = RecordDecoder()
+    with open(path, 'rb') as f:
+        magic = f.read(len(MAGIC))
+        if magic not in (MAGIC, MAGIC_ZLIB):
+            raise ValueError(f"{path} is not a record file")
+        inflater = zlib.decompressobj() if magic == MAGIC_ZLIB else None
+        buf = b''
+        pos = 0
+        eof = False
+        records = []
+        while True:
+            try:
+                pos = decoder.decode(buf, pos, records)
+                if records:
+                    yield from records
+                    records.clear()
+            except _NeedMore:
+                if eof:
+                    if pos < len(buf):
+                        raise ValueError(f"{path} ends in the middle of a record")
+                    return
+                chunk = f.read(READ_SIZE)
+                if not chunk:
+                    eof = True
+                if inflater:
+                    chunk = inflater.decompress(chunk) if chunk else inflater.flush()
+                buf = buf[pos:] + chunk
+                pos = 0
+
+
+def encode_records(pairs):
+    """Encode a batch of pairs as one self-contained blob"""
+    out = bytearray(MAGIC)
+    RecordEncoder().encode_all(out, pairs)
+    return bytes(out)
+
+
+def decode_records(blob):
+    """Decode a blob made by encode_records into a list of pairs"""
+    if blob[:len(MAGIC)] != MAGIC:
+        raise ValueError("Not a record blob")
+    decoder = RecordDecoder()
+    records = []
+    pos = len(MAGIC)
+    end = len(blob)
+    try:
+        while pos < end:
+            pos = decoder.decode(blob, pos, records)
+    except _NeedMore:
+        raise ValueError("Truncated record blob")
+    return records
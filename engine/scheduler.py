@@ -0,0 +1,101 @@
+"""
+Map task scheduling for the master.
+
+The input is cut into many small tasks that are handed out one at a time
+as workers report back, so fast workers simply process more tasks. When
+nothing is left in the queue, idle workers get a backup copy of the
+slowest running task (speculative execution); whichever copy finishes
+first wins and the other result is discarded, never shuffled: the master
+only lists the winner's tasks in start_shuffle, and in pipelined mode it
+answers each map_done with map_accepted or map_discarded before the
+worker shuffles anything.
+
+When a worker is lost, only its own tasks go back to the queue. The path
+of a finished output is kept, so the next worker can reuse it instead of
+mapping again: work_dir is on storage all workers share (engine/storage.py).
+"""
+
+import statistics
+
+PENDING = 'PENDING'
+RUNNING = 'RUNNING'
+DONE = 'DONE'
+
+
+class TaskScheduler:
+    def __init__(self, splits, speculation=True, slowdown=1.5):
+        self.tasks = {
+            task_id: {"task_id": task_id, "split": split, "state": PENDING,
+                      "attempts": {}, "owner": None, "output": None}
+            for task_id, split in enumerate(splits)
+        }
+        self.pending = list(self.tasks)
+        self.speculation = speculation
+        self.slowdown = slowdown
+        self.durations = []
+        self.backups = 0
+
+    def done(self):
+        return all(t['state'] == DONE for t in self.tasks.values())
+
+    def _straggler(self, worker_id, now):
+        """The running task that has been running longest, if it is slow enough"""
+        candidates = [
+            t for t in self.tasks.values()
+            if t['state'] == RUNNING and len(t['attempts']) == 1
+            and worker_id not in t['attempts']
+        ]
+        if not candidates:
+            return None
+        task = min(candidates, key=lambda t: min(t['attempts'].values()))
+        elapsed = now - min(task['attempts'].values())
+        # Wait until some tasks finished, so "slow" means something
+        if not self.durations or elapsed < self.slowdown * statistics.median(self.durations):
+            return None
+        return task
+
+    def next_task(self, worker_id, now):
+        """Pick the next task for an idle worker. Returns (task, is_backup) or None"""
+        if self.pending:
+            task = self.tasks[self.pending.pop(0)]
+            task['state'] = RUNNING
+            task['attempts'][worker_id] = now
+            return task, False
+        if not self.speculation:
+            return None
+        task = self._straggler(worker_id, now)
+        if task is None:
+            return None
+        task['attempts'][worker_id] = now
+        self.backups += 1
+        return task, True
+
+    def complete(self, task_id, worker_id, now, output=None):
+        """Record a finished attempt. Returns False for a duplicate result."""
+        task = self.tasks[task_id]
+        if task['state'] == DONE:
+            return False
+        task['state'] = DONE
+        task['owner'] = worker_id
+        task['output'] = output
+        self.durations.append(now - task['attempts'].get(worker_id, now))
+        return True
+
+    def worker_lost(self, worker_id):
+        """Put the lost worker's running and finished tasks back in the queue"""
+        requeued = []
+        for task in self.tasks.values():
+            started = task['attempts'].pop(worker_id, None)
+            if task['state'] == RUNNING and started is not None and not task['attempts']:
+                task['state'] = PENDING
+                requeued.append(task['task_id'])
+            elif task['state'] == DONE and task['owner'] == worker_id:
+                task['state'] = PENDING
+                task['owner'] = None
+                task['attempts'] = {}
+                requeued.append(task['task_id'])
+        self.pending = requeued + self.pending
+        return requeued
+
+    def owned_tasks(self, worker_id):
+        return [t['task_id'] for t in self.tasks.values() if t['owner'] == worker_id]
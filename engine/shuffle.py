@@ -0,0 +1,246 @@
+"""
+Shuffle transport between workers.
+
+Each worker keeps one persistent connection per peer (PeerPool) and sends
+its partitions to all peers at the same time as asyncio tasks.
+A partition is cut into bounded batches of binary records (see
+engine/records.py), so the receiver decodes and
+stores it incrementally instead of buffering the whole payload. After the
+last batch the sender asks for an ack, which guarantees the data has been
+stored before the worker reports shuffle_done to the master.
+
+Every batch is tagged with the job, the reduce partition and the group of
+map tasks it was produced from. The receiver (PartitionStore) stages a
+group, per connection, until the sender commits it on that connection,
+and drops a group whose tasks were committed before. Groups from
+different peers are stored in parallel: the store's lock only guards its
+tables, and every sorter has a lock of its own. This makes it safe to re-send map output after a worker failure:
+a map task is never counted twice, and half-sent data from a dead sender
+is never counted at all.
+
+When the master declares a peer lost, abort() fails every send to it at
+once (in flight or later) instead of waiting for shuffle_timeout: a
+stopped peer still accepts TCP connections but never acks.
+
+A new connection starts with a hello that agrees on a compression codec
+(see engine/compression.py); each connection then compresses its own
+batches, at a level that follows the measured CPU and link speed.
+"""
+
+import asyncio
+import itertools
+import threading
+import time
+
+from engine.compression import available_codecs, negotiate
+from engine.extsort import ExternalSorter, MemoryBudget
+from engine.protocol import ConnectionClosed, encode_message, read_message, write_message
+from engine.records import encode_records
+
+
+class PartitionStore:
+    """
+    Receiver side of the shuffle: one ExternalSorter per reduce partition
+    and per staged group. Their buffers share `budget` (e.g. the worker's),
+    or one of `max_records` for the store.
+    """
+
+    def __init__(self, spill_dir, max_records=100000, compress_level=None, combine=None,
+                 budget=None, merge_fan_in=64):
+        self.spill_dir = spill_dir
+        self.budget = budget if budget is not None else MemoryBudget(max_records)
+        self.merge_fan_in = merge_fan_in
+        self.compress_level = compress_level
+        self.combine = combine
+        self.lock = threading.Lock()
+        self.sorters = {}
+        self.staged = {}
+        self.committed = {}
+        self._ids = itertools.count()
+
+    def _new_sorter(self, name):
+        return ExternalSorter(self.spill_dir, prefix=f"{name}_{next(self._ids)}",
+                              compress_level=self.compress_level, combine=self.combine,
+                              budget=self.budget, merge_fan_in=self.merge_fan_in)
+
+    def stage(self, partition, tasks, records, source=None):
+        """
+        Add a batch to its group. Groups are staged per source connection:
+        a group re-sent after a failure never mixes with the half it replaces.
+        """
+        key = (partition, tuple(tasks), source)
+        with self.lock:
+            sorter = self.staged.get(key)
+            if sorter is None:
+                sorter = self.staged[key] = self._new_sorter(f"stage_p{partition}")
+        # Out of the store's lock: receivers of other groups do not wait for a spill
+        sorter.extend(records)
+
+    def commit(self, partition, tasks, source=None):
+        """Make a staged group visible to the reducer. False if it is a duplicate."""
+        with self.lock:
+            staged = self.staged.pop((partition, tuple(tasks), source), None)
+            done = self.committed.setdefault(partition, set())
+            duplicate = bool(done.intersection(tasks))
+            if not duplicate:
+                done.update(tasks)
+                target = self._sorter(partition)
+        if staged:
+            if duplicate:
+                staged.cleanup()
+            else:
+                target.absorb(staged)
+        return not duplicate
+
+    def _sorter(self, partition):
+        if partition not in self.sorters:
+            self.sorters[partition] = self._new_sorter(f"p{partition}")
+        return self.sorters[partition]
+
+    def sorter(self, partition):
+        with self.lock:
+            return self._sorter(partition)
+
+    def drop(self, partition):
+        """Forget a partition once it has been reduced"""
+        with self.lock:
+            sorters = [self.sorters.pop(partition, None)]
+            sorters += [self.staged.pop(key) for key in [k for k in self.staged if k[0] == partition]]
+        for sorter in sorters:
+            if sorter:
+                sorter.cleanup()
+
+
+class PeerPool:
+    """One open connection (with its send lock and compressor) per peer address"""
+
+    def __init__(self, timeout=None, config=None):
+        self.conns = {}
+        self.lock = asyncio.Lock()
+        # A peer that stops answering must not block the sender forever
+        self.timeout = timeout
+        # Compression settings, see engine/compression.py
+        self.config = config or {}
+        # Peers declared lost by the master, and the sends in progress per peer
+        self.lost = set()
+        self.sending = {}
+
+    async def get(self, address):
+        if address in self.lost:
+            raise ConnectionError(f"Peer {address} was lost")
+        async with self.lock:
+            entry = self.conns.get(address)
+            if entry is None:
+                reader, writer = await asyncio.wait_for(
+                    asyncio.open_connection(*address), self.timeout)
+                try:
+                    await write_message(writer, {"type": "hello", "codecs": available_codecs()})
+                    reply = await asyncio.wait_for(read_message(reader), self.timeout)
+                except (OSError, asyncio.TimeoutError, ConnectionClosed):
+                    writer.close()
+                    raise
+                if reply is None or reply['type'] != 'hello':
+                    writer.close()
+                    raise ConnectionError(f"No hello from peer {address}")
+                entry = (reader, writer, asyncio.Lock(), negotiate(self.config, reply['codecs']))
+                self.conns[address] = entry
+            return entry
+
+    def drop(self, address):
+        entry = self.conns.pop(address, None)
+        if entry:
+            entry[1].close()
+
+    def abort(self, address):
+        """The peer is lost: cancel the sends to it and refuse new ones"""
+        self.lost.add(address)
+        for task in self.sending.pop(address, set()):
+            task.cancel()
+        entry = self.conns.pop(address, None)
+        if entry:
+            # close() would wait to flush what the peer does not read
+            entry[1].transport.abort()
+
+    def revive(self, addresses):
+        """Peers of a new partition table (e.g. a worker that came back on the same address)"""
+        self.lost.difference_update(addresses)
+
+    def close_all(self):
+        for address in list(self.conns):
+            self.drop(address)
+
+
+def encode_batch(header, batch, compressor):
+    """One shuffle_data frame. Returns (record bytes before compression, frame)."""
+    blob = encode_records(batch)
+    return len(blob), encode_message(dict(header, count=len(batch)), blob, compressor)
+
+
+async def send_partition(pool, address, job_id, partition, tasks, records, batch_size):
+    """
+    Send one partition in batches, commit it and wait for the receiver's ack.
+    Returns (records sent, record bytes sent, bytes on the wire).
+    """
+    sends = pool.sending.setdefault(address, set())
+    sends.add(asyncio.current_task())
+    try:
+        return await _send_partition(pool, address, job_id, partition, tasks, records, batch_size)
+    finally:
+        sends.discard(asyncio.current_task())
+
+
+async def _send_partition(pool, address, job_id, partition, tasks, records, batch_size):
+    reader, writer, conn_lock, compressor = await pool.get(address)
+    header = {"type": "shuffle_data", "job_id": job_id, "partition": partition, "tasks": tasks}
+    sent_bytes = 0
+    wire_bytes = 0
+    try:
+        async with conn_lock:
+            # drain() waits while the receiver is behind, so at most one
+            # socket buffer of batches is in flight per peer
+            net_seconds = 0.0
+            for i in range(0, len(records), batch_size):
+                # Encoding (and compressing) runs off the event loop
+                raw, frame = await asyncio.to_thread(
+                    encode_batch, header, records[i:i + batch_size], compressor)
+                sent_bytes += raw
+                wire_bytes += len(frame)
+                start = time.perf_counter()
+                writer.write(frame)
+                await asyncio.wait_for(writer.drain(), pool.timeout)
+                net_seconds += time.perf_counter() - start
+            start = time.perf_counter()
+            writer.write(encode_message({"type": "shuffle_commit", "job_id": job_id,
+                                         "partition": partition, "tasks": tasks}))
+            writer.write(encode_message({"type": "shuffle_flush"}))
+            reply = await asyncio.wait_for(read_message(reader), pool.timeout)
+            if compressor is not None:
+                # The link is as fast as the receiver takes the bytes, ack included
+                compressor.observe_send(wire_bytes, net_seconds + time.perf_counter() - start)
+        if reply is None or reply['type'] != 'shuffle_ack':
+            raise ConnectionError(f"No ack from peer {address}")
+        return len(records), sent_bytes, wire_bytes
+    except (OSError, asyncio.TimeoutError, ConnectionClosed):
+        # Never reuse a connection that failed half way through
+        pool.drop(address)
+        raise
+
+
+async def send_partitions(pool, job_id, partitions, tasks, batch_size=5000, max_parallel=8):
+    """
+    Send {partition: (address, records)} for one group of map tasks to
+    all targets concurrently, at most `max_parallel` at a time.
+    Returns {partition: (records, bytes, wire bytes) sent or the exception that stopped it}.
+    A send aborted because its peer was lost gives a CancelledError.
+    """
+    slots = asyncio.Semaphore(max_parallel)
+
+    async def send(partition, address, records):
+        async with slots:
+            return await send_partition(pool, address, job_id, partition, tasks, records, batch_size)
+
+    results = await asyncio.gather(
+        *(send(partition, address, records) for partition, (address, records) in partitions.items()),
+        return_exceptions=True
+    )
+    return dict(zip(partitions, results))
@@ -0,0 +1,78 @@
+"""
+Byte-range input splits.
+
+The master only looks at the size of the dataset and a handful of bytes
+around each boundary; it sends (path, start, end) descriptors to the
+workers, which memory-map the file and parse their own range.
+"""
+
+import mmap
+import os
+
+
+def _aligned_boundaries(f, first, end, parts):
+    """Offsets that cut [first, end) into `parts` pieces on line starts"""
+    boundaries = [first]
+    for i in range(1, parts):
+        target = first + (end - first) * i // parts
+        if target <= boundaries[-1]:
+            continue
+        # Move the boundary forward to the start of the next line
+        f.seek(target - 1)
+        f.readline()
+        pos = f.tell()
+        if pos >= end:
+            break
+        if pos > boundaries[-1]:
+            boundaries.append(pos)
+    boundaries.append(end)
+    return boundaries
+
+
+def _to_splits(path, boundaries):
+    return [{"path": path, "start": start, "end": end}
+            for start, end in zip(boundaries, boundaries[1:]) if end > start]
+
+
+def compute_splits(path, num_splits, skip_header=True):
+    """Cut a file into `num_splits` newline-aligned byte ranges"""
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        if skip_header:
+            f.readline()
+        boundaries = _aligned_boundaries(f, f.tell(), size, num_splits)
+    return _to_splits(path, boundaries)
+
+
+def subdivide_split(split, parts):
+    """Cut one split into smaller newline-aligned splits"""
+    if parts <= 1:
+        return [split]
+    with open(split['path'], 'rb') as f:
+        boundaries = _aligned_boundaries(f, split['start'], split['end'], parts)
+    return _to_splits(split['path'], boundaries)
+
+
+def read_split_lines(split):
+    """Yield the decoded lines of one split straight from a memory map"""
+    start, end = split['start'], split['end']
+    if end <= start:
+        return
+    with open(split['path'], 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = start
+            while pos < end:
+                nl = mm.find(b'\n', pos, end)
+                nl = end if nl == -1 else nl + 1
+                yield mm[pos:nl].decode('utf-8')
+                pos = nl
+
+
+def read_split_text(split):
+    """Return the whole split as one decoded string"""
+    start, end = split['start'], split['end']
+    if end <= start:
+        return ""
+    with open(split['path'], 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return mm[start:end].decode('utf-8')
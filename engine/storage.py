@@ -0,0 +1,63 @@
+"""
+Check that the master and the workers share their storage.
+
+Nodes hand each other files by path, not over the network: the input
+splits (engine/splits.py), a lost worker's map outputs, reused by the
+worker that takes its tasks over (engine/scheduler.py), and the reduce
+outputs the master merges (engine/output.py). The input, work_dir and
+the results directory must therefore be on storage that every node sees
+at the same path: one machine, or a shared filesystem such as NFS.
+
+At job start the master leaves a marker file with a random token in
+work_dir and in the job's output directory. Every worker reads the
+tokens back and checks that its own directories are those same ones, so
+a setup without shared storage fails the job right away, naming the
+directory, and not later on a file some node cannot open.
+"""
+
+import os
+import uuid
+
+
+def place_markers(directories, job_id):
+    """Write a marker in each {name: directory}. Returns {name: {"path", "token"}} for the workers."""
+    markers = {}
+    for name, directory in directories.items():
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(os.path.abspath(directory), f".storage_check_job_{job_id}")
+        token = uuid.uuid4().hex
+        with open(path, 'w') as f:
+            f.write(token)
+        markers[name] = {"path": path, "token": token}
+    return markers
+
+
+def remove_markers(markers):
+    for marker in markers.values():
+        try:
+            os.remove(marker['path'])
+        except OSError:
+            pass
+
+
+def check_markers(markers, directories):
+    """Raise RuntimeError unless each of this node's {name: directory} holds the master's marker"""
+    for name, marker in markers.items():
+        try:
+            with open(marker['path']) as f:
+                found = f.read()
+        except OSError:
+            found = None
+        shared_dir = os.path.dirname(marker['path'])
+        if found != marker['token']:
+            raise RuntimeError(
+                f"{name} {shared_dir} of the master cannot be read here: the master and the "
+                f"workers need shared storage (the same files at the same paths)")
+        local_dir = directories.get(name)
+        if local_dir is None:
+            continue
+        os.makedirs(local_dir, exist_ok=True)
+        if not os.path.samefile(local_dir, shared_dir):
+            raise RuntimeError(
+                f"{name} is {os.path.abspath(local_dir)} here but {shared_dir} on the master: "
+                f"set it to a path that is the same directory on every node")
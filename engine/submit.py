@@ -0,0 +1,89 @@
+"""
+Job submission client for a warm cluster (`master.py --serve`).
+
+    python engine/submit.py <problem_module> [--flags]   submit a job and wait for it
+    python engine/submit.py <module> [--flags] + <module> [--flags]
+                                                         several modules over one scan of the input
+    python engine/submit.py --jobs                       list the jobs and workers
+    python engine/submit.py --shutdown                   stop once submitted jobs are done
+
+Submit options (the other --flags go to the problem module):
+    --detach             print the job id and return right away
+    --input=PATH         input file, relative to the project (default: config input_path)
+    --output-dir=DIR     where the reduce results go (default: results/job_<id>)
+    --profile            profile the job, report in <output-dir>/profile/report.txt
+"""
+
+import socket
+import sys
+import os
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load_config, parse_problems, format_problems
+from engine.protocol import send_message, recv_message
+
+CLIENT_OPTIONS = ('--detach', '--input=', '--output-dir=', '--jobs', '--shutdown', '--profile')
+
+
+def request(msg, replies=1):
+    """Send one request to the master and return its replies"""
+    config = load_config()
+    with socket.create_connection((config['master_node']['ip'], config['master_node']['port'])) as sock:
+        send_message(sock, msg)
+        answers = []
+        for _ in range(replies):
+            reply = recv_message(sock)
+            if reply is None:
+                raise ConnectionError("The master closed the connection")
+            answers.append(reply)
+        return answers
+
+
+def option(argv, name):
+    for arg in argv:
+        if arg.startswith(name):
+            return arg[len(name):]
+    return None
+
+
+def submit(argv):
+    wait = '--detach' not in argv
+    msg = {
+        "type": "submit",
+        "problems": parse_problems([arg for arg in argv if not arg.startswith(CLIENT_OPTIONS)]),
+        "input_path": option(argv, '--input='),
+        "output_dir": option(argv, '--output-dir='),
+        "profile": '--profile' in argv,
+        "wait": wait,
+    }
+    answers = request(msg, replies=2 if wait else 1)
+    print(f"Submitted job {answers[0]['job_id']} ({format_problems(msg['problems'])})")
+    if not wait:
+        return 0
+    result = answers[1]
+    if result['state'] != 'DONE':
+        print(f"Job {result['job_id']} {result['state']}: {result['error']}")
+        return 1
+    print(f"Job {result['job_id']} done in {result['wall_s']:.2f} s, results in {result['output_dir']}")
+    return 0
+
+
+def list_jobs():
+    (reply,) = request({"type": "jobs"})
+    print("Workers: " + ", ".join(f"{wid} {status}" for wid, status in reply['workers'].items()))
+    for job in reply['jobs']:
+        wall = f"{job['wall_s']:.2f} s" if job['wall_s'] is not None else "-"
+        print(f"  job {job['job_id']:>3}  {job['state']:8} {wall:>9}  {format_problems(job['problems'])}"
+              + (f"  ({job['error']})" if job['error'] else ""))
+    return 0
+
+
+if __name__ == "__main__":
+    argv = sys.argv[1:]
+    if '--jobs' in argv:
+        sys.exit(list_jobs())
+    if '--shutdown' in argv:
+        (reply,) = request({"type": "shutdown"})
+        print(f"Master shuts down after {reply['pending']} queued jobs")
+        sys.exit(0)
+    sys.exit(submit(argv))
@@ -1,182 +1,924 @@
-import socket
-import threading
-import json
+import asyncio
+import contextlib
+import io
 import sys
 import os
-import hashlib
-import importlib
+import shutil
+import time
+import importlib.util
+import itertools
+import multiprocessing
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from utils import load_config
+from utils import load_config, parse_problems
+from engine.protocol import ConnectionClosed, read_message, write_message
+from engine.splits import read_split_lines, read_split_text, subdivide_split
+from engine.columnar import ColumnReader, may_match, subdivide_row_groups
+from engine.shuffle import PartitionStore, PeerPool, send_partitions
+from engine.extsort import MemoryBudget
+from engine.records import RecordWriter, read_records, decode_records
+from engine.partitioner import from_spec, sample_keys
+from engine.metrics import start_timer, elapsed, add_counters
+from engine.mapcache import MapCache, module_fingerprint
+from engine.compression import available_codecs, negotiate
+from engine.output import ResultWriter, output_labels
+from engine.storage import check_markers
+from engine import profiling
 
 PROBLEM_MODULE = "user_app"
 
+# Problem modules loaded so far, one instance per (name, args): a job
+# configuring its module never changes the module of another job
+problem_modules = {}
+
 def load_problem_module(problem_name, extra_args=None):
-    """Load map/reduce functions from specified module"""
-    global map_function, reduce_function
-    module = importlib.import_module(problem_name)
+    """Load map/reduce functions from specified module (once per name and args)"""
+    extra_args = list(extra_args or [])
+    module = problem_modules.get((problem_name, tuple(extra_args)))
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(problem_name)
+    if spec is None:
+        raise ImportError(f"No problem module named {problem_name!r}")
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
     print(f"[WORKER] Extra args received: {extra_args}")
     if hasattr(module, 'configure_features'):
-        module.configure_features(extra_args if extra_args else [])
-    map_function = module.map_function
-    reduce_function = module.reduce_function
+        module.configure_features(extra_args)
     print(f"[WORKER] Loaded problem module: {problem_name}")
+    if getattr(module, 'combine_function', None):
+        print(f"[WORKER] Using map-side combiner from {problem_name}")
+    if getattr(module, 'map_batch', None):
+        print(f"[WORKER] Using batched map_batch from {problem_name}")
+    problem_modules[(problem_name, tuple(extra_args))] = module
+    return module
+
+def combine_pairs(pairs, combine_function):
+    """Group (key, value) pairs and run the combiner once per key"""
+    if combine_function is None:
+        return pairs
+    grouped = {}
+    for key, value in pairs:
+        if key not in grouped: grouped[key] = []
+        grouped[key].append(value)
+    return [(key, combine_function(key, values)) for key, values in grouped.items()]
+
+
+class ProblemSet:
+    """
+    The problem modules of one job, problems = [(module, args), ...].
+
+    With several modules the input is scanned once for all of them: every
+    line (or text buffer, for map_batch, or row group of a columnar input,
+    for map_columns) is handed to each module in turn.
+    Their keys share one shuffle as "<index>:<key>", and every combine and
+    reduce call goes to the module that emitted the key. A job with one
+    module keeps its keys as they are.
+
+    Module functions are looked up with function(), which times their
+    calls when the thread runs a profiled command (engine/profiling.py).
+    """
+
+    def __init__(self, problems):
+        self.problems = [(name, list(args or [])) for name, args in problems]
+        self.modules = [load_problem_module(name, args) for name, args in self.problems]
+        self.shared = len(self.modules) > 1
+        self.combiners = [getattr(m, 'combine_function', None) for m in self.modules]
+        # Hot keys can only be split when every module can combine them
+        self.can_combine = all(self.combiners)
+        # Columnar input (engine/columnar.py) needs map_columns everywhere
+        self.columnar = all(getattr(m, 'map_columns', None) and getattr(m, 'COLUMNS', None)
+                            for m in self.modules)
+        # Profiles tell user code from engine code by these
+        self.names = [label or name for label, (name, _) in zip(output_labels(self.problems), self.problems)]
+        self.user_files = [m.__file__ for m in self.modules if getattr(m, '__file__', None)]
+
+    def function(self, index, name):
+        """A function of module `index` (None if it has none), timed when profiling"""
+        function = getattr(self.modules[index], name, None)
+        recorder = profiling.current()
+        if recorder is None or function is None:
+            return function
+        return recorder.timed(f"{self.names[index]}.{name}", function)
+
+    def owner(self, key):
+        """(module index, the module's own key) of a shuffled key"""
+        if not self.shared:
+            return 0, key
+        index, key = key.split(':', 1)
+        return int(index), key
+
+    def tag(self, index, pairs):
+        if not self.shared:
+            return pairs
+        return ((f"{index}:{key}", value) for key, value in pairs)
+
+    def combine_pairs(self, pairs):
+        if not self.shared:
+            return combine_pairs(pairs, self.function(0, 'combine_function'))
+        if not any(self.combiners):
+            return pairs
+        combiners = [self.function(i, 'combine_function') for i in range(len(self.modules))]
+        grouped = {}
+        for key, value in pairs:
+            if key not in grouped: grouped[key] = []
+            grouped[key].append(value)
+        results = []
+        for key, values in grouped.items():
+            index, own_key = self.owner(key)
+            combine_function = combiners[index]
+            if combine_function is None:
+                results.extend((key, value) for value in values)
+            else:
+                results.append((key, combine_function(own_key, values)))
+        return results
+
+    def combine_map_output(self, pairs, stats):
+        """
+        combine_pairs() of a map output. How many records each key had
+        before it was combined goes to stats["key_counts"]: the combined
+        output has about one record per key and task, so only these counts
+        show which keys are hot.
+        """
+        if any(self.combiners):
+            stats["key_counts"] = Counter(key for key, _ in pairs)
+        return self.combine_pairs(pairs)
+
+    def combine(self, key, values):
+        index, own_key = self.owner(key)
+        return self.function(index, 'combine_function')(own_key, values)
+
+    def reducer(self):
+        """reduce(key, values) -> (module index, the module's own key, result)"""
+        reduce_functions = [self.function(i, 'reduce_function') for i in range(len(self.modules))]
+
+        def reduce(key, values):
+            index, own_key = self.owner(key)
+            return index, own_key, reduce_functions[index](own_key, values)
+        return reduce
+
+    def map_split(self, split):
+        """Returns the combined pairs and {records_in, bytes_read, ...} of the split"""
+        if 'row_groups' in split:
+            return self.map_row_groups(split)
+        results = []
+        line_count = 0
+        stats = {"bytes_read": split['end'] - split['start']}
+        if not self.shared and not getattr(self.modules[0], 'map_batch', None):
+            map_function = self.function(0, 'map_function')
+            for line in read_split_lines(split):
+                results.extend(map_function(line))
+                line_count += 1
+            stats["records_in"] = line_count
+            return self.combine_map_output(results, stats), stats
+
+        batch = [(i, self.function(i, 'map_batch'))
+                 for i, m in enumerate(self.modules) if getattr(m, 'map_batch', None)]
+        per_line = [(i, self.function(i, 'map_function'))
+                    for i, m in enumerate(self.modules) if not getattr(m, 'map_batch', None)]
+        # Read whole buffers, at most map_batch_bytes at a time; map_batch
+        # modules get the buffer, the others its lines, one pass for all
+        parts = -(-(split['end'] - split['start']) // map_batch_bytes)
+        for part in subdivide_split(split, parts):
+            text = read_split_text(part)
+            line_count += text.count('\n')
+            for index, map_batch in batch:
+                results.extend(self.tag(index, map_batch(text)))
+            if per_line:
+                # StringIO splits on '\n' only, like reading the file does
+                for line in io.StringIO(text):
+                    for index, map_function in per_line:
+                        results.extend(self.tag(index, map_function(line)))
+        stats["records_in"] = line_count
+        return self.combine_map_output(results, stats), stats
+
+    def map_row_groups(self, split):
+        """
+        Columnar input: only the chunks of the COLUMNS the modules declare
+        are read, and only of row groups their ZONE_FILTER may keep
+        """
+        results = []
+        stats = {"records_in": 0, "row_groups": 0, "row_groups_skipped": 0}
+        map_columns = [self.function(i, 'map_columns') for i in range(len(self.modules))]
+        with ColumnReader(split['path']) as reader:
+            for group in reader.row_groups(split):
+                users = [i for i, m in enumerate(self.modules)
+                         if may_match(group, getattr(m, 'ZONE_FILTER', None))]
+                if not users:
+                    stats["row_groups_skipped"] += 1
+                    continue
+                stats["row_groups"] += 1
+                stats["records_in"] += group['rows']
+                needed = sorted(set(itertools.chain.from_iterable(
+                    self.modules[i].COLUMNS for i in users)))
+                columns = reader.read(group, needed)
+                for index in users:
+                    module = self.modules[index]
+                    results.extend(self.tag(index, map_columns[index](
+                        {c: columns[c] for c in module.COLUMNS})))
+            stats["bytes_read"] = reader.bytes_read
+        return self.combine_map_output(results, stats), stats
+
+    def fingerprint(self):
+        return "+".join(module_fingerprint(module, args)
+                        for module, (_, args) in zip(self.modules, self.problems))
+
+
+# Problem sets by their problems, so a process of the map pool builds each one once
+problem_sets = {}
+
+def load_problem_set(problems):
+    key = tuple((name, tuple(args or [])) for name, args in problems)
+    if key not in problem_sets:
+        problem_sets[key] = ProblemSet(problems)
+    return problem_sets[key]
+
+def map_split(split, problems, profile_interval=None):
+    """
+    Run map (and the combiners) of the job's problems over one byte range
+    of the input. A map process profiles it when given a profile_interval,
+    and returns the profile with the stats.
+    """
+    problem_set = load_problem_set(problems)
+    if profile_interval is None:
+        return problem_set.map_split(split)
+    with profiling.recording('map (pool)', problem_set.user_files, profile_interval) as recorder:
+        pairs, stats = problem_set.map_split(split)
+    return pairs, dict(stats, profile=recorder.data)
+
+def _init_map_process(problems, batch_bytes):
+    """Process pool initializer: every child loads the worker's default modules up front"""
+    global map_batch_bytes
+    map_batch_bytes = batch_bytes
+    load_problem_set(problems)
+
+def run_map(job, split):
+    """Map a split locally, fanned out to the process pool when configured"""
+    if map_pool is None:
+        return map_split(split, job.problems.problems)
+    if 'row_groups' in split:
+        parts = subdivide_row_groups(split, map_parallelism)
+    else:
+        parts = subdivide_split(split, map_parallelism)
+    map_results = []
+    stats = {}
+    interval = job.profile.interval if job.profile else None
+    for part_results, part_stats in map_pool.map(map_split, parts,
+                                                 itertools.repeat(job.problems.problems),
+                                                 itertools.repeat(interval)):
+        map_results.extend(part_results)
+        if 'profile' in part_stats:
+            job.profile.add(part_stats.pop('profile'))
+        add_counters(stats, part_stats)
+    # Each process combined its own part, combine once more across parts
+    return job.problems.combine_pairs(map_results), stats
+
+# Local process pool for the map phase (None when map_parallelism is 1)
+map_pool = None
+map_parallelism = 1
+map_batch_bytes = 8 * 1024 * 1024
+
+peer_pool = None
+# Bounds how many incoming batches are decoded and stored at the same time
+peer_slots = None
+# Open incoming peer connections: handler task -> writer
+peer_connections = {}
+connection_ids = itertools.count()
+# Records the reduce sorters of all jobs may hold in memory, together
+# (reduce_memory_records, see engine/extsort.py)
+reduce_memory = None
+
+# Control connection to the master, shared with the heartbeat task,
+# and the compressor agreed on with the master (None: send raw)
+master_writer = None
+master_compressor = None
+
+# State of every job this worker takes part in, by job id
+jobs = {}
+# worker.py --profile: profile every job, not only the ones the master asks for
+profile_jobs = False
+
+
+class JobState:
+    """
+    Everything a worker keeps for one job. It lives in its own work
+    directory, and is dropped (files included) when the job ends.
+    """
+
+    def __init__(self, job_id, problems, output_dir, profile=False):
+        self.job_id = job_id
+        self.problems = load_problem_set(problems)
+        self.output_dir = output_dir
+        # One results sub-directory per module when they share the scan
+        self.labels = output_labels(self.problems.problems)
+        for label in self.labels:
+            os.makedirs(os.path.join(output_dir, label), exist_ok=True)
+        self.work_dir = os.path.join(worker_dir, f"job_{job_id}")
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+        os.makedirs(self.work_dir)
+
+        # Where each map output is, which groups of map tasks were already
+        # shuffled, the current partition table and the partitioner chosen
+        # by the master
+        self.task_outputs = {}
+        self.shuffled_groups = []
+        self.partition_table = []
+        self.partitioner = None
+        # Pipelined mode: map outputs are shuffled as soon as the master accepts
+        # them (the first attempt of a task wins), by background tasks that take turns (with recovery) on shuffle_lock
+        self.pipelined = False
+        self.shuffle_lock = asyncio.Lock()
+        self.background = set()
+        # Incoming shuffle records, one spillable sorter per reduce partition,
+        # combined as they arrive when every module has a combiner. All jobs
+        # share the worker's reduce_memory_records.
+        self.partition_store = PartitionStore(
+            os.path.join(self.work_dir, 'reduce_runs'),
+            compress_level=config.get('spill_compression_level'),
+            combine=self.problems.combine if self.problems.can_combine else None,
+            budget=reduce_memory,
+            merge_fan_in=config.get('reduce_merge_fan_in', 64)
+        )
+        # Map outputs of earlier runs (None when map_cache is off)
+        self.map_cache = None
+        if config.get('map_cache', False):
+            self.map_cache = MapCache(
+                config.get('map_cache_dir', 'map_cache'),
+                config.get('map_cache_bytes', 1 << 30),
+                self.problems.fingerprint()
+            )
+        # Opt-in profile of the job's commands (None when off), see engine/profiling.py
+        self.profile = None
+        if profile or profile_jobs:
+            self.profile = profiling.Profile(
+                self.problems.user_files, config.get('profile_interval_s', profiling.DEFAULT_INTERVAL))
+
+    def profiled(self, phase, function, *args):
+        """function(*args), profiled under `phase` when the job is"""
+        if self.profile is None:
+            return function(*args)
+        return self.profile.run(phase, function, *args)
+
+    def output_path(self, index, name):
+        return os.path.normpath(os.path.join(self.output_dir, self.labels[index], name))
+
+    def close(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def in_background(self, coro):
+        task = asyncio.create_task(coro)
+        self.background.add(task)
+        task.add_done_callback(self.background.discard)
+
+async def send_to_master(msg):
+    await write_message(master_writer, msg, compressor=master_compressor)
+
+async def send_heartbeats(interval):
+    """Tell the master we are alive, even while a long task is running"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await send_to_master({"type": "heartbeat"})
+        except OSError:
+            return
+
+def map_output_path(job, task_id):
+    return os.path.abspath(os.path.join(job.work_dir, f"map_results_task_{task_id}.bin"))
+
+def map_task(job, task_id, split, previous_output=None):
+    """
+    Run one map task, or reuse the output of a lost worker if we can read it.
+    Returns the output path, a sample of its key counts (None if reused)
+    and the task's metrics.
+    """
+    timer = start_timer()
+    if previous_output and os.path.exists(previous_output):
+        print(f"[WORKER {worker_id}] Reusing output of map task {task_id} from {previous_output}")
+        job.task_outputs[task_id] = previous_output
+        return previous_output, None, dict(elapsed(timer), reused_outputs=1)
+    path = map_output_path(job, task_id)
+    if os.path.exists(path):
+        # May be a hard link into the map cache, never write through it
+        os.remove(path)
+
+    if job.map_cache:
+        cache_key = job.map_cache.key(split)
+        info = job.map_cache.get(cache_key, path)
+        if info is not None:
+            print(f"[WORKER {worker_id}] Map cache hit for task {task_id}, skipping MAP.")
+            job.task_outputs[task_id] = path
+            return path, info['sample'], dict(elapsed(timer), cache_hits=1,
+                                              output_bytes=os.path.getsize(path))
+
+    if 'row_groups' in split:
+        where = "row groups {}-{}".format(*split['row_groups'])
+    else:
+        where = f"bytes {split['start']}-{split['end']}"
+    print(f"[WORKER {worker_id}] Starting MAP task {task_id} on {where}...")
+    map_results, stats = run_map(job, split)
+    key_counts = stats.pop("key_counts", None)
+    if stats.get("row_groups_skipped"):
+        print(f"[WORKER {worker_id}] Mapped {stats['records_in']} rows, "
+              f"skipped {stats['row_groups_skipped']} row groups.")
+    else:
+        print(f"[WORKER {worker_id}] Mapped {stats['records_in']} lines.")
+
+    # Save local, one file per task
+    with RecordWriter(path, compress_level=config.get('spill_compression_level')) as writer:
+        writer.write_all(map_results)
+    job.task_outputs[task_id] = path
+
+    # Lets the master balance the reduce partitions, by record counts before combining
+    keys, other = sample_keys(map_results, config.get('partition_sample_records', 1000),
+                              counts=key_counts)
+    sample = {"keys": keys, "other": other}
+    if job.map_cache:
+        job.map_cache.put(cache_key, path, {"sample": sample})
+    metrics = dict(elapsed(timer), records_out=len(map_results),
+                   output_bytes=os.path.getsize(path), **stats)
+    return path, sample, metrics
+
+def bucket_group(job, task_ids, targets):
+    """
+    Combine the output of a group of map tasks and cut it into partitions.
+    Local partitions are stored right away, the others are returned as
+    {partition: (address, records)}, along with record counters.
+    """
+    stats = {"records_in": 0, "records_out": 0, "local_records": 0}
+    partitioner = job.partitioner
+
+    # Records of split keys stay apart per map task: the task id alone picks
+    # their part, so a task re-sent on its own after a failure goes to the
+    # same partition as in its first group, and is dropped there as a duplicate
+    grouped = []
+    split_records = {task_id: [] for task_id in task_ids}
+    for task_id in task_ids:
+        for record in read_records(job.task_outputs[task_id]):
+            stats["records_in"] += 1
+            if partitioner.is_split(record[0]):
+                split_records[task_id].append(record)
+            else:
+                grouped.append(record)
+
+    buckets = {p: [] for p in targets}
+    pieces = [(0, grouped)] + list(split_records.items())
+    for salt, records in pieces:
+        for key, value in job.problems.combine_pairs(records):
+            stats["records_out"] += 1
+            p = partitioner.partition(key, salt=salt)
+            if p in buckets:
+                buckets[p].append((key, value))
 
-incoming_shuffle_data = []
-lock = threading.Lock()
+    partitions = {}
+    for p, data_part in buckets.items():
+        owner = job.partition_table[p - 1]
+        if owner['worker_id'] == worker_id:
+            job.partition_store.stage(p, task_ids, data_part)
+            job.partition_store.commit(p, task_ids)
+            stats["local_records"] += len(data_part)
+        else:
+            # Sent even when empty, so the receiver knows the group is complete
+            partitions[p] = ((owner['ip'], owner['port']), data_part)
+    return partitions, stats
 
-def handle_peer_connection(conn, addr):
+async def shuffle_group(job, task_ids, targets=None):
+    """
+    Send the combined output of a group of map tasks to the owners of the
+    `targets` partitions (all of them by default). Returns its metrics.
+    """
+    if targets is None:
+        targets = range(1, len(job.partition_table) + 1)
+    partitions, metrics = await asyncio.to_thread(job.profiled, 'shuffle', bucket_group,
+                                                  job, task_ids, targets)
+    metrics.update(records_sent=0, send_failures=0, bytes_sent_raw=0, bytes_sent=0,
+                   bytes_sent_by_peer={})
+
+    # All peers are fed at once over pooled connections
+    start = time.perf_counter()
+    results = await send_partitions(
+        peer_pool, job.job_id, partitions, task_ids,
+        batch_size=config.get('shuffle_batch_records', 5000),
+        max_parallel=config.get('shuffle_parallelism', 8)
+    )
+    if job.profile:
+        # Runs on the event loop, out of sight of the stack samples
+        job.profile.add_section('shuffle', 'send_partitions (encode + socket I/O)',
+                                time.perf_counter() - start)
+    for p, result in results.items():
+        owner = job.partition_table[p - 1]['worker_id']
+        if isinstance(result, BaseException):
+            # The master notices the dead peer and asks for a resend
+            print(f" -> Failed to send partition {p} to Worker {owner}: {result!r}")
+            metrics["send_failures"] += 1
+        else:
+            records, raw_bytes, wire_bytes = result
+            print(f" -> Sent {records} items of partition {p} to Worker {owner}")
+            metrics["records_sent"] += records
+            metrics["bytes_sent_raw"] += raw_bytes
+            metrics["bytes_sent"] += wire_bytes
+            peer = str(owner)
+            metrics["bytes_sent_by_peer"][peer] = metrics["bytes_sent_by_peer"].get(peer, 0) + wire_bytes
+    return metrics
+
+def run_in_background(job, what, coro):
+    """
+    Run a command of the job as a background task, so the worker keeps
+    reading commands (e.g. a recover) meanwhile. Failures fail the job,
+    as in run_command.
+    """
+    async def run():
+        try:
+            await coro
+        except (OSError, ConnectionClosed) as e:
+            print(f"[WORKER {worker_id}] {what} of job {job.job_id} stopped: {e!r}")
+        except Exception as e:
+            print(f"[WORKER {worker_id}] {what} of job {job.job_id} failed: {e!r}")
+            try:
+                await send_to_master({"type": "job_error", "worker_id": worker_id,
+                                      "job_id": job.job_id, "error": repr(e)})
+            except OSError:
+                pass
+    job.in_background(run())
+
+async def shuffle_in_background(job, task_ids):
+    """Pipelined mode: push a finished map task to the reducers while the next one is mapped"""
+    async with job.shuffle_lock:
+        metrics = await shuffle_group(job, task_ids)
+        job.shuffled_groups.append(task_ids)
+    await send_to_master({"type": "task_shuffled", "worker_id": worker_id, "job_id": job.job_id,
+                          "tasks": task_ids, "metrics": metrics})
+
+async def shuffle(job, msg):
+    """Shuffle phase: send the outputs of the map tasks we won"""
+    task_ids = msg['tasks']
+    print(f"[WORKER {worker_id}] Starting SHUFFLE of {len(task_ids)} map tasks...")
+    timer = start_timer()
+    # Outputs of duplicate (losing) attempts are simply not listed
+    metrics = {}
+    async with job.shuffle_lock:
+        set_partition_table(job, msg)
+        if task_ids:
+            metrics = await shuffle_group(job, task_ids)
+            job.shuffled_groups.append(task_ids)
+    metrics.update(elapsed(timer))
+    await send_to_master({"type": "shuffle_done", "worker_id": worker_id, "job_id": job.job_id,
+                          "metrics": metrics})
+
+def set_partition_table(job, msg):
+    job.partition_table[:] = msg['partitions']
+    job.partitioner = from_spec(msg['partitioner'])
+
+async def recover(job, msg):
+    """
+    A worker died after the map phase (or during a pipelined one): take
+    over its map tasks and re-send our data of the partitions it was reducing
+    """
+    timer = start_timer()
+    metrics = {"adopted_tasks": len(msg['tasks'])}
+    # Shuffles started before finish first, with the old table (their sends
+    # to the lost worker were aborted), so their groups are re-sent below
+    # like all the others
+    async with job.shuffle_lock:
+        set_partition_table(job, msg)
+        if msg['resend']:
+            for task_ids in job.shuffled_groups:
+                add_counters(metrics, await shuffle_group(job, task_ids, msg['resend']))
+        for task in msg['tasks']:
+            await asyncio.to_thread(job.profiled, 'recovery', map_task,
+                                    job, task['task_id'], task['split'], task['output'])
+            # Receivers drop whatever part of it they already have
+            add_counters(metrics, await shuffle_group(job, [task['task_id']], msg['targets']))
+            job.shuffled_groups.append([task['task_id']])
+    metrics.update(elapsed(timer))
+    await send_to_master({"type": "recover_done", "worker_id": worker_id, "job_id": job.job_id,
+                          "metrics": metrics})
+
+def reduce_partitions(job, partitions):
+    """
+    Reduce the given partitions, streaming each one to its own output file
+    (one per module). Returns the output paths of every partition, the
+    partials of split keys and metrics.
+    """
+    timer = start_timer()
+    metrics = {"records_in": 0, "keys": 0, "records_out": 0, "spilled_runs": 0,
+               "spilled_bytes": 0, "output_bytes": 0}
+    # Keys split over several partitions are only combined here,
+    # the master collects the partials for one last reduce
+    partials = []
+    outputs = []
+    reduce = job.problems.reducer()
+    for p in partitions:
+        sorter = job.partition_store.sorter(p)
+        print(f"[WORKER {worker_id}] Starting REDUCE of partition {p} on {sorter.count} items "
+              f"({len(sorter.runs)} runs spilled to disk)...")
+        metrics["records_in"] += sorter.count
+        metrics["spilled_runs"] += len(sorter.runs)
+        metrics["spilled_bytes"] += sorter.spilled_bytes
+
+        # Sorted runs are merged and streamed one key at a time,
+        # and so are the results, straight to the output file
+        out_files = [job.output_path(i, f"reduce_results_{p}.jsonl") for i in range(len(job.labels))]
+        with contextlib.ExitStack() as stack:
+            writers = [stack.enter_context(ResultWriter(out_file)) for out_file in out_files]
+            for key, values in sorter.groups():
+                metrics["keys"] += 1
+                if job.partitioner.is_split(key):
+                    partials.append([p, key, job.problems.combine(key, list(values))])
+                    continue
+                index, own_key, res = reduce(key, values)
+                if res: writers[index].write(own_key, res)
+        job.partition_store.drop(p)
+        for writer, out_file in zip(writers, out_files):
+            metrics["records_out"] += writer.count
+            metrics["output_bytes"] += os.path.getsize(out_file)
+        outputs.append([os.path.abspath(out_file) for out_file in out_files])
+
+        print(f"[WORKER {worker_id}] REDUCE DONE! Saved to {', '.join(out_files)}")
+    metrics.update(elapsed(timer))
+    return outputs, partials, metrics
+
+def reduce_split_keys(job, keys):
+    """
+    Final reduce of keys that were split over several partitions.
+    Returns the output paths (one per module) and metrics.
+    """
+    print(f"[WORKER {worker_id}] Reducing {len(keys)} split keys...")
+    timer = start_timer()
+    out_files = [job.output_path(i, "reduce_results_split.jsonl") for i in range(len(job.labels))]
+    # The master sends the keys sorted
+    reduce = job.problems.reducer()
+    with contextlib.ExitStack() as stack:
+        writers = [stack.enter_context(ResultWriter(out_file)) for out_file in out_files]
+        for key, values in keys:
+            index, own_key, res = reduce(key, iter(values))
+            if res: writers[index].write(own_key, res)
+
+    print(f"[WORKER {worker_id}] REDUCE DONE! Saved to {', '.join(out_files)}")
+    metrics = dict(elapsed(timer), split_keys=len(keys),
+                   records_out=sum(writer.count for writer in writers),
+                   output_bytes=sum(os.path.getsize(out_file) for out_file in out_files))
+    return [os.path.abspath(out_file) for out_file in out_files], metrics
+
+def store_batch(job, msg, source):
+    job.partition_store.stage(msg['partition'], msg['tasks'], decode_records(msg['blob']), source)
+
+async def handle_peer_connection(reader, writer):
     """Receive data from other workers"""
+    addr = writer.get_extra_info('peername')
     print(f"[WORKER SERVER] Receiving data from peer {addr}")
-    buffer = ""
+    peer_connections[asyncio.current_task()] = writer
+    # Groups are staged per connection (see PartitionStore.stage)
+    source = next(connection_ids)
     try:
         while True:
-            chunk = conn.recv(4096).decode('utf-8')
-            if not chunk: break
-            buffer += chunk
-            
-        # When connection closes, store the data
-        data = json.loads(buffer)
-        with lock:
-            incoming_shuffle_data.extend(data)
-        print(f"[WORKER SERVER] Received {len(data)} items from peer.")
-        
+            # The next frame is only read once this one is stored, so a
+            # slow receiver pushes back on the sender through TCP
+            msg = await read_message(reader)
+            if msg is None: break
+            # Data of a job that is over (or unknown) is dropped
+            job = jobs.get(msg.get('job_id'))
+            if msg['type'] == 'hello':
+                # The sender compresses with a codec from this list
+                await write_message(writer, {"type": "hello", "codecs": available_codecs()})
+            elif msg['type'] == 'shuffle_data':
+                if job is not None:
+                    async with peer_slots:
+                        await asyncio.to_thread(job.profiled, 'shuffle (receive)', store_batch,
+                                                job, msg, source)
+            elif msg['type'] == 'shuffle_commit':
+                # Merging the group into its partition may spill, off the event loop
+                if job is not None and not await asyncio.to_thread(
+                        job.partition_store.commit, msg['partition'], msg['tasks'], source):
+                    print(f"[WORKER SERVER] Dropped duplicate data of tasks {msg['tasks']}")
+            elif msg['type'] == 'shuffle_flush':
+                # Everything before the flush is stored, let the sender go on
+                await write_message(writer, {"type": "shuffle_ack"})
+
     except Exception as e:
-        print(f"[WORKER SERVER] Error receiving data: {e}")
+        print(f"[WORKER SERVER] Error receiving data: {e!r}")
     finally:
-        conn.close()
-
-def start_worker_server(my_ip, my_port):
-    """Listen for incoming worker connections"""
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((my_ip, my_port))
-    server.listen()
-    
-    while True:
-        conn, addr = server.accept()
-        t = threading.Thread(target=handle_peer_connection, args=(conn, addr))
-        t.start()
+        writer.close()
+        peer_connections.pop(asyncio.current_task(), None)
 
-def start_worker(worker_id, problem_module="user_app", extra_args=None):
-    load_problem_module(problem_module, extra_args)
-    config = load_config()
-    my_config = config['worker_nodes'][worker_id - 1]
-    
-    server_thread = threading.Thread(
-        target=start_worker_server, 
-        args=(my_config['ip'], my_config['port']),
-        daemon=True
+async def run_command(job, msg):
+    """Run one command of a job and report back to the master"""
+    reply = {"worker_id": worker_id, "job_id": job.job_id}
+
+    if msg['type'] == 'map_task':
+        task_id = msg['task_id']
+        output, sample, metrics = await asyncio.to_thread(
+            job.profiled, 'map', map_task, job, task_id, msg['split'], msg.get('output'))
+        await send_to_master(dict(reply, type="map_done", task_id=task_id,
+                                  output=output, sample=sample, metrics=metrics))
+
+    elif msg['type'] == 'map_accepted':
+        # Pipelined mode: our attempt won, push it to the reducers while we map on
+        run_in_background(job, f"Shuffle of map task {msg['task_id']}",
+                          shuffle_in_background(job, [msg['task_id']]))
+
+    elif msg['type'] == 'map_discarded':
+        # A backup attempt finished first, this output is never shuffled
+        job.task_outputs.pop(msg['task_id'], None)
+
+    elif msg['type'] == 'start_pipeline':
+        # Partitions are fixed before the map phase, see pipelined mode in master.py
+        set_partition_table(job, msg)
+        peer_pool.revive((owner['ip'], owner['port']) for owner in msg['partitions'])
+        job.pipelined = True
+
+    elif msg['type'] == 'start_shuffle':
+        peer_pool.revive((owner['ip'], owner['port']) for owner in msg['partitions'])
+        run_in_background(job, "Shuffle", shuffle(job, msg))
+
+    elif msg['type'] == 'recover':
+        # Sends to the lost worker fail now rather than after shuffle_timeout
+        lost = msg['lost']
+        peer_pool.abort((lost['ip'], lost['port']))
+        print(f"[WORKER {worker_id}] RECOVERY from Worker {lost['worker_id']}: adopting "
+              f"{len(msg['tasks'])} map tasks, re-sending partitions {msg['resend']}...")
+        run_in_background(job, "Recovery", recover(job, msg))
+
+    # C. REDUCE PHASE
+    elif msg['type'] == 'start_reduce':
+        outputs, partials, metrics = await asyncio.to_thread(
+            job.profiled, 'reduce', reduce_partitions, job, msg['partitions'])
+        await send_to_master(dict(reply, type="reduce_done", partitions=msg['partitions'],
+                                  outputs=outputs, partials=partials, metrics=metrics))
+
+    elif msg['type'] == 'reduce_split':
+        outputs, metrics = await asyncio.to_thread(
+            job.profiled, 'reduce', reduce_split_keys, job, msg['keys'])
+        await send_to_master(dict(reply, type="split_done", outputs=outputs, metrics=metrics))
+
+    elif msg['type'] == 'profile_report':
+        # The job's work is done: keep this worker's profile next to the
+        # results and send it to the master for the merged report
+        data = job.profile.data if job.profile else profiling.new_profile()
+        path = os.path.abspath(os.path.join(job.output_dir, 'profile', f"worker_{worker_id}.json"))
+        await asyncio.to_thread(profiling.write, data, path)
+        print(f"[WORKER {worker_id}] Profile written to {path}")
+        await send_to_master(dict(reply, type="profile_done", path=path, profile=data))
+
+async def run_worker(my_config):
+    """Event loop of a worker: peer server, master connection and heartbeats"""
+    global master_writer, master_compressor, peer_pool, peer_slots
+    peer_pool = PeerPool(timeout=config.get('shuffle_timeout', 30), config=config)
+    peer_slots = asyncio.Semaphore(config.get('peer_concurrency', 4))
+    server = await asyncio.start_server(
+        handle_peer_connection, my_config['ip'], my_config['port'],
+        backlog=config.get('listen_backlog', 1024), reuse_address=True
     )
-    server_thread.start()
-    
-    print(f"[WORKER {worker_id}] Listening for peers on {my_config['port']}...")
+    # Port 0: the OS picked one, and the master learns it from the register
+    my_config = dict(my_config, port=server.sockets[0].getsockname()[1])
+
+    print(f"[WORKER {worker_id or ''}] Listening for peers on {my_config['port']}...")
     print(f"[WORKER {worker_id}] Connecting to Master...")
-    client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client.connect((config['master_node']['ip'], config['master_node']['port']))
-    reg_msg = json.dumps({"type": "register", "worker_id": worker_id, "address": my_config})
-    client.send(reg_msg.encode('utf-8'))
-    
-    buffer = ""
+    reader, master_writer = await asyncio.open_connection(
+        config['master_node']['ip'], config['master_node']['port'])
+    # The master runs these modules when it only runs one job (master.py --auto)
+    await send_to_master({"type": "register", "worker_id": worker_id, "address": my_config,
+                          "pid": os.getpid(), "problems": default_problems,
+                          "codecs": available_codecs()})
+    heartbeats = asyncio.create_task(send_heartbeats(config.get('heartbeat_interval', 1.0)))
+
+    # Commands are handled one at a time; CPU-heavy work runs in a thread,
+    # so heartbeats and incoming shuffle data are served meanwhile. Shuffles
+    # and recoveries run in the background, so a recover is read at once.
     while True:
         try:
-            chunk = client.recv(4096 * 10).decode('utf-8')
-            if not chunk: break
-            buffer += chunk
-            
-            try:
-                while "{" in buffer and "}" in buffer:
-                    start = buffer.find("{")
-                    try:
-                        msg = json.loads(buffer)
-                        buffer = "" 
-                    except:
-                        break
-
-                    if msg['type'] == 'map_task':
-                        data_lines = msg['data']
-                        print(f"[WORKER {worker_id}] Starting MAP on {len(data_lines)} lines...")
-                        map_results = []
-                        for line in data_lines:
-                            map_results.extend(map_function(line))
-                        
-                        # Save local
-                        with open(f"map_results_{worker_id}.json", 'w') as f:
-                            json.dump(map_results, f)
-                        
-                        client.send(json.dumps({"type": "map_done", "worker_id": worker_id}).encode('utf-8'))
-                    elif msg['type'] == 'start_shuffle':
-                        all_workers = msg['workers']
-                        print(f"[WORKER {worker_id}] Starting SHUFFLE...")
-                        
-                        with open(f"map_results_{worker_id}.json", 'r') as f:
-                            my_data = json.load(f)
-                        buckets = {wid: [] for wid in range(1, len(all_workers) + 1)}
-                        for key, value in my_data:
-                            hash_val = int(hashlib.md5(key.encode()).hexdigest(), 16)
-                            target_id = (hash_val % len(all_workers)) + 1
-                            buckets[target_id].append((key, value))
-                        for target_id, data_part in buckets.items():
-                            if target_id == worker_id:
-                                with lock:
-                                    incoming_shuffle_data.extend(data_part)
-                            else:
-                                # If for another, connect and send
-                                target_info = config['worker_nodes'][target_id - 1]
-                                try:
-                                    p_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                                    p_sock.connect((target_info['ip'], target_info['port']))
-                                    p_sock.send(json.dumps(data_part).encode('utf-8'))
-                                    p_sock.close()
-                                    print(f" -> Sent {len(data_part)} items to Worker {target_id}")
-                                except Exception as e:
-                                    print(f" -> Failed to send to Worker {target_id}: {e}")
-
-                        client.send(json.dumps({"type": "shuffle_done", "worker_id": worker_id}).encode('utf-8'))
-
-                    # C. REDUCE PHASE
-                    elif msg['type'] == 'start_reduce':
-                        print(f"[WORKER {worker_id}] Starting REDUCE on {len(incoming_shuffle_data)} items...")
-                        
-                        # Group by Key locally
-                        grouped = {}
-                        for key, val in incoming_shuffle_data:
-                            if key not in grouped: grouped[key] = []
-                            grouped[key].append(val)
-                            
-                        # Run User Reduce Function
-                        final_results = []
-                        for key, values in grouped.items():
-                            res = reduce_function(key, values)
-                            if res: final_results.append(res)
-                            
-                        # Save Final Output
-                        out_file = f"reduce_results_{worker_id}.json"
-                        with open(out_file, 'w') as f:
-                            json.dump(final_results, f, indent=2)
-                            
-                        print(f"[WORKER {worker_id}] REDUCE DONE! Saved to {out_file}")
-                        client.send(json.dumps({"type": "reduce_done", "worker_id": worker_id}).encode('utf-8'))
-
-            except json.JSONDecodeError:
-                continue
-                
+            msg = await read_message(reader)
+            if msg is None: break
+
+            if msg['type'] == 'welcome':
+                # The master lists the codecs it decodes, and gives a worker
+                # without an id (or with one already taken) a free one
+                master_compressor = negotiate(config, msg['codecs'])
+                if msg['worker_id'] != worker_id:
+                    set_worker_id(msg['worker_id'])
+                    print(f"[WORKER {worker_id}] Registered as worker {worker_id}")
+
+            elif msg['type'] == 'job_start':
+                # Modules stay loaded between jobs, only the job state is new
+                reply = {"type": "job_ready", "worker_id": worker_id, "job_id": msg['job_id']}
+                try:
+                    if msg.get('storage'):
+                        check_markers(msg['storage'], {"work_dir": config.get('work_dir', 'work'),
+                                                       "output_dir": msg['output_dir']})
+                    job = await asyncio.to_thread(JobState, msg['job_id'], msg['problems'],
+                                                  msg['output_dir'], msg.get('profile', False))
+                except Exception as e:
+                    print(f"[WORKER {worker_id}] Cannot start job {msg['job_id']}: {e!r}")
+                    await send_to_master(dict(reply, error=repr(e)))
+                    continue
+                jobs[job.job_id] = job
+                await send_to_master(dict(reply, combiner=job.problems.can_combine,
+                                          columnar=job.problems.columnar,
+                                          profile=job.profile is not None))
+
+            elif msg['type'] == 'job_end':
+                job = jobs.pop(msg['job_id'], None)
+                if job is not None:
+                    for task in list(job.background):
+                        task.cancel()
+                    await asyncio.to_thread(job.close)
+
+            else:
+                job = jobs.get(msg.get('job_id'))
+                if job is None:
+                    print(f"[WORKER {worker_id}] Ignoring {msg['type']} of unknown job {msg.get('job_id')}")
+                    continue
+                try:
+                    await run_command(job, msg)
+                except (OSError, ConnectionClosed):
+                    raise
+                except Exception as e:
+                    # A failing problem module fails its job, not the worker
+                    print(f"[WORKER {worker_id}] {msg['type']} of job {job.job_id} failed: {e!r}")
+                    await send_to_master({"type": "job_error", "worker_id": worker_id,
+                                          "job_id": job.job_id, "error": repr(e)})
+
         except Exception as e:
-            print(f"Connection Error: {e}")
+            print(f"Connection Error: {e!r}")
             break
 
+    heartbeats.cancel()
+    peer_pool.close_all()
+    server.close()
+    # Let the peer handlers see the close and return
+    for writer in peer_connections.values():
+        writer.close()
+    if peer_connections:
+        await asyncio.wait(list(peer_connections), timeout=1)
+
+def set_worker_id(my_id):
+    global worker_id, worker_dir
+    worker_id = my_id
+    worker_dir = os.path.join(config.get('work_dir', 'work'), f"worker_{worker_id}")
+    os.makedirs(worker_dir, exist_ok=True)
+
+def node_config(my_id):
+    """This worker's worker_nodes entry, or any free port for a worker outside config.json"""
+    for node in config['worker_nodes']:
+        if node.get('id') == my_id:
+            return node
+    return {"ip": config.get('worker_host', config['master_node']['ip']), "port": 0}
+
+def start_worker(my_id=None, problems=None, profile=False):
+    """Run a worker; my_id None lets the master pick its id when it registers"""
+    global worker_id, config, default_problems, profile_jobs
+    global map_pool, map_parallelism, map_batch_bytes, reduce_memory
+    worker_id = my_id
+    profile_jobs = profile
+    # Loaded right away, so the first job does not wait for the import
+    default_problems = problems or [(PROBLEM_MODULE, [])]
+    load_problem_set(default_problems)
+    config = load_config()
+    my_config = node_config(my_id)
+    reduce_memory = MemoryBudget(config.get('reduce_memory_records', 100000))
+
+    map_batch_bytes = config.get('map_batch_bytes', map_batch_bytes)
+
+    # One worker per node can use every core for the map phase
+    map_parallelism = my_config.get('map_parallelism', config.get('map_parallelism', 1))
+    if map_parallelism == 0:
+        map_parallelism = os.cpu_count() or 1
+    if map_parallelism > 1:
+        map_pool = ProcessPoolExecutor(
+            max_workers=map_parallelism,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=_init_map_process,
+            initargs=(default_problems, map_batch_bytes)
+        )
+        print(f"[WORKER {worker_id or ''}] Map phase runs on {map_parallelism} processes")
+
+    if worker_id is not None:
+        set_worker_id(worker_id)
+    if config.get('map_cache', False):
+        print(f"[WORKER {worker_id or ''}] Map output cache in {config.get('map_cache_dir', 'map_cache')}")
+    if profile_jobs:
+        print(f"[WORKER {worker_id or ''}] Profiling every job (engine/profiling.py)")
+
+    asyncio.run(run_worker(my_config))
+
 if __name__ == "__main__":
-    # Usage: python worker.py <worker_id> [problem_module] [--options]
+    # Usage: python worker.py <worker_id|auto> [--profile] [problem_module] [--options] [+ problem_module [--options] ...]
     # Examples:
     #   python worker.py 1                              -> runs with user_app (problem 1)
     #   python worker.py 1 user_app                     -> runs with user_app (problem 1)
     #   python worker.py 1 user_app_problem2            -> runs with user_app_problem2 (problem 2)
     #   python worker.py 1 user_app_problem2 --all      -> problem 2 with all features
     #   python worker.py 1 user_app_problem2 --popularity --top-artists  -> specific features
-    
-    worker_id = int(sys.argv[1])
-    problem_module = sys.argv[2] if len(sys.argv) > 2 and not sys.argv[2].startswith('--') else "user_app"
-    
-    # Collect extra arguments (--flags)
-    extra_args = [arg for arg in sys.argv[2:] if arg.startswith('--')]
-    
-    start_worker(worker_id, problem_module, extra_args)
+    #   python worker.py 1 user_app + user_app_problem2 --all  -> both, over one scan of the input
+    #   python worker.py auto                           -> joins with an id from the master, any free port
+    #   python worker.py 1 --profile                    -> profiles every job it runs (engine/profiling.py)
+    # The module is what `master.py --auto` runs; a `master.py --serve` cluster
+    # runs whatever is submitted with engine/submit.py, on the same workers.
+    # A worker id without an entry in config.json worker_nodes also takes any free port.
+
+    worker_id = None if sys.argv[1] == 'auto' else int(sys.argv[1])
+    # Module names, each with its extra arguments (--flags)
+    problems = parse_problems([arg for arg in sys.argv[2:] if arg != '--profile'], default=PROBLEM_MODULE)
+
+    start_worker(worker_id, problems, profile='--profile' in sys.argv[2:])
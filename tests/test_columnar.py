@@ -0,0 +1,94 @@
+"""
+Columnar copy of a CSV dataset (engine/columnar.py).
+
+    python -m pytest tests/test_columnar.py
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.columnar import (ColumnReader, compute_splits, decode_chunk, encode_chunk, ingest,
+                             is_fresh, may_match, split_digest)
+
+
+def test_int_chunks_use_the_narrowest_type():
+    for values, kind in ((["1", "-5", "100"], "int:b"), (["300", "0"], "int:h"),
+                         (["70000"], "int:i"), (["-9000000000", "1"], "int:q")):
+        chunk_kind, data, low, high = encode_chunk(values)
+        assert chunk_kind == kind
+        assert (low, high) == (min(map(int, values)), max(map(int, values)))
+        assert decode_chunk(chunk_kind, data) == list(map(int, values))
+    # Swapped bytes of another machine
+    kind, data, _, _ = encode_chunk(["300", "-2"])
+    swapped = "big" if sys.byteorder == "little" else "little"
+    assert decode_chunk(kind, data[1::-1] + data[3:1:-1], swapped) == [300, -2]
+
+
+def test_text_chunks():
+    # Not plain integers: leading zeros, signs, spaces, too big for 64 bits
+    values = ["007", "+1", " 2", str(1 << 64), "Björk", ""]
+    kind, data, low, high = encode_chunk(values)
+    assert kind == "str" and (low, high) == (min(values), max(values))
+    assert decode_chunk(kind, data) == values
+    kind, data, _, _ = encode_chunk(["a\0b", "c"])
+    assert kind == "json"
+    assert decode_chunk(kind, data) == ["a\0b", "c"]
+
+
+def test_may_match():
+    group = {"columns": [{"type": "int:h", "min": 10, "max": 20},
+                         {"type": "str", "min": "a", "max": "z"}]}
+    assert may_match(group, None)
+    assert may_match(group, {0: (15, 30)})
+    assert may_match(group, {"0": (None, 10)})
+    assert not may_match(group, {0: (21, None)})
+    assert not may_match(group, {0: (0, 9)})
+    # Text chunks are never pruned
+    assert may_match(group, {1: (0, 1)})
+
+
+def write_csv(path, rows):
+    path.write_text("\n".join(",".join(row) for row in rows) + "\n")
+
+
+def test_ingest_and_read(tmp_path):
+    csv_path = tmp_path / "data.csv"
+    # The "name" column holds only integers in its first row group
+    rows = [["id", "name", "plays"]]
+    rows += [[str(i), str(100 + i), str(i * 10)] for i in range(4)]
+    rows += [["4", "short"]]
+    rows += [[str(i), f"n{i}", str(i * 10), "extra"] for i in range(5, 9)]
+    write_csv(csv_path, rows)
+    dest = str(tmp_path / "columns")
+    manifest = ingest(str(csv_path), dest, row_group_rows=4)
+    assert is_fresh(dest, str(csv_path))
+    assert manifest["rows"] == 8
+    assert manifest["column_types"] == ["int", "str", "int"]
+
+    with ColumnReader(dest) as reader:
+        first, second = reader.row_groups({"row_groups": [0, 2]})
+        assert reader.read(first, [0, 1, 2]) == {0: [0, 1, 2, 3], 1: ["100", "101", "102", "103"],
+                                                 2: [0, 10, 20, 30]}
+        assert reader.read(second, [1]) == {1: ["n5", "n6", "n7", "n8"]}
+        assert may_match(first, {2: (0, 30)}) and not may_match(second, {2: (0, 30)})
+
+    splits = compute_splits(dest, 5)
+    assert [split["row_groups"] for split in splits] == [[0, 1], [1, 2]]
+    assert split_digest(splits[0]) != split_digest(splits[1])
+
+    # A changed CSV needs a new copy
+    rows[1][2] = "999"
+    write_csv(csv_path, rows + [["9", "n9", "90"]])
+    assert not is_fresh(dest, str(csv_path))
+
+
+def test_ingest_sorted(tmp_path):
+    csv_path = tmp_path / "data.csv"
+    write_csv(csv_path, [["id", "plays"]] + [[str(i), str((i * 7) % 10)] for i in range(10)])
+    dest = str(tmp_path / "columns")
+    manifest = ingest(str(csv_path), dest, row_group_rows=5, sort_by="plays")
+    assert [chunk["columns"][1]["max"] for chunk in manifest["row_groups"]] == [4, 9]
+    with ColumnReader(dest) as reader:
+        group = reader.row_groups({"row_groups": [0, 1]})[0]
+        assert reader.read(group, [1]) == {1: [0, 1, 2, 3, 4]}
@@ -0,0 +1,58 @@
+"""
+Map-side combiners of the apps and the worker's combine step.
+
+    python -m pytest tests/test_combiner.py
+"""
+
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.worker import combine_pairs, load_problem_module
+
+GENRES = ["pop", "rock", "R&B", "Dance/Electronic"]
+
+
+def dataset_lines(n):
+    rng = random.Random(n)
+    lines = []
+    for i in range(n):
+        # Skewed artists, so top_artist is never a tie that depends on order
+        artist = f"Artist {min(int(rng.expovariate(0.3)), 20)}"
+        lines.append(f'{artist},"Song, {i}",{rng.randint(100000, 300000)},{rng.choice(["True", "False"])},'
+                     f'{rng.randint(1985, 2025)},{rng.randint(0, 100)},0.5,0.6,1,-5.0,0,0.05,0.3,0,0.3,0.9,95.0,'
+                     f'{rng.choice(GENRES)}\n')
+    return lines
+
+
+def reduce_all(module, pairs):
+    grouped = {}
+    for key, value in pairs:
+        grouped.setdefault(key, []).append(value)
+    return {key: module.reduce_function(key, values) for key, values in grouped.items()}
+
+
+@pytest.mark.parametrize("name, args", [("user_app", []), ("user_app_problem2", []),
+                                        ("user_app_problem2", ["--popularity"])])
+def test_combining_does_not_change_the_results(name, args):
+    module = load_problem_module(name, args)
+    pairs = [pair for line in dataset_lines(3000) for pair in module.map_function(line)]
+    expected = reduce_all(module, pairs)
+    assert expected
+
+    # Combined per map task, and once more (as a split key's partials are)
+    combined = []
+    for start in range(0, len(pairs), 700):
+        combined.extend(combine_pairs(pairs[start:start + 700], module.combine_function))
+    assert len(combined) < len(pairs)
+    assert reduce_all(module, combined) == expected
+    assert reduce_all(module, combine_pairs(combined, module.combine_function)) == expected
+
+
+def test_combine_pairs_without_a_combiner():
+    pairs = [("a", 1), ("b", 2), ("a", 3)]
+    assert combine_pairs(pairs, None) is pairs
+    assert combine_pairs(pairs, lambda key, values: sum(values)) == [("a", 4), ("b", 2)]
@@ -0,0 +1,75 @@
+"""
+Adaptive payload compression (engine/compression.py).
+
+    python -m pytest tests/test_compression.py
+"""
+
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.compression import CODECS, AdaptiveCompressor, available_codecs, decompress, negotiate
+
+TEXT = b"artist,track,plays\n" * 1000
+# Rows that higher levels compress better than level 1
+ROWS = "".join(f"{random.Random(i).choice(['a', 'b', 'c'])}rtist{i % 97},track{i % 1013},{i * 7919 % 10007}\n"
+               for i in range(5000)).encode()
+
+
+@pytest.mark.parametrize("codec", available_codecs())
+def test_round_trip(codec):
+    compressor = AdaptiveCompressor(codec)
+    out = compressor.compress(TEXT)
+    assert out[0] == CODECS[codec][0]
+    assert decompress(out) == TEXT
+    assert compressor.counters()["compressed"] == 1
+
+
+def test_small_and_incompressible_payloads_are_sent_raw():
+    compressor = AdaptiveCompressor(min_bytes=4096)
+    assert compressor.compress(b"x" * 100) is None
+    assert compressor.compress(os.urandom(10000)) is None
+    assert not compressor.enabled
+    counters = compressor.counters()
+    assert counters["skipped"] == 2 and counters["level"] is None
+    assert counters["raw_bytes"] == counters["wire_bytes"] == 10100
+
+
+def test_unknown_codec_id():
+    with pytest.raises(ValueError):
+        decompress(b"\x7f" + TEXT)
+
+
+def test_level_follows_the_link():
+    # A slow link: spending CPU on smaller payloads pays, the level goes up
+    slow = AdaptiveCompressor()
+    for _ in range(64):
+        slow.compress(ROWS)
+        slow.observe_send(1000, 1.0)
+    assert slow.level > slow.min_level
+    # A link much faster than compressing: back to raw bytes
+    fast = AdaptiveCompressor()
+    for _ in range(64):
+        fast.compress(TEXT)
+        fast.observe_send(10 ** 12, 1e-3)
+    assert not fast.enabled
+    # A fixed level never moves
+    fixed = AdaptiveCompressor(level=3)
+    for _ in range(64):
+        fixed.compress(TEXT)
+        fixed.observe_send(1000, 1.0)
+    assert fixed.level == 3
+
+
+def test_negotiate():
+    assert negotiate({"compression": "zlib"}, ["zlib"]).codec == "zlib"
+    assert negotiate({}, ["zlib"]).codec == "zlib"
+    # The receiver cannot decode it, or compression is off
+    assert negotiate({"compression": "zlib"}, ["lzma"]) is None
+    assert negotiate({"compression": "zlib"}, None) is None
+    assert negotiate({"compression": None}, ["zlib"]) is None
+    compressor = negotiate({"compression_min_bytes": 10, "compression_level": 9}, ["zlib"])
+    assert compressor.min_bytes == 10 and compressor.level == 9 and compressor.fixed
@@ -0,0 +1,93 @@
+"""
+External sort-merge grouping (engine/extsort.py).
+
+    python -m pytest tests/test_extsort.py
+"""
+
+import os
+import random
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.extsort import ExternalSorter, MemoryBudget
+
+
+def grouped(sorter):
+    return [(key, sorted(values)) for key, values in sorter.groups()]
+
+
+def expected_groups(pairs):
+    groups = {}
+    for key, value in pairs:
+        groups.setdefault(key, []).append(value)
+    return sorted((key, sorted(values)) for key, values in groups.items())
+
+
+def shuffled_pairs(n, keys):
+    pairs = [(f"key{i % keys:04d}", i) for i in range(n)]
+    random.Random(n).shuffle(pairs)
+    return pairs
+
+
+def test_spills_and_merges_in_key_order(tmp_path):
+    sorter = ExternalSorter(str(tmp_path), max_records=100, compress_level=1)
+    pairs = shuffled_pairs(1000, 37)
+    for start in range(0, len(pairs), 30):
+        sorter.extend(pairs[start:start + 30])
+    assert sorter.runs and sorter.count == 1000
+    assert grouped(sorter) == expected_groups(pairs)
+    sorter.cleanup()
+    assert os.listdir(tmp_path) == []
+
+
+def test_many_runs_are_merged_in_passes(tmp_path):
+    sorter = ExternalSorter(str(tmp_path), max_records=10, merge_fan_in=4)
+    pairs = shuffled_pairs(500, 23)
+    for pair in pairs:
+        sorter.add(*pair)
+    assert len(sorter.runs) > 16
+    assert grouped(sorter) == expected_groups(pairs)
+    # Every merge pass left one run in place of merge_fan_in
+    assert len(sorter.runs) < 4
+    assert len(os.listdir(tmp_path)) == len(sorter.runs)
+
+
+def test_combine_instead_of_spill(tmp_path):
+    sorter = ExternalSorter(str(tmp_path), max_records=100, combine=lambda key, values: sum(values))
+    pairs = shuffled_pairs(5000, 10)
+    for start in range(0, len(pairs), 50):
+        sorter.extend(pairs[start:start + 50])
+    # Ten keys always combine to well under half the budget
+    assert sorter.runs == []
+    assert [(key, sum(values)) for key, values in sorter.groups()] == \
+        [(key, sum(values)) for key, values in expected_groups(pairs)]
+
+
+def test_shared_budget_empties_the_largest_buffer(tmp_path):
+    budget = MemoryBudget(100)
+    big = ExternalSorter(str(tmp_path), prefix="big", budget=budget)
+    small = ExternalSorter(str(tmp_path), prefix="small", budget=budget)
+    small.extend(shuffled_pairs(20, 20))
+    big.extend(shuffled_pairs(70, 70))
+    assert big.runs == [] and small.runs == []
+    big.extend(shuffled_pairs(20, 20))
+    assert len(big.runs) == 1 and big.buffer == []
+    assert small.runs == [] and len(small.buffer) == 20
+    assert budget.used == 20
+
+    small.cleanup()
+    assert budget.used == 0 and small not in budget.sorters
+    assert len(grouped(big)) == 70
+
+
+def test_absorb(tmp_path):
+    budget = MemoryBudget(50)
+    target = ExternalSorter(str(tmp_path), prefix="target", budget=budget)
+    staged = ExternalSorter(str(tmp_path), prefix="staged", budget=budget)
+    first, second = shuffled_pairs(80, 30), shuffled_pairs(40, 15)
+    target.extend(first)
+    staged.extend(second)
+    target.absorb(staged)
+    assert staged.count == 0 and staged not in budget.sorters
+    assert target.count == 120
+    assert grouped(target) == expected_groups(first + second)
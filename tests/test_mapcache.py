@@ -0,0 +1,83 @@
+"""
+Map output cache (engine/mapcache.py).
+
+    python -m pytest tests/test_mapcache.py
+"""
+
+import importlib.util
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.mapcache import MapCache, module_fingerprint
+
+
+def load_module(path, source):
+    path.write_text(source)
+    spec = importlib.util.spec_from_file_location(path.stem, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def test_fingerprint(tmp_path):
+    module = load_module(tmp_path / "app.py", "LIMIT = 10\n\ndef map_function(line):\n    return []\n")
+    fingerprint = module_fingerprint(module)
+    assert module_fingerprint(module) == fingerprint
+    assert module_fingerprint(module, ["--popularity"]) != fingerprint
+    # configure_features() changing a constant changes the fingerprint
+    module.LIMIT = 20
+    assert module_fingerprint(module) != fingerprint
+    module.LIMIT = 10
+    assert module_fingerprint(module) == fingerprint
+    other = load_module(tmp_path / "app2.py", "LIMIT = 10\n\ndef map_function(line):\n    return [1]\n")
+    assert module_fingerprint(other) != fingerprint
+
+
+def test_key_is_the_split_content(tmp_path):
+    data = tmp_path / "input.csv"
+    data.write_bytes(b"header\nrow a\nrow b\nrow a\nrow b\n")
+    cache = MapCache(str(tmp_path / "cache"), 1 << 20, "fp")
+    first = cache.key({"path": str(data), "start": 7, "end": 19})
+    # The same rows elsewhere in the file (or in another one) hit
+    assert cache.key({"path": str(data), "start": 19, "end": 31}) == first
+    assert cache.key({"path": str(data), "start": 7, "end": 13}) != first
+    assert MapCache(str(tmp_path / "cache"), 1 << 20, "other").key(
+        {"path": str(data), "start": 7, "end": 19}) != first
+
+
+def test_hit_is_a_hard_link(tmp_path):
+    cache = MapCache(str(tmp_path / "cache"), 1 << 20, "fp")
+    output = tmp_path / "map_0.bin"
+    output.write_bytes(b"records")
+    assert cache.get("k", str(tmp_path / "miss.bin")) is None
+    cache.put("k", str(output), {"samples": {"a": 1}})
+
+    dest = tmp_path / "work" / "map_7.bin"
+    dest.parent.mkdir()
+    dest.write_bytes(b"stale output")
+    assert cache.get("k", str(dest)) == {"samples": {"a": 1}}
+    assert dest.read_bytes() == b"records"
+    assert os.stat(dest).st_ino == os.stat(cache._paths("k")[0]).st_ino
+    # Replacing the job's output leaves the entry alone
+    os.remove(output)
+    os.remove(dest)
+    assert cache.get("k", str(dest)) == {"samples": {"a": 1}}
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = MapCache(str(tmp_path / "cache"), 250, "fp")
+    output = tmp_path / "map.bin"
+    for i, key in enumerate(("a", "b")):
+        output.write_bytes(b"x" * 100)
+        cache.put(key, str(output), {})
+        os.remove(output)
+        os.utime(cache._paths(key)[0], (1000 + i, 1000 + i))
+    # "a" is older, but a hit makes it the most recently used
+    assert cache.get("a", str(tmp_path / "hit.bin")) == {}
+    output.write_bytes(b"x" * 100)
+    cache.put("c", str(output), {})
+    assert cache.get("b", str(tmp_path / "b.bin")) is None
+    assert not os.path.exists(cache._paths("b")[1])
+    assert cache.get("a", str(tmp_path / "a.bin")) == {}
+    assert cache.get("c", str(tmp_path / "c.bin")) == {}
@@ -0,0 +1,62 @@
+"""
+Reduce output files (engine/output.py).
+
+    python -m pytest tests/test_output.py
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.output import ResultWriter, merge_results, output_labels
+
+
+def write_results(path, results):
+    with ResultWriter(str(path)) as writer:
+        for key, value in results:
+            writer.write(key, value)
+    return str(path)
+
+
+def test_result_file_appears_only_when_complete(tmp_path):
+    path = tmp_path / "part_1.jsonl"
+    with ResultWriter(str(path)) as writer:
+        writer.write("a", {"total": 1})
+        assert not path.exists()
+    assert writer.count == 1
+    assert [json.loads(line) for line in path.read_text().splitlines()] == \
+        [{"key": "a", "value": {"total": 1}}]
+
+    with pytest.raises(RuntimeError):
+        with ResultWriter(str(tmp_path / "part_2.jsonl")) as writer:
+            writer.write("a", 1)
+            raise RuntimeError("reducer failed")
+    assert sorted(os.listdir(tmp_path)) == ["part_1.jsonl"]
+
+
+def test_merge_results(tmp_path):
+    paths = [
+        write_results(tmp_path / "part_1.jsonl", [("a", 1), ("d", 4), ("x", 9)]),
+        write_results(tmp_path / "part_2.jsonl", []),
+        write_results(tmp_path / "part_3.jsonl", [("b", {"n": 2}), ("c", [3]), ("é", 5)]),
+    ]
+    # A partition file without the last newline
+    (tmp_path / "part_4.jsonl").write_text('{"key": "c0", "value": 0}')
+    paths.append(str(tmp_path / "part_4.jsonl"))
+
+    dest = tmp_path / "results.jsonl"
+    assert merge_results(paths, str(dest)) == 7
+    results = [json.loads(line) for line in dest.read_text(encoding="utf-8").splitlines()]
+    assert [r["key"] for r in results] == ["a", "b", "c", "c0", "d", "x", "é"]
+    assert results[1]["value"] == {"n": 2}
+    assert not os.path.exists(f"{dest}.tmp")
+
+
+def test_output_labels():
+    assert output_labels([("user_app", [])]) == ['']
+    assert output_labels([("user_app", []), ("problem2", [])]) == ["user_app", "problem2"]
+    assert output_labels([("problem2", []), ("problem2", ["--popularity"])]) == \
+        ["problem2_0", "problem2_1"]
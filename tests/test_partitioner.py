@@ -0,0 +1,64 @@
+"""
+Reduce partitioners (engine/partitioner.py).
+
+    python -m pytest tests/test_partitioner.py
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.partitioner import (BalancedPartitioner, HashPartitioner, build_balanced, from_spec,
+                                sample_keys, stable_hash)
+
+
+def test_hash_partitioner():
+    partitioner = HashPartitioner(4)
+    partitions = {partitioner.partition(f"key{i}") for i in range(1000)}
+    assert partitions == {1, 2, 3, 4}
+    assert partitioner.partition("key7") == stable_hash("key7") % 4 + 1
+    assert not partitioner.is_split("key7")
+
+
+def test_spec_round_trip():
+    balanced = BalancedPartitioner(3, {"a": 2}, {"hot": [1, 3]})
+    for partitioner in (HashPartitioner(5), balanced):
+        rebuilt = from_spec(partitioner.to_spec())
+        assert type(rebuilt) is type(partitioner)
+        assert rebuilt.to_spec() == partitioner.to_spec()
+    rebuilt = from_spec(balanced.to_spec())
+    assert rebuilt.partition("a") == 2
+    assert rebuilt.is_split("hot") and not rebuilt.is_split("a")
+    assert [rebuilt.partition("hot", salt) for salt in range(4)] == [1, 3, 1, 3]
+    assert rebuilt.partition("cold") == HashPartitioner(3).partition("cold")
+
+
+def test_sample_keys():
+    pairs = [("hot", 1)] * 9000 + [(f"k{i}", 1) for i in range(1000)]
+    weights, other = sample_keys(pairs, sample_size=1000, max_keys=1)
+    assert list(weights) == ["hot"]
+    assert abs(weights["hot"] - 9000) <= 10
+    assert abs(other - 1000) <= 10
+    # Counts from before the combiner win over the (combined) pairs
+    weights, other = sample_keys([("hot", 9000), ("k", 1)], max_keys=1, counts={"hot": 9000, "k": 1})
+    assert weights == {"hot": 9000} and other == 1
+
+
+def test_build_balanced():
+    weights = {"a": 50, "b": 30, "c": 20, "d": 20}
+    partitioner = build_balanced(3, weights, other_weight=30)
+    # Heaviest first, each on the least loaded partition
+    assert partitioner.assignment == {"a": 1, "b": 2, "c": 3, "d": 3}
+    assert partitioner.splits == {}
+
+
+def test_build_balanced_splits_heavy_keys():
+    weights = {"hot": 600, "warm": 100, "cold": 50}
+    assert build_balanced(3, weights).splits == {}
+    partitioner = build_balanced(3, weights, other_weight=150, splittable=True)
+    # A fair share is 300, so "hot" is cut in two
+    assert partitioner.is_split("hot")
+    assert len(partitioner.splits["hot"]) == 2
+    assert not partitioner.is_split("warm")
+    # Never more pieces than partitions
+    assert len(build_balanced(3, {"hot": 10000, "x": 1}, splittable=True).splits["hot"]) == 3
@@ -0,0 +1,90 @@
+"""
+Message framing (engine/protocol.py).
+
+    python -m pytest tests/test_protocol.py
+"""
+
+import asyncio
+import os
+import socket
+import sys
+import threading
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.compression import AdaptiveCompressor
+from engine.protocol import (HEADER, KIND_BLOB, KIND_JSON, FLAG_COMPRESSED, ConnectionClosed,
+                             decode_payload, encode_message, read_message, recv_message,
+                             send_message)
+
+
+def split_frame(frame):
+    length, kind = HEADER.unpack_from(frame)
+    payload = frame[HEADER.size:]
+    assert len(payload) == length
+    return kind, payload
+
+
+def test_json_and_blob_frames():
+    kind, payload = split_frame(encode_message({"type": "ping", "n": 1}))
+    assert kind == KIND_JSON
+    assert decode_payload(kind, payload) == {"type": "ping", "n": 1}
+
+    kind, payload = split_frame(encode_message({"type": "batch"}, blob=b"\x00\xffraw"))
+    assert kind == KIND_BLOB
+    assert decode_payload(kind, payload) == {"type": "batch", "blob": b"\x00\xffraw"}
+
+
+def test_compressed_frame():
+    msg = {"type": "sample", "keys": ["artist"] * 2000}
+    kind, payload = split_frame(encode_message(msg, blob=b"x" * 10000,
+                                               compressor=AdaptiveCompressor(level=6)))
+    assert kind == KIND_BLOB | FLAG_COMPRESSED
+    assert len(payload) < 2000
+    assert decode_payload(kind, payload) == dict(msg, blob=b"x" * 10000)
+    # Small payloads are sent as they are
+    kind, _ = split_frame(encode_message({"type": "ping"}, compressor=AdaptiveCompressor()))
+    assert kind == KIND_JSON
+
+
+def test_socket_frames_are_not_merged_or_cut():
+    left, right = socket.socketpair()
+    with left, right:
+        def send():
+            # Two frames in one write, then one bigger than the socket buffers
+            left.sendall(encode_message({"n": 1}) + encode_message({"n": 2}))
+            send_message(left, {"n": 3}, blob=os.urandom(1 << 20))
+            left.shutdown(socket.SHUT_WR)
+        sender = threading.Thread(target=send)
+        sender.start()
+        assert recv_message(right) == {"n": 1}
+        assert recv_message(right) == {"n": 2}
+        assert len(recv_message(right)['blob']) == 1 << 20
+        assert recv_message(right) is None
+        sender.join()
+
+
+def test_socket_closed_in_the_middle_of_a_frame():
+    left, right = socket.socketpair()
+    with left, right:
+        left.sendall(encode_message({"n": 1})[:-2])
+        left.shutdown(socket.SHUT_WR)
+        with pytest.raises(ConnectionClosed):
+            recv_message(right)
+
+
+def test_stream_frames():
+    async def read_all(data):
+        reader = asyncio.StreamReader()
+        reader.feed_data(data)
+        reader.feed_eof()
+        messages = []
+        while (msg := await read_message(reader)) is not None:
+            messages.append(msg)
+        return messages
+
+    frames = encode_message({"n": 1}) + encode_message({"n": 2}, blob=b"abc")
+    assert asyncio.run(read_all(frames)) == [{"n": 1}, {"n": 2, "blob": b"abc"}]
+    with pytest.raises(ConnectionClosed):
+        asyncio.run(read_all(frames[:-1]))
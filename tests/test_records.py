@@ -0,0 +1,71 @@
+"""
+Binary record format (engine/records.py).
+
+    python -m pytest tests/test_records.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.records import (MAGIC, ROWS_PER_BLOCK, RecordWriter, decode_records, encode_records,
+                            read_records)
+
+MIXED = [
+    ("a", 1),
+    ("b", None),
+    ("c", [1, "two", 3.5, [True, False]]),
+    ("d", {"nested": {"x": 1}, "n": 2}),
+    ("e", {"big": 1 << 70, "s": "text"}),
+    ("f", {"artist": "Björk", "plays": 3, "share": 0.25, "top": True}),
+    ("", "empty key"),
+]
+
+
+def test_mixed_values_round_trip():
+    assert decode_records(encode_records(MIXED)) == MIXED
+
+
+def test_rows_blocks():
+    pairs = [(f"k{i % 50}", {"artist": f"a{i % 7}", "plays": i, "share": i / 3})
+             for i in range(ROWS_PER_BLOCK * 2 + 10)]
+    blob = encode_records(pairs)
+    assert decode_records(blob) == pairs
+    # Packed rows of key id + 3 fields (24 bytes), without per-record headers
+    assert len(blob) < 25 * len(pairs)
+
+
+def test_rows_with_changing_field_types():
+    # Same field names, but a float, a string, a huge int and a missing field
+    # in the middle of the run: those records fall back to their own schema
+    pairs = [("k", {"n": i}) for i in range(10)]
+    pairs += [("k", {"n": 1.5}), ("k", {"n": "x"}), ("k", {"n": 1 << 65}), ("k", {"m": 1})]
+    pairs += [("k", {"n": i}) for i in range(10)]
+    assert decode_records(encode_records(pairs)) == pairs
+
+
+@pytest.mark.parametrize("compress_level", [None, 6])
+def test_files(tmp_path, compress_level):
+    path = str(tmp_path / "records.bin")
+    pairs = MIXED + [(f"key{i}", {"n": i, "name": f"name{i % 100}"}) for i in range(20000)]
+    with RecordWriter(path, flush_size=1000, compress_level=compress_level) as writer:
+        writer.write("first", {"n": -1, "name": "first"})
+        writer.write_all(pairs)
+    assert writer.count == len(pairs) + 1
+    assert list(read_records(path)) == [("first", {"n": -1, "name": "first"})] + pairs
+
+
+def test_bad_input(tmp_path):
+    with pytest.raises(ValueError):
+        decode_records(encode_records(MIXED)[:-3])
+    with pytest.raises(ValueError):
+        decode_records(b"JSON" + encode_records(MIXED)[len(MAGIC):])
+
+    path = tmp_path / "records.bin"
+    with RecordWriter(str(path)) as writer:
+        writer.write_all(MIXED)
+    path.write_bytes(path.read_bytes()[:-3])
+    with pytest.raises(ValueError):
+        list(read_records(str(path)))
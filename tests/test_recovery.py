@@ -0,0 +1,139 @@
+"""
+End-to-end recovery checks: a worker stops answering in the middle of a
+job, and the results must still count every record once.
+
+    python -m pytest tests/test_recovery.py
+"""
+
+import json
+import os
+import signal
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import load_config
+from bench.cluster import MASTER, WORKER, make_config
+
+# "even" and "odd" are heavy enough for the balanced partitioner to split
+# them; a few rare "cold" keys are not split, and reducing them is slow,
+# which leaves time to stop a worker in the middle of its reduce
+SPLIT_APP = '''
+import time
+
+def map_function(line):
+    pairs = [("even" if len(line) % 2 == 0 else "odd", 1)]
+    number = line.strip().lstrip("x")
+    if number.isdigit() and int(number) % 200 == 0:
+        pairs.append((f"cold{int(number) // 200 % 10}", 1))
+    return pairs
+
+def combine_function(key, values):
+    return sum(values)
+
+def reduce_function(key, values):
+    if key.startswith("cold"):
+        time.sleep(0.5)
+    return {"total": sum(values)}
+'''
+
+# Every map task takes a while, so the pipelined map phase is still
+# running (and shuffling) when a worker stops
+SLOW_MAP_APP = '''
+import time
+
+def map_batch(text):
+    time.sleep(0.3)
+    counts = {"even": 0, "odd": 0}
+    for line in text.splitlines(keepends=True):
+        counts["even" if len(line) % 2 == 0 else "odd"] += 1
+    return [(key, {"total": total}) for key, total in counts.items()]
+
+def combine_function(key, values):
+    return {"total": sum(value["total"] for value in values)}
+
+def reduce_function(key, values):
+    return {"total": sum(value["total"] for value in values)}
+'''
+
+
+def wait_for(path, text, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if os.path.exists(path):
+            with open(path) as f:
+                if text in f.read():
+                    return True
+        time.sleep(0.02)
+    return False
+
+
+def run_with_stopped_worker(tmp_path, app, stop_after, **settings):
+    """
+    Run `app` on 3 workers and stop worker 2 (SIGSTOP) once the master
+    logged `stop_after`. Returns the master log, {key: total} of the
+    results, the expected totals and the seconds from the stop to the end.
+    """
+    input_path = tmp_path / 'input.csv'
+    lines = ["header"] + ["x" * (i % 7) + str(i) for i in range(20000)]
+    input_path.write_text("\n".join(lines) + "\n")
+    expected = {"even": 0, "odd": 0}
+    for line in lines[1:]:
+        expected["even" if len(line + "\n") % 2 == 0 else "odd"] += 1
+    (tmp_path / 'test_app.py').write_text(app)
+
+    run_dir = tmp_path / 'run'
+    run_dir.mkdir()
+    config = make_config(str(run_dir), str(input_path), 3, load_config())
+    config.update(heartbeat_timeout=2, map_cache=False, columnar=False)
+    config.update(settings)
+    config_path = run_dir / 'config.json'
+    config_path.write_text(json.dumps(config))
+    env = dict(os.environ, MAPREDUCE_CONFIG=str(config_path), PYTHONPATH=str(tmp_path))
+
+    def launch(args, log_name):
+        return subprocess.Popen([sys.executable, '-u'] + args, cwd=run_dir, env=env,
+                                stdout=open(run_dir / log_name, 'w'), stderr=subprocess.STDOUT,
+                                stdin=subprocess.DEVNULL)
+
+    master = launch([MASTER, '--auto'], 'master.log')
+    workers = [launch([WORKER, str(i), 'test_app'], f'worker_{i}.log') for i in (1, 2, 3)]
+    try:
+        assert wait_for(run_dir / 'master.log', stop_after, 60)
+        workers[1].send_signal(signal.SIGSTOP)
+        stopped = time.monotonic()
+        assert master.wait(timeout=120) == 0
+        recovery_s = time.monotonic() - stopped
+    finally:
+        for proc in [master] + workers:
+            proc.kill()
+            proc.wait()
+
+    with open(run_dir / 'reduce_results.jsonl') as f:
+        results = {r['key']: r['value']['total'] for r in map(json.loads, f)}
+    return (run_dir / 'master.log').read_text(), results, expected, recovery_s
+
+
+def test_worker_lost_during_reduce_with_split_keys(tmp_path):
+    # Worker 2 stops answering in the middle of its reduce
+    log, results, expected, _ = run_with_stopped_worker(
+        tmp_path, SPLIT_APP, "SHUFFLE PHASE COMPLETE", partitioner="balanced", pipelined=False)
+    assert "Splitting hot keys" in log
+    assert "Recovering from Worker 2" in log
+    # Every 200th line also counts for one of ten cold keys
+    expected.update({f"cold{k}": 10 for k in range(10)})
+    assert results == expected
+
+
+def test_worker_hangs_during_pipelined_map(tmp_path):
+    # Worker 2 stops while map outputs are being shuffled to it; the others
+    # must give up on it once it is declared lost, not after shuffle_timeout
+    log, results, expected, recovery_s = run_with_stopped_worker(
+        tmp_path, SLOW_MAP_APP, "finished map task", pipelined=True, map_tasks_per_worker=8,
+        shuffle_timeout=30)
+    assert "Worker 2 lost" in log
+    assert "Re-queued map tasks" in log
+    assert results == expected
+    # heartbeat_timeout (2 s) and what is left of the map phase
+    assert recovery_s < 12
@@ -0,0 +1,91 @@
+"""
+Map task scheduling (engine/scheduler.py).
+
+    python -m pytest tests/test_scheduler.py
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.scheduler import DONE, RUNNING, TaskScheduler
+
+
+def test_tasks_are_handed_out_in_order():
+    scheduler = TaskScheduler(["s0", "s1", "s2"], speculation=False)
+    picked = [scheduler.next_task(worker_id, now=0) for worker_id in (1, 2, 1)]
+    assert [(task['task_id'], task['split'], backup) for task, backup in picked] == \
+        [(0, "s0", False), (1, "s1", False), (2, "s2", False)]
+    assert scheduler.next_task(2, now=1) is None
+    for task_id in range(3):
+        assert not scheduler.done()
+        assert scheduler.complete(task_id, 1, now=1)
+    assert scheduler.done()
+
+
+def test_backup_of_a_straggler():
+    scheduler = TaskScheduler(["s0", "s1", "s2"], slowdown=1.5)
+    scheduler.next_task(1, now=0)
+    scheduler.next_task(2, now=0)
+    scheduler.next_task(3, now=0)
+    # Nothing finished yet, so nothing counts as slow
+    assert scheduler.next_task(1, now=100) is None
+    scheduler.complete(0, 1, now=10)
+    scheduler.complete(2, 3, now=10)
+    # Task 1 runs longer than 1.5 x the median (10 s) only after 15 s
+    assert scheduler.next_task(1, now=14) is None
+    task, backup = scheduler.next_task(1, now=16)
+    assert backup and task['task_id'] == 1
+    assert set(task['attempts']) == {1, 2}
+    assert scheduler.backups == 1
+    # One backup per task, and never on the worker already running it
+    assert scheduler.next_task(3, now=17) is None
+    assert scheduler.next_task(2, now=17) is None
+
+    # The first attempt to finish wins, the other result is a duplicate
+    assert scheduler.complete(1, 1, now=18, output="w1/map_1.bin")
+    assert not scheduler.complete(1, 2, now=19, output="w2/map_1.bin")
+    assert scheduler.tasks[1]['owner'] == 1
+    assert scheduler.tasks[1]['output'] == "w1/map_1.bin"
+    assert scheduler.owned_tasks(1) == [0, 1]
+
+
+def test_no_backups_without_speculation():
+    scheduler = TaskScheduler(["s0", "s1"], speculation=False)
+    scheduler.next_task(1, now=0)
+    scheduler.next_task(2, now=0)
+    scheduler.complete(0, 1, now=1)
+    assert scheduler.next_task(1, now=1000) is None
+    assert scheduler.tasks[1]['state'] == RUNNING
+    assert scheduler.tasks[0]['state'] == DONE
+
+
+def test_worker_lost_requeues_only_its_tasks():
+    scheduler = TaskScheduler(["s0", "s1", "s2", "s3", "s4"], speculation=False)
+    for worker_id in (1, 2, 1, 2):
+        scheduler.next_task(worker_id, now=0)
+    scheduler.complete(0, 1, now=1, output="w1/map_0.bin")
+    scheduler.complete(1, 2, now=1, output="w2/map_1.bin")
+    # Worker 2 finished task 1 and still runs task 3; task 4 was never started
+    assert scheduler.worker_lost(2) == [1, 3]
+    assert scheduler.pending == [1, 3, 4]
+    assert scheduler.tasks[0]['owner'] == 1
+    assert scheduler.tasks[1]['owner'] is None and scheduler.tasks[1]['attempts'] == {}
+    assert scheduler.owned_tasks(2) == []
+    # The requeued tasks come first
+    assert scheduler.next_task(1, now=2)[0]['task_id'] == 1
+
+
+def test_worker_lost_with_a_backup_running():
+    scheduler = TaskScheduler(["s0", "s1"])
+    scheduler.next_task(1, now=0)
+    scheduler.next_task(2, now=0)
+    scheduler.complete(0, 1, now=10)
+    task, backup = scheduler.next_task(1, now=20)
+    assert backup and task['task_id'] == 1
+    # The backup on worker 1 carries on, so task 1 is not requeued
+    assert scheduler.worker_lost(2) == []
+    assert scheduler.tasks[1]['state'] == RUNNING
+    assert list(scheduler.tasks[1]['attempts']) == [1]
+    assert scheduler.complete(1, 1, now=21)
+    assert scheduler.done()
@@ -0,0 +1,67 @@
+"""
+Receiver side of the shuffle (engine/shuffle.py PartitionStore).
+
+    python -m pytest tests/test_shuffle.py
+"""
+
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.extsort import ExternalSorter
+from engine.shuffle import PartitionStore
+
+
+def reduce_input(store, partition):
+    return {key: sorted(values) for key, values in store.sorter(partition).groups()}
+
+
+def test_groups_count_once(tmp_path):
+    store = PartitionStore(str(tmp_path), max_records=4)
+    store.stage(1, [1, 2], [("a", 1), ("b", 2)], source=0)
+    store.stage(1, [1, 2], [("a", 3)], source=0)
+    assert store.commit(1, [1, 2], source=0)
+    # A group with a task that was committed before is dropped
+    store.stage(1, [2], [("a", 100)], source=1)
+    assert not store.commit(1, [2], source=1)
+    store.stage(1, [3], [("c", 4)], source=1)
+    assert store.commit(1, [3], source=1)
+    assert reduce_input(store, 1) == {"a": [1, 3], "b": [2], "c": [4]}
+
+
+def test_resent_group_does_not_mix_with_the_half_sent_one(tmp_path):
+    store = PartitionStore(str(tmp_path))
+    # Half of the group came over a connection that then failed ...
+    store.stage(1, [7], [("a", 1)], source=0)
+    # ... and the whole group again over a new one
+    store.stage(1, [7], [("a", 1), ("a", 2)], source=1)
+    assert store.commit(1, [7], source=1)
+    assert reduce_input(store, 1) == {"a": [1, 2]}
+    store.drop(1)
+    assert os.listdir(tmp_path) == []
+
+
+def test_a_spill_does_not_block_other_receivers(tmp_path, monkeypatch):
+    spill = ExternalSorter._spill
+    spilling = threading.Event()
+
+    def slow_spill(self):
+        if self.prefix.startswith("stage_p1_"):
+            spilling.set()
+            time.sleep(1)
+        spill(self)
+    monkeypatch.setattr(ExternalSorter, '_spill', slow_spill)
+
+    store = PartitionStore(str(tmp_path), max_records=10)
+    first = threading.Thread(target=store.stage, args=(1, [1], [(str(i), i) for i in range(20)], 0))
+    first.start()
+    assert spilling.wait(5)
+    start = time.monotonic()
+    store.stage(2, [2], [("x", 1)], source=1)
+    assert store.commit(2, [2], source=1)
+    assert time.monotonic() - start < 0.5
+    first.join()
+    assert store.commit(1, [1], source=0)
+    assert len(reduce_input(store, 1)) == 20
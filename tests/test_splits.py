@@ -0,0 +1,54 @@
+"""
+Byte-range input splits (engine/splits.py).
+
+    python -m pytest tests/test_splits.py
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.splits import compute_splits, read_split_lines, read_split_text, subdivide_split
+
+
+def write_input(path, lines):
+    path.write_text("".join(line + "\n" for line in lines), encoding="utf-8")
+    return str(path)
+
+
+def test_splits_cover_every_line_once(tmp_path):
+    lines = [f"row {i}," + "é" * (i % 13) for i in range(1000)]
+    path = write_input(tmp_path / "input.csv", ["header"] + lines)
+    splits = compute_splits(path, 7)
+    assert len(splits) == 7
+    assert splits[0]["start"] == len("header\n")
+    assert splits[-1]["end"] == os.path.getsize(path)
+    assert all(a["end"] == b["start"] for a, b in zip(splits, splits[1:]))
+    read = [line.rstrip("\n") for split in splits for line in read_split_lines(split)]
+    assert read == lines
+    assert "".join(read_split_text(split) for split in splits) == "".join(l + "\n" for l in lines)
+
+
+def test_more_splits_than_lines(tmp_path):
+    path = write_input(tmp_path / "input.csv", ["header", "a", "b"])
+    splits = compute_splits(path, 10)
+    assert [list(read_split_lines(split)) for split in splits] == [["a\n"], ["b\n"]]
+    assert compute_splits(write_input(tmp_path / "empty.csv", ["header"]), 3) == []
+
+
+def test_subdivide_split(tmp_path):
+    lines = [f"line {i}" for i in range(100)]
+    path = write_input(tmp_path / "input.csv", lines)
+    split = compute_splits(path, 3, skip_header=False)[1]
+    parts = subdivide_split(split, 4)
+    assert len(parts) == 4
+    assert (parts[0]["start"], parts[-1]["end"]) == (split["start"], split["end"])
+    assert [l for part in parts for l in read_split_lines(part)] == list(read_split_lines(split))
+    assert subdivide_split(split, 1) == [split]
+
+
+def test_last_line_without_newline(tmp_path):
+    path = tmp_path / "input.csv"
+    path.write_text("header\na\nb")
+    splits = compute_splits(str(path), 2)
+    assert [line for split in splits for line in read_split_lines(split)] == ["a\n", "b"]
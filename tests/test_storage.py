@@ -0,0 +1,40 @@
+"""
+Shared storage check (engine/storage.py).
+
+    python -m pytest tests/test_storage.py
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine.storage import check_markers, place_markers, remove_markers
+
+
+def test_shared_directories_pass(tmp_path, monkeypatch):
+    markers = place_markers({"work_dir": str(tmp_path / "work"),
+                             "output_dir": str(tmp_path / "results" / "job_1")}, 1)
+    # Relative paths of a worker running in the same directory
+    monkeypatch.chdir(tmp_path)
+    check_markers(markers, {"work_dir": "work", "output_dir": str(tmp_path / "results" / "job_1")})
+    remove_markers(markers)
+    assert os.listdir(tmp_path / "work") == []
+
+
+def test_unreadable_marker(tmp_path):
+    markers = place_markers({"output_dir": str(tmp_path / "results")}, 1)
+    # Another machine: the path holds nothing, or a file of some other job
+    os.remove(markers["output_dir"]["path"])
+    with pytest.raises(RuntimeError, match="output_dir .* cannot be read here"):
+        check_markers(markers, {})
+    markers = place_markers({"output_dir": str(tmp_path / "results")}, 1)
+    with pytest.raises(RuntimeError, match="shared storage"):
+        check_markers(dict(markers, output_dir=dict(markers["output_dir"], token="other")), {})
+
+
+def test_worker_with_another_work_dir(tmp_path):
+    markers = place_markers({"work_dir": str(tmp_path / "work")}, 1)
+    with pytest.raises(RuntimeError, match="work_dir is .*elsewhere"):
+        check_markers(markers, {"work_dir": str(tmp_path / "elsewhere")})
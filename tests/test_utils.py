@@ -0,0 +1,30 @@
+"""
+Command line helpers (utils.py).
+
+    python -m pytest tests/test_utils.py
+"""
+
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils import format_problems, parse_problems
+
+
+def test_parse_problems():
+    assert parse_problems([]) == [("user_app", [])]
+    assert parse_problems(["--popularity"]) == [("user_app", ["--popularity"])]
+    assert parse_problems(["user_app_problem2", "--popularity"]) == \
+        [("user_app_problem2", ["--popularity"])]
+    assert parse_problems(["user_app", "+", "user_app_problem2", "--popularity", "--top"]) == \
+        [("user_app", []), ("user_app_problem2", ["--popularity", "--top"])]
+    # A group without a module name runs the default one
+    assert parse_problems(["+", "--popularity"], default="app") == \
+        [("app", []), ("app", ["--popularity"])]
+
+
+def test_format_problems_round_trip():
+    problems = [("user_app", []), ("user_app_problem2", ["--popularity"])]
+    line = format_problems(problems)
+    assert line == "user_app + user_app_problem2 --popularity"
+    assert parse_problems(line.split()) == problems
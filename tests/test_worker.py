@@ -0,0 +1,43 @@
+"""
+Map-side shuffle of a worker (engine/worker.py bucket_group).
+
+    python -m pytest tests/test_worker.py
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from engine import worker
+from engine.partitioner import BalancedPartitioner
+from engine.records import RecordWriter
+
+
+def test_split_key_goes_to_the_same_partition_alone_and_in_a_group(tmp_path, monkeypatch):
+    monkeypatch.setattr(worker, 'worker_id', 1, raising=False)
+    # "hot" is split over partitions 1-3; a different count per task tells them apart
+    task_outputs = {}
+    for task_id, count in ((4, 10), (5, 1), (6, 100)):
+        path = tmp_path / f"map_{task_id}.bin"
+        with RecordWriter(str(path)) as writer:
+            writer.write_all([("hot", 1)] * count + [("cold", 1)])
+        task_outputs[task_id] = str(path)
+    job = SimpleNamespace(
+        partitioner=BalancedPartitioner(3, {}, {"hot": [1, 2, 3]}),
+        task_outputs=task_outputs,
+        problems=SimpleNamespace(combine_pairs=lambda pairs: worker.combine_pairs(pairs, lambda key, values: sum(values))),
+        # All partitions belong to another worker, so all are returned
+        partition_table=[{"worker_id": 2, "ip": "127.0.0.1", "port": 9000 + p} for p in (1, 2, 3)],
+    )
+
+    def partition_of_hot(partitions, total):
+        return [p for p, (_, records) in partitions.items() if ("hot", total) in records]
+
+    alone, _ = worker.bucket_group(job, [5], [1, 2, 3])
+    grouped, stats = worker.bucket_group(job, [4, 5, 6], [1, 2, 3])
+    assert len(partition_of_hot(alone, 1)) == 1
+    assert partition_of_hot(grouped, 1) == partition_of_hot(alone, 1)
+    # The other tasks of the group are combined on their own too
+    assert partition_of_hot(grouped, 10) and partition_of_hot(grouped, 100)
+    assert stats["records_in"] == 114
@@ -1,5 +1,7 @@
 import csv
 import io
+import itertools
+from collections import Counter
 
 # Configuration parameters
 FILTER_START_YEAR = 1990  
@@ -53,7 +55,102 @@ def map_function(document_line):
     except Exception as e:
         return []
 
-# --- 2. REDUCE FUNCTION ---
+# --- 1b. BATCHED MAP FUNCTION ---
+def _int_column(column):
+    """Parse a column of strings, None where the value is not an integer"""
+    try:
+        return list(map(int, column))
+    except ValueError:
+        pass
+    parsed = []
+    for text in column:
+        try:
+            parsed.append(int(text))
+        except ValueError:
+            parsed.append(None)
+    return parsed
+
+def map_batch(lines_or_buffer):
+    """Map a whole split at once.
+
+    The CSV is parsed once into columns, then filtering and interval
+    bucketing work on whole columns. Returns one combined value per
+    interval (same shape as combine_function output).
+    """
+    if not isinstance(lines_or_buffer, str):
+        lines_or_buffer = ''.join(lines_or_buffer)
+    rows = [row for row in csv.reader(io.StringIO(lines_or_buffer)) if len(row) >= 18]
+    if not rows:
+        return []
+    return map_columns(dict(enumerate(zip(*rows))))
+
+# --- 1c. COLUMNAR MAP FUNCTION ---
+# Columns read from a columnar input (engine/columnar.py): 0=Artist, 2=Duration, 4=Year
+COLUMNS = [0, 2, 4]
+# Rows outside these years give no output, row groups outside them are skipped
+ZONE_FILTER = {4: (FILTER_START_YEAR, FILTER_END_YEAR)}
+
+def map_columns(columns):
+    """Map some rows given as {column index: values}, like map_batch"""
+    artists = columns[0]
+    durations = _int_column(columns[2])
+    years = _int_column(columns[4])
+
+    # making fliter + INTERVAL/SHIFTING, computed once per distinct year
+    interval_of = {y: get_interval_key(y) for y in set(years)
+                   if y is not None and FILTER_START_YEAR <= y <= FILTER_END_YEAR}
+    keys = list(map(interval_of.get, years))
+
+    # Rows that survive the filter, sorted by interval so each interval
+    # is one contiguous run of row numbers
+    valid = [k is not None and d is not None for k, d in zip(keys, durations)]
+    order = sorted(itertools.compress(range(len(keys)), valid), key=keys.__getitem__)
+
+    results = []
+    for key, group in itertools.groupby(order, key=keys.__getitem__):
+        idx = list(group)
+        results.append((key, {
+            "duration": sum(map(durations.__getitem__, idx)),
+            "count": len(idx),
+            "artist_counts": dict(Counter(map(artists.__getitem__, idx))),
+            "years": sorted(set(map(years.__getitem__, idx)))
+        }))
+    return results
+
+# --- 2. COMBINE FUNCTION ---
+def combine_function(key, values_list):
+    """Pre-aggregate one key on the mapper.
+
+    Accepts raw map values and already combined values, so it can be
+    applied more than once. The output is understood by reduce_function.
+    """
+    total_duration = 0
+    count = 0
+    artist_counts = {}
+    years_found = set()
+
+    for item in values_list:
+        total_duration += item['duration']
+        if 'count' in item:
+            count += item['count']
+            for art, c in item['artist_counts'].items():
+                artist_counts[art] = artist_counts.get(art, 0) + c
+            years_found.update(item['years'])
+        else:
+            count += 1
+            art = item['artist']
+            artist_counts[art] = artist_counts.get(art, 0) + 1
+            if 'original_year' in item:
+                years_found.add(item['original_year'])
+
+    return {
+        "duration": total_duration,
+        "count": count,
+        "artist_counts": artist_counts,
+        "years": sorted(years_found)
+    }
+
+# --- 3. REDUCE FUNCTION ---
 def reduce_function(key, values_list):
     total_duration = 0
     count = 0
@@ -64,6 +161,15 @@ def reduce_function(key, values_list):
     
     for item in values_list:
         total_duration += item['duration']
+
+        # already combined on the mapper
+        if 'count' in item:
+            count += item['count']
+            for art, c in item['artist_counts'].items():
+                artist_counts[art] = artist_counts.get(art, 0) + c
+            years_found.update(item['years'])
+            continue
+
         count += 1
         
         # calculating artists
@@ -95,4 +201,8 @@ def reduce_function(key, values_list):
 if __name__ == "__main__":
     print(f"--- Configuration: {INTERVAL_SIZE}-year intervals, Offset: {INTERVAL_OFFSET} ---")
     line = 'Britney Spears,Song,200000,False,2002,80,0.5,0.5,1,-5,0,0.05,0.3,0,0.3,0.9,95,pop'
-    print(f"Mapped: {map_function(line)}")
\ No newline at end of file
+    print(f"Mapped: {map_function(line)}")
+    key, value = map_function(line)[0]
+    print(f"Combined: {combine_function(key, [value, value])}")
+    batch = [line + "\n", line]
+    print(f"Batch mapped: {map_batch(batch)}")
\ No newline at end of file
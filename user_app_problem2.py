@@ -16,6 +16,7 @@ Usage:
 
 import csv
 import io
+from collections import Counter
 
 # --- FEATURE FLAG ---
 POPULARITY_ENABLED = False
@@ -97,7 +98,81 @@ def map_function(document_line):
         return []
 
 
-# --- 2. REDUCE FUNCTION ---
+# --- 1b. BATCHED MAP FUNCTION ---
+def map_batch(lines_or_buffer):
+    """
+    Input: A whole split (string buffer or list of CSV lines)
+    Output: One (genre, combined value) tuple per genre
+
+    The split is parsed once into columns and the counting is done per
+    column instead of building a dict for every row.
+    """
+    if not isinstance(lines_or_buffer, str):
+        lines_or_buffer = ''.join(lines_or_buffer)
+    rows = [row for row in csv.reader(io.StringIO(lines_or_buffer))
+            if len(row) >= 18 and row[3] != 'explicit']
+    if not rows:
+        return []
+    return map_columns(dict(enumerate(zip(*rows))))
+
+
+# --- 1c. COLUMNAR MAP FUNCTION ---
+# Columns read from a columnar input (engine/columnar.py)
+COLUMNS = [3, 6, 17]
+
+
+def map_columns(columns):
+    """
+    Input: {column index: values} of some rows (explicit, popularity, genre)
+    Output: One (genre, combined value) tuple per genre, like map_batch
+    """
+    genres = [g.strip() for g in columns[17]]
+    explicit_flags = [e.strip().lower() == 'true' for e in columns[3]]
+
+    track_counts = Counter(genres)
+    explicit_counts = Counter(g for g, e in zip(genres, explicit_flags) if e)
+
+    results = {}
+    for genre, total in track_counts.items():
+        results[genre] = {
+            "track_count": total,
+            "explicit_count": explicit_counts.get(genre, 0),
+        }
+
+    # --- OPTIONAL: Popularity analysis ---
+    if POPULARITY_ENABLED:
+        for value_data in results.values():
+            value_data["explicit_popularity_sum"] = 0
+            value_data["explicit_popularity_count"] = 0
+            value_data["clean_popularity_sum"] = 0
+            value_data["clean_popularity_count"] = 0
+        for genre, explicit_flag, pop_str in zip(genres, explicit_flags, columns[6]):
+            try:
+                popularity = int(pop_str)
+            except ValueError:
+                continue
+            prefix = "explicit" if explicit_flag else "clean"
+            results[genre][prefix + "_popularity_sum"] += popularity
+            results[genre][prefix + "_popularity_count"] += 1
+
+    return list(results.items())
+
+
+# --- 2. COMBINE FUNCTION ---
+def combine_function(key, values_list):
+    """
+    Pre-aggregate the values of one genre on the mapper.
+    All fields are plain counters, so the combined value has the same
+    shape as a map value and reduce_function needs no changes.
+    """
+    combined = {}
+    for item in values_list:
+        for field, amount in item.items():
+            combined[field] = combined.get(field, 0) + amount
+    return combined
+
+
+# --- 3. REDUCE FUNCTION ---
 def reduce_function(key, values_list):
     """
     Input:
@@ -190,10 +265,14 @@ if __name__ == "__main__":
         if genre not in grouped:
             grouped[genre] = []
         grouped[genre].append(value)
+
+    # The batched entry point must agree with the per-line one
+    batch_mapped = dict(map_batch("\n".join(sample_lines)))
+    assert batch_mapped == {g: combine_function(g, v) for g, v in grouped.items()}
     
     print("Results:")
     for genre, values in grouped.items():
-        result = reduce_function(genre, values)
+        result = reduce_function(genre, [combine_function(genre, values)])
         print(f"\n{genre}: {result}")
     
     print("\n" + "=" * 60)
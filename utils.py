@@ -3,7 +3,30 @@ import os
 
 def load_config():
     base_dir = os.path.dirname(os.path.abspath(__file__))
-    config_path = os.path.join(base_dir, 'conf', 'config.json')
+    # MAPREDUCE_CONFIG points at another config file, e.g. one written by bench/
+    config_path = os.environ.get('MAPREDUCE_CONFIG') or os.path.join(base_dir, 'conf', 'config.json')
     
     with open(config_path, 'r') as f:
-        return json.load(f)
\ No newline at end of file
+        return json.load(f)
+
+def parse_problems(argv, default="user_app"):
+    """
+    Problem modules and their --flags from a command line. Several modules,
+    run over one scan of the input, are separated by '+':
+        user_app + user_app_problem2 --popularity
+    """
+    problems = []
+    group = []
+    for arg in list(argv) + ['+']:
+        if arg != '+':
+            group.append(arg)
+            continue
+        name = group[0] if group and not group[0].startswith('--') else default
+        problems.append((name, [a for a in group if a.startswith('--')]))
+        group = []
+    return problems
+
+
+def format_problems(problems):
+    """The command line form of parse_problems() output"""
+    return " + ".join(" ".join([name] + list(args)) for name, args in problems)